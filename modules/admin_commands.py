@@ -1,5 +1,7 @@
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+import asyncio
+from telegram import Update
 from telegram.ext import ContextTypes
+from modules.settings import env_settings
 from modules.log_utils import log_async_call
 from modules.logging_config import logger
 from modules.storage import (
@@ -8,13 +10,30 @@ from modules.storage import (
     db_unlink_users_from_email,
     db_get_users_by_email,
     db_get_email_row,
+    db_add_allow_rule,
+    db_remove_allow_rule,
+    db_list_allow_rules,
+    db_list_authorized_emails,
+    db_revoke_users,
 )
-from modules.auth_utils import is_admin
+from modules.auth_utils import is_admin, is_top_level_admin, is_root_admin, admin_roles
 from modules.template_engine import render_template
-from modules.config import authorization_ui, telegram_start
+from modules.config import settings, ConfigError
+from modules.hot_reload import reload_config
+from modules.keyboards import keyboards
 from modules.states import UserState
+from modules.sharding import set_user_state, invalidate_email, reload_admin_roles
+from modules.preauth_guard import preauth_guard
+from modules.allowlist import allowlist, parse_rule, RULE_BAN
+from modules.media_group_buffer import pending_media_groups
+from modules.ticket_pipeline import in_flight_tickets
+from modules import profiler
 
-email_status_labels = authorization_ui.get("email_status_labels", {})
+DEFAULT_PROFILE_SECONDS = 30
+MAX_PROFILE_SECONDS = 600
+
+# Ссылки на задачи профилирования, чтобы их не собрал сборщик мусора
+_profile_tasks = set()
 
 @log_async_call
 async def handle_add_email(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -31,6 +50,7 @@ async def handle_add_email(update: Update, context: ContextTypes.DEFAULT_TYPE):
     for email in context.args:
         email = email.strip()
         db_add_allowed_email(email)
+        await invalidate_email(context.application, email)
         logger.info(f"Admin {user.id} added allowed email: {email}")
         added.append(email)
         
@@ -46,18 +66,13 @@ async def handle_add_email(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 telegram_id = user_data["telegram_id"]
                 
                 text = render_template("welcome_user.txt", username=username, email=email)
-                button_text = telegram_start.get("action_button_text", "Submit a request")
-                keyboard = InlineKeyboardMarkup([
-                    [InlineKeyboardButton(text=button_text, callback_data="submit_request")]
-                ])
-                
-                context.application.user_data[telegram_id]["state"] = UserState.WAITING_FOR_REQUEST_BUTTON
+                await set_user_state(context.application, telegram_id, UserState.WAITING_FOR_REQUEST_BUTTON)
                 
                 await context.bot.send_message(
                     chat_id=telegram_id,
                     text=text,
                     parse_mode="HTML",
-                    reply_markup=keyboard
+                    reply_markup=keyboards().action_markup
                 )
                 
                 logger.info(f"Sent authorization message to user {telegram_id}")
@@ -81,6 +96,7 @@ async def handle_ban_email(update: Update, context: ContextTypes.DEFAULT_TYPE):
     for email in context.args:
         email = email.strip()
         db_ban_allowed_email(email)
+        await invalidate_email(context.application, email)
         logger.info(f"Admin {user.id} banned email: {email}")
         banned.append(email)
 
@@ -101,6 +117,7 @@ async def handle_remove_email(update: Update, context: ContextTypes.DEFAULT_TYPE
     for email in context.args:
         email = email.strip()
         db_unlink_users_from_email(email)
+        await invalidate_email(context.application, email)
         logger.info(f"Admin {user.id} removed allowed email: {email}")
         removed.append(email)
 
@@ -117,6 +134,7 @@ async def handle_check_email(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text(render_template("email_required.txt", command="/check_email"))
         return
 
+    email_status_labels = settings().authorization_ui.get("email_status_labels", {})
     results = []
     for email in context.args:
         email = email.strip()
@@ -128,4 +146,296 @@ async def handle_check_email(update: Update, context: ContextTypes.DEFAULT_TYPE)
             status_label = email_status_labels.get(status_key, status_key)
             results.append(render_template("email_status_found.txt", email=email, status=status_label))
 
-    await update.message.reply_text("\n".join(results))
\ No newline at end of file
+    await update.message.reply_text("\n".join(results))
+async def _apply_allow_rules(update: Update, context: ContextTypes.DEFAULT_TYPE, is_ban: bool):
+    user = update.effective_user
+    if not is_admin(user.id):
+        await update.message.reply_text(render_template("not_authorized.txt"))
+        return
+
+    command = "/ban_rule" if is_ban else "/allow_rule"
+    if not context.args:
+        await update.message.reply_text(render_template("allow_rule_required.txt", command=command))
+        return
+
+    rules = []
+    for pattern in context.args:
+        try:
+            _, rule, _, _ = parse_rule(pattern)
+        except ValueError:
+            await update.message.reply_text(render_template("allow_rule_invalid.txt", rule=pattern))
+            continue
+        db_add_allow_rule(rule, is_ban=is_ban)
+        logger.info(f"Admin {user.id} added {'ban' if is_ban else 'allow'} rule: {rule}")
+        rules.append(rule)
+
+    if rules:
+        await asyncio.to_thread(allowlist.reload)
+        preauth_guard.clear()
+        revoked = 0
+        if is_ban:
+            revoked = await asyncio.to_thread(_revoke_banned_users)
+            logger.info(f"Admin {user.id} ban rules revoked {revoked} authorized users")
+        template = "allow_rules_banned.txt" if is_ban else "allow_rules_added.txt"
+        await update.message.reply_text(render_template(template, rules=rules, revoked=revoked))
+
+def _revoke_banned_users() -> int:
+    """
+    Снимает авторизацию с пользователей, чей адрес попал под запрещающее правило
+    @return Число пользователей, у которых снята авторизация
+    """
+    banned = [telegram_id for telegram_id, email in db_list_authorized_emails() if allowlist.match(email) == RULE_BAN]
+    return db_revoke_users(banned) if banned else 0
+
+@log_async_call
+async def handle_allow_rule(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _apply_allow_rules(update, context, is_ban=False)
+
+@log_async_call
+async def handle_ban_rule(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _apply_allow_rules(update, context, is_ban=True)
+
+@log_async_call
+async def handle_remove_rule(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not is_admin(user.id):
+        await update.message.reply_text(render_template("not_authorized.txt"))
+        return
+
+    if not context.args:
+        await update.message.reply_text(render_template("allow_rule_required.txt", command="/remove_rule"))
+        return
+
+    removed = []
+    for pattern in context.args:
+        try:
+            _, rule, _, _ = parse_rule(pattern)
+        except ValueError:
+            rule = pattern.strip().lower()
+        if db_remove_allow_rule(rule):
+            logger.info(f"Admin {user.id} removed allowlist rule: {rule}")
+            removed.append(rule)
+
+    if removed:
+        await asyncio.to_thread(allowlist.reload)
+        preauth_guard.clear()
+    await update.message.reply_text(render_template("allow_rules_removed.txt", rules=removed))
+
+@log_async_call
+async def handle_rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not is_admin(user.id):
+        await update.message.reply_text(render_template("not_authorized.txt"))
+        return
+
+    rules = db_list_allow_rules()
+    await update.message.reply_text(render_template("allow_rules_list.txt", rules=rules))
+
+TOP_LEVEL_FLAG = "top"
+
+def _parse_admin_args(args: list) -> tuple:
+    """
+    @return (Telegram ID, нераспознанные аргументы, указан ли флаг top)
+    """
+    ids, invalid, top_level = [], [], False
+    for arg in args:
+        arg = arg.strip()
+        if arg.lower() == TOP_LEVEL_FLAG:
+            top_level = True
+        elif arg.lstrip("-").isdigit():
+            ids.append(int(arg))
+        else:
+            invalid.append(arg)
+    return ids, invalid, top_level
+
+@log_async_call
+async def handle_add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not is_top_level_admin(user.id):
+        await update.message.reply_text(render_template("not_authorized.txt"))
+        return
+
+    ids, invalid, top_level = _parse_admin_args(context.args or [])
+    if invalid:
+        await update.message.reply_text(render_template("admin_id_invalid.txt", values=invalid))
+    if not ids:
+        await update.message.reply_text(render_template("admin_id_required.txt", command="/add_admin"))
+        return
+
+    added = []
+    for telegram_id in ids:
+        # Назначать и понижать админов верхнего уровня может только главный админ
+        if (top_level or admin_roles.is_top_level(telegram_id)) and not is_root_admin(user.id):
+            await update.message.reply_text(render_template("admin_root_required.txt", telegram_id=telegram_id))
+            continue
+        if is_root_admin(telegram_id):
+            continue
+        admin_roles.grant(telegram_id, is_top_level=top_level)
+        logger.info(f"Admin {user.id} granted {'top-level ' if top_level else ''}admin role to {telegram_id}")
+        added.append(telegram_id)
+
+    if added:
+        await reload_admin_roles(context.application)
+        await update.message.reply_text(render_template("admins_added.txt", ids=added, top_level=top_level))
+
+@log_async_call
+async def handle_remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not is_top_level_admin(user.id):
+        await update.message.reply_text(render_template("not_authorized.txt"))
+        return
+
+    ids, invalid, _ = _parse_admin_args(context.args or [])
+    if invalid:
+        await update.message.reply_text(render_template("admin_id_invalid.txt", values=invalid))
+    if not ids:
+        await update.message.reply_text(render_template("admin_id_required.txt", command="/remove_admin"))
+        return
+
+    removed, skipped = [], False
+    for telegram_id in ids:
+        if admin_roles.is_top_level(telegram_id) and not is_root_admin(user.id):
+            await update.message.reply_text(render_template("admin_root_required.txt", telegram_id=telegram_id))
+            skipped = True
+            continue
+        if admin_roles.revoke(telegram_id):
+            logger.info(f"Admin {user.id} revoked admin role from {telegram_id}")
+            removed.append(telegram_id)
+
+    if removed:
+        await reload_admin_roles(context.application)
+    if removed or not skipped:
+        await update.message.reply_text(render_template("admins_removed.txt", ids=removed))
+
+@log_async_call
+async def handle_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not is_top_level_admin(user.id):
+        await update.message.reply_text(render_template("not_authorized.txt"))
+        return
+
+    await update.message.reply_text(render_template(
+        "admins_list.txt",
+        root_admin_id=env_settings.root_admin_id,
+        admins=admin_roles.items(),
+    ))
+
+@log_async_call
+async def handle_reload_config(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not is_admin(user.id):
+        await update.message.reply_text(render_template("not_authorized.txt"))
+        return
+
+    try:
+        new_settings = await reload_config(context.bot)
+    except ConfigError as e:
+        logger.error(f"Admin {user.id} config reload rejected: {e}")
+        await update.message.reply_text(render_template("config_reload_failed.txt", error=str(e)))
+        return
+
+    logger.info(f"Admin {user.id} reloaded configuration")
+    await update.message.reply_text(render_template(
+        "config_reloaded.txt",
+        categories=len(new_settings.ticket_categories),
+        keyboard_version=keyboards().version
+    ))
+
+@log_async_call
+async def _finish_cpu_profile(bot, chat_id: int, seconds: float):
+    try:
+        path, samples = await asyncio.to_thread(profiler.run_cpu_profile, seconds)
+    except Exception as e:
+        logger.exception(f"CPU profile failed: {e}")
+        await bot.send_message(chat_id=chat_id, text=render_template("profile_failed.txt", error=str(e)))
+        return
+    await bot.send_message(chat_id=chat_id, text=render_template("profile_finished.txt", path=path, samples=samples))
+
+@log_async_call
+async def handle_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not is_admin(user.id):
+        await update.message.reply_text(render_template("not_authorized.txt"))
+        return
+
+    if profiler.cpu_profile_running():
+        await update.message.reply_text(render_template("profile_busy.txt"))
+        return
+
+    try:
+        seconds = float(context.args[0]) if context.args else DEFAULT_PROFILE_SECONDS
+    except ValueError:
+        seconds = DEFAULT_PROFILE_SECONDS
+    seconds = min(max(seconds, 1), MAX_PROFILE_SECONDS)
+
+    # Профиль снимается в фоне: обработчик не должен держать апдейты на всё время замера
+    task = asyncio.create_task(_finish_cpu_profile(context.bot, update.effective_chat.id, seconds))
+    _profile_tasks.add(task)
+    task.add_done_callback(_profile_tasks.discard)
+
+    logger.info(f"Admin {user.id} started CPU profile for {seconds:.0f}s")
+    await update.message.reply_text(render_template("profile_started.txt", seconds=int(seconds)))
+
+@log_async_call
+async def handle_profile_stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not is_admin(user.id):
+        await update.message.reply_text(render_template("not_authorized.txt"))
+        return
+
+    running = profiler.cpu_profile_running()
+    profiler.stop_cpu_profile()
+    await update.message.reply_text(render_template("profile_stopping.txt", running=running))
+
+@log_async_call
+async def handle_memory_baseline(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not is_admin(user.id):
+        await update.message.reply_text(render_template("not_authorized.txt"))
+        return
+
+    await asyncio.to_thread(profiler.take_memory_baseline)
+    logger.info(f"Admin {user.id} took tracemalloc baseline")
+    await update.message.reply_text(render_template("memory_baseline_taken.txt"))
+
+def _memory_breakdown(sections: dict, shared: set) -> dict:
+    return {
+        name: (len(objects), profiler.deep_sizeof(objects, set(shared)))
+        for name, objects in sections.items()
+    }
+
+@log_async_call
+async def handle_memory_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not is_admin(user.id):
+        await update.message.reply_text(render_template("not_authorized.txt"))
+        return
+
+    # Копии контейнеров снимаются в цикле событий, обход и подсчёт — в отдельном потоке
+    tickets = in_flight_tickets()
+    sections = {
+        "user_data sessions": list(context.application.user_data.values()),
+        "pending_media_groups": [list(messages) for messages in pending_media_groups.values()],
+        "ticket attachments": [list(ticket.attachments) for ticket in tickets],
+    }
+    # Приложение и бот доступны из любого сообщения, но к его размеру не относятся
+    shared = {id(context.application), id(context.bot)}
+    breakdown = await asyncio.to_thread(_memory_breakdown, sections, shared)
+    path = await asyncio.to_thread(profiler.write_memory_report, breakdown)
+
+    logger.info(f"Admin {user.id} requested memory report")
+    await update.message.reply_text(render_template(
+        "memory_report.txt",
+        path=path,
+        sections=[(name, count, round(size / 1024, 1)) for name, (count, size) in breakdown.items()]
+    ))
+
+@log_async_call
+async def handle_memory_stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not is_admin(user.id):
+        await update.message.reply_text(render_template("not_authorized.txt"))
+        return
+
+    await asyncio.to_thread(profiler.stop_memory_tracing)
+    await update.message.reply_text(render_template("memory_tracing_stopped.txt"))
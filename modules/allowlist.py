@@ -0,0 +1,155 @@
+import re
+import asyncio
+import fnmatch
+from telegram.ext import Application
+from modules.settings import env_settings
+from modules.storage import db_list_allow_rules, db_allow_rules_version
+from modules.preauth_guard import preauth_guard
+from modules.log_utils import log_async_call
+from modules.logging_config import logger
+
+RULE_ALLOW = "allow"
+RULE_BAN = "ban"
+
+_DOMAIN_PATTERN = re.compile(r"^(\*\.)?([a-z0-9-]+\.)+[a-z0-9-]+$")
+_LOCAL_PATTERN = re.compile(r"^[a-z0-9_.+*?-]+$")
+
+def parse_rule(pattern: str) -> tuple:
+    """
+    Разбирает правило списка разрешённых адресов:
+    «corp.com» или «@corp.com» — весь домен, «*.corp.com» — все поддомены,
+    «it-*@corp.com» — шаблон локальной части (* и ?), «user@corp.com» — один адрес.
+
+    @return (вид правила, нормализованный шаблон, локальная часть, домен)
+    @raise ValueError: Если шаблон не похож ни на один вид правил
+    """
+    rule = pattern.strip().lower()
+    local, at, domain = rule.rpartition("@")
+    if not at:
+        domain = rule
+    if not _DOMAIN_PATTERN.fullmatch(domain):
+        raise ValueError(f"Invalid domain in rule '{pattern}'")
+    if not local:
+        kind = "subdomains" if domain.startswith("*.") else "domain"
+        return kind, domain, None, domain
+    if not _LOCAL_PATTERN.fullmatch(local):
+        raise ValueError(f"Invalid local part in rule '{pattern}'")
+    if "*" in local or "?" in local or domain.startswith("*."):
+        return "local", f"{local}@{domain}", local, domain
+    return "address", f"{local}@{domain}", local, domain
+
+class _DomainNode:
+    __slots__ = ("children", "domain_rule", "subdomain_rule", "local_rules")
+
+    def __init__(self):
+        self.children = {}
+        self.domain_rule = None       # правило для самого домена
+        self.subdomain_rule = None    # правило для любых поддоменов
+        self.local_rules = []         # (регулярное выражение локальной части, решение, только поддомены)
+
+class AllowlistMatcher:
+    """
+    Скомпилированные правила: дерево доменов по меткам справа налево и множество отдельных адресов.
+    Проверка адреса — O(длины адреса) плюс шаблоны локальной части на его доменах;
+    запрет сильнее разрешения на любом уровне.
+    """
+
+    def __init__(self, rules: list):
+        self._root = _DomainNode()
+        self._addresses = {}
+        self.size = 0
+        for pattern, is_ban in rules:
+            try:
+                self._add(pattern, RULE_BAN if is_ban else RULE_ALLOW)
+                self.size += 1
+            except ValueError as e:
+                logger.error(f"Allowlist rule skipped: {e}")
+
+    def _node(self, domain: str) -> _DomainNode:
+        node = self._root
+        for label in reversed(domain.split(".")):
+            node = node.children.setdefault(label, _DomainNode())
+        return node
+
+    def _add(self, pattern: str, decision: str):
+        kind, rule, local, domain = parse_rule(pattern)
+        if kind == "address":
+            self._addresses[rule] = _stronger(self._addresses.get(rule), decision)
+            return
+        subdomains_only = domain.startswith("*.")
+        node = self._node(domain[2:] if subdomains_only else domain)
+        if kind == "domain":
+            node.domain_rule = _stronger(node.domain_rule, decision)
+        elif kind == "subdomains":
+            node.subdomain_rule = _stronger(node.subdomain_rule, decision)
+        else:
+            regex = re.compile(fnmatch.translate(local))
+            node.local_rules.append((regex, decision, subdomains_only))
+
+    def match(self, email: str):
+        """
+        @return RULE_BAN, RULE_ALLOW или None, если ни одно правило не подходит
+        """
+        email = email.lower()
+        local, _, domain = email.rpartition("@")
+        decision = self._addresses.get(email)
+        if decision == RULE_BAN or not domain:
+            return decision
+
+        labels = domain.split(".")
+        node = self._root
+        last = len(labels) - 1
+        for depth, label in enumerate(reversed(labels)):
+            node = node.children.get(label)
+            if node is None:
+                break
+            exact = depth == last
+            decision = _stronger(decision, node.domain_rule if exact else node.subdomain_rule)
+            for regex, rule_decision, subdomains_only in node.local_rules:
+                if subdomains_only != exact and regex.fullmatch(local):
+                    decision = _stronger(decision, rule_decision)
+            if decision == RULE_BAN:
+                break
+        return decision
+
+def _stronger(current, new):
+    if current == RULE_BAN or new == RULE_BAN:
+        return RULE_BAN
+    return new or current
+
+class Allowlist:
+    """
+    Текущий скомпилированный список правил. Правила меняются командами админов;
+    воркеры (BOT_WORKERS > 1) подхватывают чужие изменения в allowlist_refresh_loop.
+    """
+
+    def __init__(self):
+        self.matcher = AllowlistMatcher([])
+        self.version = None
+
+    def reload(self) -> bool:
+        """
+        Перечитывает правила из БД, если они изменились. Выполняется вне цикла событий.
+
+        @return True, если список пересобран
+        """
+        version = db_allow_rules_version()
+        if version == self.version:
+            return False
+        matcher = AllowlistMatcher(db_list_allow_rules())
+        self.matcher, self.version = matcher, version
+        logger.info(f"Allowlist compiled: {matcher.size} rules")
+        return True
+
+    def match(self, email: str):
+        return self.matcher.match(email)
+
+allowlist = Allowlist()
+
+@log_async_call
+async def allowlist_refresh_loop(app: Application):
+    while True:
+        await asyncio.sleep(env_settings.allowlist_refresh_interval)
+        if await asyncio.to_thread(allowlist.reload):
+            # Адрес, закэшированный как неизвестный, мог стать разрешённым
+            preauth_guard.clear()
@@ -1,38 +1,45 @@
-import re
-import yaml
 import asyncio
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto
+from telegram import Update, ReplyKeyboardRemove
 from telegram.ext import ContextTypes
 from modules.states import UserState
 from modules.template_engine import render_template
 from modules.storage import (
     db_add_user,
+    db_add_allowed_email,
     db_get_user_by_telegram_id,
     db_update_user_email,
     db_get_email_row,
     db_get_email_by_id,
 )
-from modules.config import auth_config, telegram_start, authorization_ui, ticket_categories
+from modules.config import settings
+from modules.keyboards import keyboards
 from modules.log_utils import log_async_call
 from modules.logging_config import logger
-from rich.console import Console
-
-console = Console()
-
-email_pattern = re.compile(auth_config["email_pattern"])
-email_autocomplete = auth_config["email_autocomplete"]
-
-confirm_buttons = authorization_ui.get("confirm_change_buttons", {})
-yes_text = confirm_buttons.get("yes", "Yes")
-no_text = confirm_buttons.get("no", "No")
+from modules.preauth_guard import preauth_guard, EMAIL_UNKNOWN, EMAIL_BANNED
+from modules.allowlist import allowlist, RULE_ALLOW, RULE_BAN
 
 def normalize_email(input_text: str) -> str:
     if "@" not in input_text:
-        return input_text.strip() + email_autocomplete
+        return input_text.strip() + settings().auth_config["email_autocomplete"]
     return input_text.strip()
 
 def is_valid_email(email: str) -> bool:
-    return email_pattern.fullmatch(email) is not None
+    return settings().email_pattern.fullmatch(email) is not None
+
+def get_email_row(email: str, rule) -> dict:
+    """
+    Возвращает строку allowed_emails; адрес, разрешённый правилом, заносится в таблицу при первом обращении,
+    чтобы к нему можно было привязать пользователя
+    @param email Нормализованный адрес
+    @param rule Результат allowlist.match(email)
+    @return Строка allowed_emails или None
+    """
+    email_row = db_get_email_row(email)
+    if not email_row and rule == RULE_ALLOW:
+        db_add_allowed_email(email)
+        email_row = db_get_email_row(email)
+        logger.info(f"Email {email} allowed by allowlist rule, added to allowed_emails")
+    return email_row
 
 @log_async_call
 async def handle_authorization(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -48,6 +55,21 @@ async def handle_authorization(update: Update, context: ContextTypes.DEFAULT_TYP
             await update.message.reply_text(text)
             return
 
+        # Правила доменов и шаблонов проверяются в памяти до таблицы allowed_emails
+        rule = allowlist.match(email)
+        if rule == RULE_BAN:
+            logger.warning(f"User {user.id} attempted to auth with email banned by allowlist rule: {email}")
+            await update.message.reply_text(render_template("auth_banned.txt", email=email))
+            return
+
+        # Отрицательный кэш: заведомо неизвестный или заблокированный адрес не идёт в БД
+        cached_status = preauth_guard.cached_status(email)
+        if cached_status is not None:
+            template = "auth_banned.txt" if cached_status == EMAIL_BANNED else "auth_not_registered.txt"
+            logger.warning(f"User {user.id} attempted to auth with cached {cached_status} email: {email}")
+            await update.message.reply_text(render_template(template, email=email))
+            return
+
         # Получение текущих данных пользователя
         user_data = db_get_user_by_telegram_id(user.id)
 
@@ -62,31 +84,32 @@ async def handle_authorization(update: Update, context: ContextTypes.DEFAULT_TYP
                 return
 
             # Иначе email отличается — запрашиваем подтверждение
-            context.user_data["state"] = UserState.CONFIRMING_EMAIL_CHANGE
-            context.user_data["pending_email"] = email
+            context.user_data.state = UserState.CONFIRMING_EMAIL_CHANGE
+            context.user_data.pending_email = email
             text = render_template("auth_change_confirm.txt", old_email=current_email, new_email=email)
             logger.info(f"User {user.id} attempting to change email: {current_email} -> {email}")
-            keyboard = [[yes_text, no_text]]
-            await update.message.reply_text(text, reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+            await update.message.reply_text(text, reply_markup=keyboards().confirm_markup)
             return
 
         # Авторизация или повторная
         
         # Проверка, зарегистрирован ли email в системе
-        email_row = db_get_email_row(email)
+        email_row = get_email_row(email, rule)
         if not email_row:
             # Email не зарегистрирован — сохраняем пользователя, но без авторизации
             db_add_user(email=email, telegram_id=user.id, username=user.username, full_name=user.full_name, authorized=False)
+            preauth_guard.remember(email, EMAIL_UNKNOWN)
             text = render_template("auth_not_registered.txt", email=email)
-            context.user_data["state"] = UserState.WAITING_FOR_EMAIL
+            context.user_data.state = UserState.WAITING_FOR_EMAIL
             logger.warning(f"Unregistered email attempt by user {user.id}: {email}")
             await update.message.reply_text(text)
             return
         elif email_row["is_banned"]:
             # Email есть, но он заблокирован — пользователь не должен быть авторизован
             db_add_user(email=email, telegram_id=user.id, username=user.username, full_name=user.full_name, authorized=False)
+            preauth_guard.remember(email, EMAIL_BANNED)
             text = render_template("auth_banned.txt", email=email)
-            context.user_data["state"] = UserState.WAITING_FOR_EMAIL
+            context.user_data.state = UserState.WAITING_FOR_EMAIL
             logger.warning(f"User {user.id} attempted to auth with banned email: {email}")
             await update.message.reply_text(text)
             return
@@ -98,6 +121,7 @@ async def handle_authorization(update: Update, context: ContextTypes.DEFAULT_TYP
         text = render_template("auth_success.txt", username=username, email=email)
         await update.message.reply_text(text)
         
+        auth_config = settings().auth_config
         if auth_config.get("send_topic_after_auth", True):
             delay = auth_config.get("delay_after_auth_success", 0)
             if delay > 0:
@@ -106,32 +130,22 @@ async def handle_authorization(update: Update, context: ContextTypes.DEFAULT_TYP
             if auth_config.get("send_welcome_before_topic", False):
                 text = render_template("welcome_user.txt", username=username, email=email)
 
-                if telegram_start.get("show_action_button_if_authorized", False):
+                if settings().telegram_start.get("show_action_button_if_authorized", False):
                     # Показываем кнопку — ждём нажатие, не отправляем топики
-                    button_text = telegram_start.get("action_button_text", "Submit a request")
-                    keyboard = InlineKeyboardMarkup([
-                        [InlineKeyboardButton(text=button_text, callback_data="submit_request")]
-                    ])
+                    context.user_data.state = UserState.WAITING_FOR_REQUEST_BUTTON
                     
-                    context.user_data["state"] = UserState.WAITING_FOR_REQUEST_BUTTON
-                    
-                    await update.message.reply_text(text, reply_markup=keyboard, parse_mode="HTML")
+                    await update.message.reply_text(text, reply_markup=keyboards().action_markup, parse_mode="HTML")
                     return
                 else:
                     await update.message.reply_text(text)
 
             # Переход в состояние выбора темы
             text = render_template("select_topic.txt")
-            keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton(cat, callback_data=f"topic:{cat}")]
-                for cat in ticket_categories
-            ])
-            
-            context.user_data["state"] = UserState.WAITING_FOR_TOPIC
+            context.user_data.state = UserState.WAITING_FOR_TOPIC
             
-            await update.message.reply_text(text, reply_markup=keyboard, parse_mode="HTML")
+            await update.message.reply_text(text, reply_markup=keyboards().topic_markup, parse_mode="HTML")
         else:
-            context.user_data["state"] = UserState.IDLE
+            context.user_data.state = UserState.IDLE
 
     except Exception as e:
         logger.exception(f"Exception in handle_authorization for user {user.id}: {e}")
@@ -140,26 +154,35 @@ async def handle_authorization(update: Update, context: ContextTypes.DEFAULT_TYP
 @log_async_call
 async def handle_email_change_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     decision = update.message.text.strip()
-    pending_email = context.user_data.get("pending_email")
+    pending_email = context.user_data.pending_email
     user = update.effective_user
     username = user.first_name or user.username or "user"
     try:
-        if decision == yes_text:
+        if decision == keyboards().yes_text:
+            # Правила могли измениться, пока пользователь подтверждал смену, поэтому адрес сверяется заново
+            rule = allowlist.match(pending_email)
+            if rule == RULE_BAN:
+                context.user_data.pending_email = None
+                context.user_data.state = UserState.IDLE
+                logger.warning(f"User {user.id} attempted to change email to one banned by allowlist rule: {pending_email}")
+                await update.message.reply_text(render_template("auth_banned.txt", email=pending_email), reply_markup=ReplyKeyboardRemove())
+                return
+            # Адрес, разрешённый только правилом, ещё может отсутствовать в allowed_emails
+            get_email_row(pending_email, rule)
             success = db_update_user_email(user.id, pending_email)
             if success:
-                context.user_data["email"] = pending_email
-                context.user_data["state"] = UserState.IDLE
+                context.user_data.state = UserState.IDLE
                 text = render_template("auth_changed.txt", username=username, email=pending_email)
-                console.print(f"[yellow]User {user.id} requests email change to: {pending_email}[/yellow]")
+                logger.info(f"User {user.id} changed email to: {pending_email}")
                 await update.message.reply_text(text)
             else:
                 db_add_user(email=pending_email, telegram_id=user.id, username=user.username, full_name=user.full_name, authorized=False)
                 text = render_template("auth_not_registered.txt", email=pending_email)
-                context.user_data["state"] = UserState.WAITING_FOR_EMAIL
+                context.user_data.state = UserState.WAITING_FOR_EMAIL
                 await update.message.reply_text(text)
         else:
-            context.user_data["pending_email"] = None
-            context.user_data["state"] = UserState.IDLE
+            context.user_data.pending_email = None
+            context.user_data.state = UserState.IDLE
             text = render_template("auth_change_cancelled.txt", username=username)
             await update.message.reply_text(text, reply_markup=ReplyKeyboardRemove())
     except Exception as e:
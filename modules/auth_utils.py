@@ -1,19 +1,103 @@
-import os
-from dotenv import load_dotenv
-from modules.storage import db_is_admin
+import asyncio
+import threading
+from telegram.ext import Application
+from modules.settings import env_settings
+from modules.storage import db_add_admin, db_remove_admin, db_list_admins
+from modules.log_utils import log_async_call
+from modules.logging_config import logger
 
-load_dotenv()
-ROOT_ADMIN_ID = int(os.getenv("ROOT_ADMIN_ID", 0))
+class AdminRoles:
+    """
+    Роли админов из таблицы admins в памяти: telegram_id -> is_top_level.
+    Загружаются при старте и меняются вместе с записью в БД, поэтому проверка прав не ходит в БД;
+    воркеры (BOT_WORKERS > 1) подхватывают чужие изменения в admin_roles_refresh_loop.
+    """
 
-def is_admin(telegram_id: int) -> bool:
+    def __init__(self):
+        self._roles = None
+        # reload читает БД в отдельном потоке: снимок, прочитанный до grant/revoke, не должен их затереть
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def reload(self) -> bool:
+        """
+        Перечитывает таблицу admins. Выполняется вне цикла событий.
+
+        @return True, если набор ролей изменился
+        """
+        version = self._version
+        roles = {int(row["telegram_id"]): bool(row["is_top_level"]) for row in db_list_admins()}
+        with self._lock:
+            if version != self._version:
+                # Пока шло чтение, роли поменялись в этом процессе — снимок устарел, изменение уже в памяти
+                return False
+            changed = roles != self._roles
+            # Словарь подменяется целиком, читатели не видят его в промежуточном состоянии
+            self._roles = roles
+        if changed:
+            logger.info(f"Admin roles loaded: {len(roles)} admins")
+        return changed
+
+    def _current(self) -> dict:
+        if self._roles is None:
+            self.reload()
+        return self._roles
+
+    def is_admin(self, telegram_id: int) -> bool:
+        return telegram_id in self._current()
+
+    def is_top_level(self, telegram_id: int) -> bool:
+        return self._current().get(telegram_id, False)
+
+    def items(self) -> list[tuple]:
+        return sorted(self._current().items())
+
+    def grant(self, telegram_id: int, is_top_level: bool = False):
+        db_add_admin(telegram_id, is_top_level)
+        self._current()
+        with self._lock:
+            self._version += 1
+            self._roles = {**self._roles, telegram_id: is_top_level}
+
+    def revoke(self, telegram_id: int) -> bool:
+        removed = db_remove_admin(telegram_id)
+        self._current()
+        with self._lock:
+            self._version += 1
+            self._roles = {admin_id: top for admin_id, top in self._roles.items() if admin_id != telegram_id}
+        return removed
+
+admin_roles = AdminRoles()
+
+def _to_id(telegram_id):
     try:
-        telegram_id = int(telegram_id)
+        return int(telegram_id)
     except (ValueError, TypeError):
+        return None
+
+def is_admin(telegram_id: int) -> bool:
+    telegram_id = _to_id(telegram_id)
+    if telegram_id is None:
         return False
-    return telegram_id == ROOT_ADMIN_ID or db_is_admin(telegram_id)
+    return telegram_id == env_settings.root_admin_id or admin_roles.is_admin(telegram_id)
+
+def is_top_level_admin(telegram_id: int) -> bool:
+    """
+    Главный админ (ROOT_ADMIN_ID) или админ с is_top_level — может управлять списком админов.
+    """
+    telegram_id = _to_id(telegram_id)
+    if telegram_id is None:
+        return False
+    return telegram_id == env_settings.root_admin_id or admin_roles.is_top_level(telegram_id)
 
 def is_root_admin(telegram_id: int) -> bool:
     try:
-        return int(telegram_id) == ROOT_ADMIN_ID
+        return int(telegram_id) == env_settings.root_admin_id
     except (ValueError, TypeError):
-        return False
\ No newline at end of file
+        return False
+
+@log_async_call
+async def admin_roles_refresh_loop(app: Application):
+    while True:
+        await asyncio.sleep(env_settings.admin_roles_refresh_interval)
+        await asyncio.to_thread(admin_roles.reload)
@@ -1,16 +1,15 @@
-import yaml
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram import Update
 from telegram.ext import ContextTypes
-from rich.console import Console
 from modules.template_engine import render_template
 from modules.storage import db_get_user_by_telegram_id, db_get_email_by_id
 from modules.states import UserState
-from modules.config import telegram_start, message_limits
+from modules.config import settings
+from modules.settings import env_settings
+from modules.keyboards import keyboards
 from modules.log_utils import log_async_call
 from modules.logging_config import logger
-from modules.auth_utils import is_admin
+from modules.auth_utils import is_admin, is_top_level_admin
 
-console = Console()
 
 @log_async_call
 async def handle_start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -26,26 +25,22 @@ async def handle_start_command(update: Update, context: ContextTypes.DEFAULT_TYP
             text = render_template("welcome_user.txt", username=username, email=email)
             logger.info(f"User {user.id} is already authorized. Email: {email}")
 
-            if telegram_start.get("show_action_button_if_authorized", False):
-                context.user_data["state"] = UserState.WAITING_FOR_REQUEST_BUTTON
-                button_text = telegram_start.get("action_button_text", "Submit a request")
-                keyboard = InlineKeyboardMarkup([
-                    [InlineKeyboardButton(text=button_text, callback_data="submit_request")]
-                ])
+            if settings().telegram_start.get("show_action_button_if_authorized", False):
+                context.user_data.state = UserState.WAITING_FOR_REQUEST_BUTTON
 
                 await context.bot.send_message(
                     chat_id=update.effective_chat.id,
                     text=text,
                     parse_mode="HTML",
-                    reply_markup=keyboard
+                    reply_markup=keyboards().action_markup
                 )
             else:
-                context.user_data["state"] = UserState.IDLE
+                context.user_data.state = UserState.IDLE
                 await update.message.reply_text(text, parse_mode="HTML")
 
         else:
             # Не авторизован
-            context.user_data["state"] = UserState.WAITING_FOR_EMAIL
+            context.user_data.state = UserState.WAITING_FOR_EMAIL
             text = render_template("auth_start.txt", username=username)
             logger.info(f"User {user.id} is not authorized. Prompting for email.")
             await update.message.reply_text(text, parse_mode="HTML")
@@ -60,7 +55,11 @@ async def handle_help_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         user_id = update.effective_user.id
         admin = is_admin(user_id)
         template = "help_admin.txt" if admin else "help_user.txt"
-        text = render_template(template)
+        text = render_template(
+            template,
+            profiling=env_settings.profiling_enabled,
+            manage_admins=admin and is_top_level_admin(user_id),
+        )
         await context.bot.send_message(chat_id=update.effective_chat.id, text=text, parse_mode="HTML")
     
     except Exception as e:
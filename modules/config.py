@@ -1,14 +1,241 @@
+import os
+import re
 import yaml
+from modules.destinations import parse_destination
 
-with open("config/ui_config.yaml", "r", encoding="utf-8") as f:
-    _ui_config = yaml.safe_load(f)
+UI_CONFIG_PATH = "config/ui_config.yaml"
+AUTH_CONFIG_PATH = "config/auth.yaml"
 
-with open("config/auth.yaml", "r", encoding="utf-8") as f:
-    _auth = yaml.safe_load(f)
+SHEDDING_MODES = ("reject", "queue")
+_NUMBER = (int, float)
+_CATEGORY_KEYS = {"name", "priority", "sla_sec", "destinations"}
 
-telegram_menu = _ui_config.get("telegram_menu", [])
-telegram_start = _ui_config.get("telegram_start", {})
-authorization_ui = _ui_config.get("authorization", {})
-ticket_categories = _ui_config.get("ticket_categories", [])
-message_limits = _ui_config.get("message_limits", {})
-auth_config = _auth.get("auth", {})
\ No newline at end of file
+class ConfigError(ValueError):
+    """
+    Конфигурация не прошла проверку — при перезагрузке остаются прежние настройки.
+    """
+
+# Путь -> (допустимые типы, обязательность). Обязательное поле проверяется,
+# только если присутствует родительская секция.
+_UI_SCHEMA = {
+    "telegram_menu": (list, True),
+    "telegram_start": (dict, False),
+    "telegram_start.show_action_button_if_authorized": (bool, False),
+    "telegram_start.action_button_text": (str, False),
+    "authorization": (dict, False),
+    "authorization.confirm_change_buttons": (dict, False),
+    "authorization.confirm_change_buttons.yes": (str, False),
+    "authorization.confirm_change_buttons.no": (str, False),
+    "authorization.email_status_labels": (dict, False),
+    "ticket_categories": (list, True),
+    "message_limits": (dict, True),
+    "message_limits.max_submission_length": (int, True),
+    "message_limits.max_requests": (int, True),
+    "message_limits.interval_sec": (_NUMBER, True),
+    "message_limits.algorithm": (str, False),
+    "message_limits.topic": (dict, False),
+    "message_limits.topic.max_requests": (int, True),
+    "message_limits.topic.interval_sec": (_NUMBER, True),
+    "message_limits.global": (dict, False),
+    "message_limits.global.max_requests": (int, True),
+    "message_limits.global.interval_sec": (_NUMBER, True),
+    "message_limits.shedding": (dict, False),
+    "message_limits.shedding.mode": (str, False),
+    "message_limits.shedding.high_priority_reserve": (_NUMBER, False),
+    "message_limits.shedding.max_queue_delay_sec": (_NUMBER, False),
+}
+
+_AUTH_SCHEMA = {
+    "auth": (dict, True),
+    "auth.email_pattern": (str, True),
+    "auth.email_autocomplete": (str, True),
+    "auth.allow_incomplete_input": (bool, False),
+    "auth.send_welcome_before_topic": (bool, False),
+    "auth.send_topic_after_auth": (bool, False),
+    "auth.delay_after_auth_success": (_NUMBER, False),
+    "auth.preauth": (dict, False),
+    "auth.preauth.user_attempts": (int, False),
+    "auth.preauth.user_interval_sec": (_NUMBER, False),
+    "auth.preauth.domain_attempts": (int, False),
+    "auth.preauth.domain_interval_sec": (_NUMBER, False),
+    "auth.preauth.negative_cache_ttl_sec": (_NUMBER, False),
+    "auth.preauth.negative_cache_size": (int, False),
+    "auth.preauth.max_tracked_keys": (int, False),
+}
+
+_MISSING = object()
+
+class CategoryPolicy:
+    """
+    Приоритет, SLA и получатели категории обращений.
+
+    @param priority: Чем больше, тем раньше обращение отправляется при очереди на отправку (0 — обычное)
+    @param sla_sec: За сколько секунд обращение должно дойти до поддержки (None — без SLA)
+    @param destinations: Кортеж Destination (None — SUPPORT_CHAT_ID и SUPPORT_EMAIL)
+    """
+    __slots__ = ("priority", "sla_sec", "destinations")
+
+    def __init__(self, priority: int = 0, sla_sec: float = None, destinations: tuple = None):
+        self.priority = priority
+        self.sla_sec = sla_sec
+        self.destinations = destinations
+
+DEFAULT_POLICY = CategoryPolicy()
+
+class Settings:
+    """
+    Неизменяемый снимок конфигурации из config/*.yaml вместе с производными объектами.
+    """
+    __slots__ = (
+        "telegram_menu", "telegram_start", "authorization_ui", "ticket_categories",
+        "category_policies", "message_limits", "auth_config", "email_pattern",
+    )
+
+    def __init__(self, ui_config: dict, auth: dict):
+        self.telegram_menu = ui_config.get("telegram_menu", [])
+        self.telegram_start = ui_config.get("telegram_start") or {}
+        self.authorization_ui = ui_config.get("authorization") or {}
+        # Категория — строка или {name, priority, sla_sec, destinations}; клавиатурам нужны только названия
+        self.ticket_categories = []
+        self.category_policies = {}
+        for item in ui_config.get("ticket_categories", []):
+            if isinstance(item, str):
+                self.ticket_categories.append(item)
+                continue
+            self.ticket_categories.append(item["name"])
+            destinations = item.get("destinations")
+            self.category_policies[item["name"]] = CategoryPolicy(
+                item.get("priority") or 0,
+                item.get("sla_sec"),
+                tuple(parse_destination(destination) for destination in destinations) if destinations else None,
+            )
+        self.message_limits = ui_config.get("message_limits", {})
+        self.auth_config = auth.get("auth", {})
+        self.email_pattern = re.compile(self.auth_config["email_pattern"])
+
+def _lookup(data, path: str):
+    for key in path.split("."):
+        if not isinstance(data, dict) or key not in data:
+            return _MISSING
+        data = data[key]
+    return data
+
+def _check_schema(data, schema: dict, file_name: str):
+    if not isinstance(data, dict):
+        raise ConfigError(f"{file_name}: expected a mapping at top level")
+
+    for path, (kinds, required) in schema.items():
+        parent_path, _, _ = path.rpartition(".")
+        if parent_path and not isinstance(_lookup(data, parent_path), dict):
+            continue
+        value = _lookup(data, path)
+        if value is _MISSING or value is None:
+            if required:
+                raise ConfigError(f"{file_name}: '{path}' is required")
+            continue
+        # bool — подкласс int, но «true» вместо числа почти всегда ошибка
+        if not isinstance(value, kinds) or (isinstance(value, bool) and kinds is not bool):
+            raise ConfigError(f"{file_name}: '{path}' has invalid type {type(value).__name__}")
+        if isinstance(value, _NUMBER) and not isinstance(value, bool) and value < 0:
+            raise ConfigError(f"{file_name}: '{path}' must not be negative")
+
+def _validate(ui_config: dict, auth: dict):
+    _check_schema(ui_config, _UI_SCHEMA, UI_CONFIG_PATH)
+    _check_schema(auth, _AUTH_SCHEMA, AUTH_CONFIG_PATH)
+
+    for item in ui_config["telegram_menu"]:
+        if not isinstance(item, dict) or not item.get("command") or not item.get("description"):
+            raise ConfigError(f"{UI_CONFIG_PATH}: every telegram_menu item needs 'command' and 'description'")
+
+    categories = ui_config["ticket_categories"]
+    if not categories:
+        raise ConfigError(f"{UI_CONFIG_PATH}: ticket_categories must not be empty")
+    for index, item in enumerate(categories):
+        if isinstance(item, dict):
+            _validate_category(item, index)
+    categories = [item.get("name") if isinstance(item, dict) else item for item in categories]
+    if not all(isinstance(category, str) and category for category in categories):
+        raise ConfigError(f"{UI_CONFIG_PATH}: ticket_categories must be non-empty strings or mappings with 'name'")
+    if len(set(categories)) != len(categories):
+        raise ConfigError(f"{UI_CONFIG_PATH}: ticket_categories contain duplicates")
+
+    limits = ui_config["message_limits"]
+    for path in ("max_submission_length", "max_requests", "interval_sec",
+                 "topic.max_requests", "topic.interval_sec", "global.max_requests", "global.interval_sec"):
+        if _lookup(limits, path) == 0:
+            raise ConfigError(f"{UI_CONFIG_PATH}: 'message_limits.{path}' must be positive")
+    mode = _lookup(limits, "shedding.mode")
+    if mode is not _MISSING and mode not in SHEDDING_MODES:
+        raise ConfigError(f"{UI_CONFIG_PATH}: 'message_limits.shedding.mode' must be one of {SHEDDING_MODES}")
+
+    try:
+        re.compile(auth["auth"]["email_pattern"])
+    except re.error as e:
+        raise ConfigError(f"{AUTH_CONFIG_PATH}: invalid email_pattern: {e}") from e
+
+def _validate_category(item: dict, index: int):
+    path = f"ticket_categories[{index}]"
+    unknown = set(item) - _CATEGORY_KEYS
+    if unknown:
+        raise ConfigError(f"{UI_CONFIG_PATH}: '{path}' has unknown keys {sorted(unknown)}")
+    priority = item.get("priority")
+    if priority is not None and (not isinstance(priority, int) or isinstance(priority, bool) or priority < 0):
+        raise ConfigError(f"{UI_CONFIG_PATH}: '{path}.priority' must be a non-negative integer")
+    sla = item.get("sla_sec")
+    if sla is not None and (not isinstance(sla, _NUMBER) or isinstance(sla, bool) or sla <= 0):
+        raise ConfigError(f"{UI_CONFIG_PATH}: '{path}.sla_sec' must be a positive number")
+    destinations = item.get("destinations")
+    if destinations is None:
+        return
+    if not isinstance(destinations, list) or not destinations:
+        raise ConfigError(f"{UI_CONFIG_PATH}: '{path}.destinations' must be a non-empty list")
+    for number, destination in enumerate(destinations):
+        try:
+            parse_destination(destination)
+        except ValueError as e:
+            raise ConfigError(f"{UI_CONFIG_PATH}: '{path}.destinations[{number}]': {e}") from e
+
+def _read_yaml(path: str):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return yaml.safe_load(f)
+    except (OSError, yaml.YAMLError) as e:
+        raise ConfigError(f"{path}: {e}") from e
+
+def config_mtimes() -> tuple:
+    """
+    Время изменения файлов конфигурации — для отслеживания правок.
+    """
+    mtimes = []
+    for path in (UI_CONFIG_PATH, AUTH_CONFIG_PATH):
+        try:
+            mtimes.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            mtimes.append(None)
+    return tuple(mtimes)
+
+def load_settings() -> Settings:
+    """
+    Читает и проверяет конфигурацию. Не меняет текущие настройки.
+
+    @raise ConfigError: Если файл не читается или не соответствует схеме
+    """
+    ui_config = _read_yaml(UI_CONFIG_PATH)
+    auth = _read_yaml(AUTH_CONFIG_PATH)
+    _validate(ui_config, auth)
+    return Settings(ui_config, auth)
+
+def install_settings(new_settings: Settings):
+    """
+    Подменяет текущие настройки одной операцией присваивания.
+    """
+    global _settings
+    _settings = new_settings
+
+def settings() -> Settings:
+    return _settings
+
+def category_policy(topic: str) -> CategoryPolicy:
+    return _settings.category_policies.get(topic, DEFAULT_POLICY)
+
+_settings = load_settings()
@@ -0,0 +1,241 @@
+import re
+import time
+import asyncio
+import heapq
+import hashlib
+from collections import deque
+from telegram import Bot
+from telegram.error import TelegramError
+from modules.settings import env_settings
+from modules.template_engine import render_template
+from modules.logging_config import logger
+
+SHINGLE_SIZE = 3
+SKETCH_SIZE = 64
+# Для отпечатка достаточно начала текста — длинные обращения не замедляют стадию
+MAX_FINGERPRINT_CHARS = 1024
+# Пауза перед правкой сообщения в чате: всплеск похожих обращений даёт одну правку, а не десятки
+SUMMARY_EDIT_DELAY = 2.0
+
+_WORDS = re.compile(r"\w+")
+_NO_TEXT = "(no text)"
+
+def normalize_text(text: str) -> str:
+    """
+    Нижний регистр, только слова через один пробел: пунктуация, эмодзи и повторы пробелов не влияют на отпечаток.
+    """
+    return " ".join(_WORDS.findall(text.lower()))
+
+def shingle_hashes(text: str) -> set:
+    """
+    64-битные хэши символьных триграмм начала текста.
+    """
+    text = text[:MAX_FINGERPRINT_CHARS]
+    shingles = {text[i:i + SHINGLE_SIZE] for i in range(max(len(text) - SHINGLE_SIZE + 1, 1))}
+    return {
+        int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+        for shingle in shingles
+    }
+
+def simhash(hashes: set) -> int:
+    """
+    SimHash: у похожих текстов отпечатки различаются в немногих битах.
+    """
+    rows = [format(value, "064b") for value in hashes]
+    half = len(rows) / 2
+    # zip(*rows) транспонирует строки битов в столбцы на стороне C — без цикла по 64 битам на каждую триграмму
+    return int("".join("1" if column.count("1") > half else "0" for column in zip(*rows)), 2)
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+def minhash_sketch(hashes: set) -> frozenset:
+    """
+    Bottom-k MinHash: SKETCH_SIZE наименьших хэшей. У коротких текстов это все триграммы — сходство точное.
+    """
+    return frozenset(heapq.nsmallest(SKETCH_SIZE, hashes))
+
+def similarity(a: frozenset, b: frozenset) -> float:
+    """
+    Оценка коэффициента Жаккара двух текстов по их bottom-k скетчам.
+    """
+    union = heapq.nsmallest(SKETCH_SIZE, a | b)
+    if not union:
+        return 0.0
+    return sum(1 for value in union if value in a and value in b) / len(union)
+
+class Fingerprint:
+    __slots__ = ("simhash", "sketch")
+
+    def __init__(self, text: str):
+        hashes = shingle_hashes(text)
+        self.simhash = simhash(hashes)
+        self.sketch = minhash_sketch(hashes)
+
+    def matches(self, other: "Fingerprint") -> bool:
+        # Дешёвый SimHash отсекает непохожие тексты, MinHash подтверждает сходство
+        return (
+            hamming(self.simhash, other.simhash) <= env_settings.dedup_max_distance
+            and similarity(self.sketch, other.sketch) >= env_settings.dedup_min_similarity
+        )
+
+def file_ids(messages: list) -> frozenset:
+    """
+    file_unique_id вложений: один и тот же файл, пересланный разными пользователями, совпадает.
+    """
+    ids = set()
+    for message in messages:
+        if message.photo:
+            ids.add(message.photo[-1].file_unique_id)
+        for media in (message.document, message.video, message.voice, message.audio):
+            if media:
+                ids.add(media.file_unique_id)
+    return frozenset(ids)
+
+class Report:
+    """
+    Исходное обращение, к которому приклеиваются похожие.
+    """
+    __slots__ = (
+        "ticket_id", "fingerprint", "files", "created_at", "similar", "messages", "text", "edit_task",
+        "delivered", "pending",
+    )
+
+    def __init__(self, ticket_id: str, fingerprint, files: frozenset, created_at: float):
+        self.ticket_id = ticket_id
+        self.fingerprint = fingerprint    # None — текст слишком короткий для сравнения
+        self.files = files
+        self.created_at = created_at
+        self.similar = 0
+        self.messages = []                # сообщения с обращением в чатах поддержки, по мере отправки
+        self.text = ""
+        self.edit_task = None
+        self.delivered = False            # исходное обращение дошло хотя бы до одного чата поддержки
+        self.pending = []                 # похожие обращения, ждущие исхода его отправки
+
+class DuplicateIndex:
+    """
+    Недавние обращения по категориям в скользящем окне DEDUP_WINDOW.
+    В каждой категории не больше DEDUP_MAX_ENTRIES записей — память ограничена при любом потоке обращений.
+    """
+
+    def __init__(self):
+        self._topics = {}       # категория -> deque отчётов в порядке поступления
+        self._files = {}        # (категория, file_unique_id) -> отчёт
+        self._by_ticket = {}    # ticket_id -> отчёт
+
+    def __len__(self):
+        return len(self._by_ticket)
+
+    def _drop(self, topic: str, report: Report):
+        self._by_ticket.pop(report.ticket_id, None)
+        for file_id in report.files:
+            if self._files.get((topic, file_id)) is report:
+                del self._files[(topic, file_id)]
+
+    def _evict(self, topic: str, reports: deque, now: float):
+        while reports and (
+            now - reports[0].created_at > env_settings.dedup_window
+            or len(reports) > env_settings.dedup_max_entries
+        ):
+            self._drop(topic, reports.popleft())
+
+    def _find(self, topic: str, reports: deque, fingerprint, files: frozenset):
+        for file_id in files:
+            report = self._files.get((topic, file_id))
+            if report is not None:
+                return report
+        if fingerprint is None:
+            return None
+        # Окно ограничено, поэтому перебор — это не больше DEDUP_MAX_ENTRIES сравнений отпечатков
+        for report in reversed(reports):
+            if report.fingerprint is None:
+                continue
+            # Разные скриншоты при похожем тексте — скорее разные проблемы
+            if files and report.files:
+                continue
+            if fingerprint.matches(report.fingerprint):
+                return report
+        return None
+
+    def check(self, ticket):
+        """
+        Ищет похожее обращение той же категории. Если не нашлось — запоминает это.
+
+        @return Отчёт исходного обращения или None, если обращение новое
+        """
+        now = time.monotonic()
+        topic = ticket.topic
+        reports = self._topics.setdefault(topic, deque())
+        self._evict(topic, reports, now)
+
+        text = normalize_text("" if ticket.text == _NO_TEXT else ticket.text)
+        fingerprint = Fingerprint(text) if len(text) >= env_settings.dedup_min_length else None
+        files = file_ids(ticket.messages)
+        if fingerprint is None and not files:
+            return None
+
+        original = self._find(topic, reports, fingerprint, files)
+        if original is not None:
+            original.similar += 1
+            return original
+
+        report = Report(ticket.ticket_id, fingerprint, files, now)
+        reports.append(report)
+        self._by_ticket[ticket.ticket_id] = report
+        for file_id in files:
+            self._files[(topic, file_id)] = report
+        self._evict(topic, reports, now)
+        return None
+
+    def report(self, ticket_id: str):
+        return self._by_ticket.get(ticket_id)
+
+    def forget(self, topic: str, ticket_id: str):
+        """
+        Убирает обращение из окна: оно не дошло до чата поддержки, и похожие на него нужно отправлять как новые.
+        """
+        report = self._by_ticket.get(ticket_id)
+        if report is None:
+            return
+        self._topics[topic].remove(report)
+        self._drop(topic, report)
+
+duplicate_index = DuplicateIndex()
+# Ссылки на задачи правки, чтобы их не собрал сборщик мусора
+_edit_tasks = set()
+
+def dedup_enabled() -> bool:
+    return env_settings.dedup_window > 0
+
+def schedule_summary_update(bot: Bot, report: Report):
+    """
+    Обновляет счётчик «+N похожих» под обращением в чатах поддержки, куда оно уже отправлено.
+    """
+    if not report.messages or report.edit_task is not None:
+        return
+    report.edit_task = asyncio.get_running_loop().create_task(_update_summary(bot, report))
+    _edit_tasks.add(report.edit_task)
+    report.edit_task.add_done_callback(_edit_tasks.discard)
+
+async def _update_summary(bot: Bot, report: Report):
+    try:
+        while True:
+            await asyncio.sleep(SUMMARY_EDIT_DELAY)
+            shown, messages = report.similar, list(report.messages)
+            text = f"{report.text}\n\n{render_template('duplicate_reports.txt', count=shown)}"
+            results = await asyncio.gather(*(
+                bot.edit_message_text(chat_id=message.chat_id, message_id=message.message_id, text=text)
+                for message in messages
+            ), return_exceptions=True)
+            for result in results:
+                if isinstance(result, TelegramError):
+                    logger.error(f"Failed to update similar reports count of ticket {report.ticket_id}: {result}")
+                elif isinstance(result, BaseException):
+                    raise result
+            logger.info(f"Ticket {report.ticket_id} now has {shown} similar reports")
+            # Пока шла правка, могли прийти новые похожие или дойти отправка в ещё один чат
+            if report.similar == shown and len(report.messages) == len(messages):
+                return
+    finally:
+        report.edit_task = None
@@ -0,0 +1,79 @@
+from modules.settings import env_settings
+
+CHAT = "chat"
+EMAIL = "email"
+
+_KEYS = {"chat", "thread", "email", "timeout_sec"}
+
+class Destination:
+    """
+    Куда отправляется обращение: чат поддержки (или тема форума в нём) либо почтовый адрес.
+
+    @param timeout: Сколько секунд ждать отправки сюда (None — DELIVERY_TIMEOUT)
+    """
+    __slots__ = ("kind", "target", "thread_id", "timeout")
+
+    def __init__(self, kind: str, target, thread_id: int = None, timeout: float = None):
+        self.kind = kind
+        self.target = target
+        self.thread_id = thread_id
+        self.timeout = timeout
+
+    def __str__(self):
+        if self.kind == EMAIL:
+            return self.target
+        return f"chat {self.target}" if self.thread_id is None else f"chat {self.target} thread {self.thread_id}"
+
+def _is_int(value) -> bool:
+    # bool — подкласс int, но «true» вместо идентификатора почти всегда ошибка
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def parse_destination(item) -> Destination:
+    """
+    Разбирает получателя из ui_config.yaml: {chat: <id>, thread: <id темы>} или {email: <адрес>},
+    у обоих — необязательный timeout_sec.
+
+    @raise ValueError: Если описание не похоже ни на чат, ни на адрес
+    """
+    if not isinstance(item, dict):
+        raise ValueError("destination must be a mapping")
+    unknown = set(item) - _KEYS
+    if unknown:
+        raise ValueError(f"unknown keys {sorted(unknown)}")
+    if ("chat" in item) == ("email" in item):
+        raise ValueError("destination needs exactly one of 'chat' or 'email'")
+
+    timeout = item.get("timeout_sec")
+    if timeout is not None and (not isinstance(timeout, (int, float)) or isinstance(timeout, bool) or timeout <= 0):
+        raise ValueError("'timeout_sec' must be a positive number")
+
+    if "email" in item:
+        address = item["email"]
+        if not isinstance(address, str) or "@" not in address or "thread" in item:
+            raise ValueError("'email' must be an address without 'thread'")
+        return Destination(EMAIL, address.strip(), timeout=timeout)
+
+    chat_id, thread_id = item["chat"], item.get("thread")
+    if not _is_int(chat_id):
+        raise ValueError("'chat' must be a numeric chat id")
+    if thread_id is not None and (not _is_int(thread_id) or thread_id <= 0):
+        raise ValueError("'thread' must be a positive topic id")
+    return Destination(CHAT, chat_id, thread_id, timeout)
+
+def _default_destinations() -> tuple:
+    destinations = []
+    if env_settings.support_chat_id:
+        chat_id = env_settings.support_chat_id
+        # Числовой id как у получателей из конфигурации — по нему же ищутся ответы сотрудников
+        destinations.append(Destination(CHAT, int(chat_id) if chat_id.lstrip("-").isdigit() else chat_id))
+    if env_settings.support_email:
+        destinations.append(Destination(EMAIL, env_settings.support_email))
+    return tuple(destinations)
+
+_DEFAULT_DESTINATIONS = _default_destinations()
+
+def default_destinations() -> tuple:
+    """
+    Получатели категорий без своего списка destinations: SUPPORT_CHAT_ID и SUPPORT_EMAIL.
+    """
+    return _DEFAULT_DESTINATIONS
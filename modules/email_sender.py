@@ -1,22 +1,64 @@
-import os
-import logging
+import time
+import socket
 import smtplib
-from modules.logging_config import logger
+import threading
+from contextlib import nullcontext
 from email.message import EmailMessage
-from dotenv import load_dotenv
-from jinja2 import Environment, FileSystemLoader, select_autoescape
-from rich.console import Console
-from modules.template_engine import render_template
+from modules.settings import env_settings
+from modules.metrics import smtp_duration, smtp_failures
+from modules.tracing import start_span, end_span
+from modules.logging_config import logger
+
+class _SendDeadline:
+    """
+    Срок на весь SMTP-диалог. Таймаут сокета ограничивает каждое чтение и запись по отдельности,
+    а шагов у диалога много (приветствие, EHLO, AUTH, MAIL, RCPT, DATA). По истечении срока таймер
+    закрывает сокет: текущий шаг сразу завершается ошибкой, и поток освобождается к сроку.
+    """
 
-console = Console()
+    # Как часто проверять, не появился ли сокет, если срок истёк во время подключения
+    CONNECT_POLL_SEC = 0.05
 
-load_dotenv()
-EMAIL_SENDER = os.getenv("EMAIL_SENDER")
-EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
-SMTP_SERVER = os.getenv("SMTP_SERVER")
-SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
+    def __init__(self, server: smtplib.SMTP, timeout: float):
+        self.expired = False
+        self._server = server
+        self._timeout = timeout
+        self._timer = None
+        self._finished = False
 
-def send_email(subject: str, to_address: str, text_body: str = "", html_body: str = None, attachments: list = None):
+    def _start_timer(self, delay: float):
+        self._timer = threading.Timer(delay, self._abort)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _abort(self):
+        if self._finished:
+            return
+        self.expired = True
+        sock = self._server.sock
+        if sock is None:
+            # Подключение ещё идёт (его таймаут не больше срока) — сокет закрывается, как только появится,
+            # иначе чтение приветствия получило бы ещё один полный таймаут
+            self._start_timer(self.CONNECT_POLL_SEC)
+            return
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        self._start_timer(self._timeout)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._finished = True
+        self._timer.cancel()
+        if exc_type is not None and self.expired:
+            raise TimeoutError("SMTP send deadline exceeded") from exc
+        return False
+
+def send_email(subject: str, to_address: str, text_body: str = "", html_body: str = None, attachments: list = None,
+               timeout: float = None):
     """
     Sends an email via SMTP with optional HTML version.
 
@@ -24,12 +66,13 @@ def send_email(subject: str, to_address: str, text_body: str = "", html_body: st
     @param to_address: Recipient email
     @param text_body: Fallback text version
     @param html_body: Optional HTML version
-    @throws Exception on failure
+    @param timeout: Deadline for the whole send in seconds (system socket timeout if None)
+    @throws Exception on failure, TimeoutError when the deadline is exceeded
     """
     try:
         msg = EmailMessage()
         msg["Subject"] = subject
-        msg["From"] = EMAIL_SENDER
+        msg["From"] = env_settings.email_sender
         msg["To"] = to_address
         msg.set_content(text_body or " ")
 
@@ -45,18 +88,41 @@ def send_email(subject: str, to_address: str, text_body: str = "", html_body: st
                     filename=attachment["filename"]
                 )
 
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls()
-            server.login(EMAIL_SENDER, EMAIL_PASSWORD)
-            server.send_message(msg)
+        # Выполняется в to_thread: контекст трассы копируется в поток вместе с contextvars
+        span = start_span("send_email", "smtp")
+        error = None
+        started = time.perf_counter()
+        try:
+            smtp_args = {} if timeout is None else {"timeout": timeout}
+            server = smtplib.SMTP(**smtp_args)
+            # Соединение открывается внутри срока: он действует и на подключение, и на QUIT
+            with (nullcontext() if timeout is None else _SendDeadline(server, timeout)), server:
+                server.connect(env_settings.smtp_server, env_settings.smtp_port)
+                if env_settings.smtp_starttls:
+                    server.starttls()
+                server.login(env_settings.email_sender, env_settings.email_password)
+                server.send_message(msg)
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            if span is not None:
+                end_span(span, error)
+        smtp_duration.observe(time.perf_counter() - started)
 
         logger.info(f"Email sent to {to_address}")
 
     except Exception as e:
+        smtp_failures.inc(type(e).__name__)
         logger.error(f"Failed to send email to {to_address}: {e}")
         raise
         
 if __name__ == "__main__":
+    # Консольный режим: rich и шаблоны нужны только здесь
+    from rich.console import Console
+    from modules.template_engine import render_template
+
+    console = Console()
     console.rule("[bold green]Email Test Mode[/bold green]")
     try:
         to_address = input("Recipient email: ").strip()
@@ -0,0 +1,140 @@
+import operator
+from functools import reduce
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+from telegram import Update
+from telegram.ext import ContextTypes, filters
+from modules.states import UserState
+from modules.settings import env_settings
+from modules.auth import handle_authorization, handle_email_change_confirmation
+from modules.flow import handle_request_button, handle_topic_selection, handle_text_submission, handle_idle_state, handle_unknown_message
+from modules.keyboards import SUBMIT_REQUEST_DATA, is_topic_data
+from modules.template_engine import render_template
+from modules.logging_config import logger
+
+# Виды нажатий inline-кнопок
+CALLBACK_SUBMIT = "submit"
+CALLBACK_TOPIC = "topic"
+
+# Виды сообщений, которые принимают состояния
+TEXT_INPUT = filters.TEXT
+MEDIA_INPUT = filters.PHOTO | filters.Document.ALL | filters.VIDEO | filters.AUDIO | filters.VOICE
+ANY_INPUT = TEXT_INPUT | MEDIA_INPUT
+
+@dataclass(frozen=True)
+class StateSpec:
+    """
+    Описание одного состояния диалога.
+
+    @param on_message: обработчик сообщений, которые принимает состояние
+    @param accepts: какие сообщения принимает состояние; на остальные отвечает handle_unknown_message
+    @param callbacks: вид нажатой кнопки -> обработчик; остальные кнопки считаются устаревшими
+    @param transitions: состояния, в которые разрешён переход (кроме ENTRY_STATES)
+    @param timeout: через сколько секунд бездействия состояние сбрасывается в IDLE (None — не сбрасывается)
+    @param accepts_email: ввод email ведёт к авторизации — действует бюджет попыток preauth_guard
+    """
+    on_message: Callable
+    accepts: filters.BaseFilter
+    callbacks: dict = field(default_factory=dict)
+    transitions: frozenset = frozenset()
+    timeout: Optional[float] = None
+    accepts_email: bool = False
+
+# Состояния, в которые можно попасть из любого: /start, /add_email, сброс по таймауту
+ENTRY_STATES = frozenset({
+    UserState.IDLE,
+    UserState.WAITING_FOR_EMAIL,
+    UserState.WAITING_FOR_REQUEST_BUTTON,
+})
+
+STATES = {
+    UserState.IDLE: StateSpec(
+        on_message=handle_idle_state,
+        accepts=ANY_INPUT,
+        transitions=frozenset({UserState.CONFIRMING_EMAIL_CHANGE, UserState.WAITING_FOR_TOPIC}),
+        accepts_email=True,
+    ),
+    UserState.WAITING_FOR_EMAIL: StateSpec(
+        on_message=handle_authorization,
+        accepts=TEXT_INPUT,
+        transitions=frozenset({UserState.CONFIRMING_EMAIL_CHANGE, UserState.WAITING_FOR_TOPIC}),
+        accepts_email=True,
+    ),
+    UserState.CONFIRMING_EMAIL_CHANGE: StateSpec(
+        on_message=handle_email_change_confirmation,
+        accepts=TEXT_INPUT,
+        timeout=env_settings.session_flow_timeout,
+    ),
+    UserState.WAITING_FOR_REQUEST_BUTTON: StateSpec(
+        on_message=handle_request_button,
+        accepts=ANY_INPUT,
+        callbacks={CALLBACK_SUBMIT: handle_request_button},
+        transitions=frozenset({UserState.WAITING_FOR_TOPIC}),
+    ),
+    UserState.WAITING_FOR_TOPIC: StateSpec(
+        on_message=handle_topic_selection,
+        accepts=ANY_INPUT,
+        callbacks={CALLBACK_TOPIC: handle_topic_selection},
+        transitions=frozenset({UserState.WAITING_FOR_MESSAGE_TEXT}),
+        timeout=env_settings.session_flow_timeout,
+    ),
+    UserState.WAITING_FOR_MESSAGE_TEXT: StateSpec(
+        on_message=handle_text_submission,
+        accepts=ANY_INPUT,
+        timeout=env_settings.session_flow_timeout,
+    ),
+}
+
+# Сообщения, которые принимает хотя бы одно состояние. Всё прочее (стикеры, правки сообщений,
+# служебные апдейты) отсекается фильтрами PTB и не доходит ни до обработчиков, ни до БД
+MESSAGE_FILTER = (
+    reduce(operator.or_, {spec.accepts for spec in STATES.values()})
+    & filters.UpdateType.MESSAGE
+    & ~filters.COMMAND
+)
+# Апдейты, для которых нужна сессия: сообщения из таблицы и команды
+SESSION_FILTER = MESSAGE_FILTER | (filters.COMMAND & filters.UpdateType.MESSAGE)
+
+def callback_kind(data: str):
+    if data == SUBMIT_REQUEST_DATA:
+        return CALLBACK_SUBMIT
+    if data and is_topic_data(data):
+        return CALLBACK_TOPIC
+    return None
+
+class InvalidTransitionError(ValueError):
+    """
+    Переход между состояниями не разрешён таблицей STATES — ошибка в обработчике.
+    """
+
+def can_transition(old_state, new_state) -> bool:
+    if old_state is None or new_state == old_state or new_state in ENTRY_STATES:
+        return True
+    spec = STATES.get(old_state)
+    return spec is not None and new_state in spec.transitions
+
+def state_timeout(state):
+    spec = STATES.get(state)
+    return spec.timeout if spec else None
+
+def accepts_email(state) -> bool:
+    spec = STATES.get(state)
+    return spec is not None and spec.accepts_email
+
+async def dispatch_message(update: Update, context: ContextTypes.DEFAULT_TYPE, state: str):
+    spec = STATES.get(state)
+    if spec is None or not spec.accepts.check_update(update):
+        await handle_unknown_message(update, context)
+        return
+    await spec.on_message(update, context)
+
+async def dispatch_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, state: str):
+    query = update.callback_query
+    spec = STATES.get(state)
+    handler = spec.callbacks.get(callback_kind(query.data)) if spec else None
+    if handler is None:
+        # Кнопка из сообщения, относящегося к другому шагу диалога
+        logger.info(f"Inactive button {query.data!r} pressed by user {update.effective_user.id} in state {state}")
+        await query.message.reply_text(render_template("button_inactive.txt"))
+        return
+    await handler(update, context)
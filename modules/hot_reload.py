@@ -0,0 +1,77 @@
+import asyncio
+from telegram import BotCommand
+from telegram.ext import Application
+from modules.settings import env_settings
+from modules.config import ConfigError, Settings, load_settings, install_settings, settings, config_mtimes
+from modules.keyboards import Keyboards, install_keyboards
+from modules.template_engine import prepare_templates, install_templates, templates_mtime
+from modules.rate_limiter import rate_limiter
+from modules.preauth_guard import preauth_guard
+from modules.reply_relay import update_support_chats
+from modules.log_utils import log_async_call
+from modules.logging_config import logger
+
+# Создаётся в работающем цикле: в Python 3.9 Lock, созданный при импорте, привязан к циклу по умолчанию,
+# а воркеры работают в цикле asyncio.run()
+_reload_lock = None
+
+@log_async_call
+async def setup_bot_commands(bot):
+    await bot.set_my_commands([
+        BotCommand(cmd["command"], cmd["description"]) for cmd in settings().telegram_menu
+    ])
+
+def _prepare(new_settings: Settings) -> tuple:
+    # Всё тяжёлое (YAML, регулярные выражения, компиляция шаблонов) — вне цикла событий
+    return Keyboards(new_settings), prepare_templates()
+
+async def reload_config(bot=None) -> Settings:
+    """
+    Перечитывает конфигурацию и шаблоны, пересобирает производные объекты и подменяет их.
+    При ошибке проверки текущие настройки не меняются.
+
+    @param bot: Если передан и изменилось меню команд — обновляет его в Telegram
+    @raise ConfigError: Если новая конфигурация не прошла проверку
+    """
+    global _reload_lock
+    if _reload_lock is None:
+        _reload_lock = asyncio.Lock()
+    async with _reload_lock:
+        new_settings = await asyncio.to_thread(load_settings)
+        new_keyboards, prepared_templates = await asyncio.to_thread(_prepare, new_settings)
+
+        old_settings = settings()
+        install_settings(new_settings)
+        install_keyboards(new_keyboards)
+        install_templates(prepared_templates)
+        rate_limiter.configure(new_settings.message_limits)
+        preauth_guard.configure(new_settings.auth_config.get("preauth") or {})
+        update_support_chats(new_settings)
+        logger.info("Configuration reloaded")
+
+        if bot is not None and new_settings.telegram_menu != old_settings.telegram_menu:
+            await setup_bot_commands(bot)
+        return new_settings
+
+def _watched_mtimes() -> tuple:
+    return config_mtimes(), templates_mtime()
+
+@log_async_call
+async def config_watch_loop(app: Application):
+    """
+    Опрашивает время изменения файлов конфигурации и шаблонов и перезагружает их при правке.
+    """
+    last_seen = await asyncio.to_thread(_watched_mtimes)
+    while True:
+        await asyncio.sleep(env_settings.config_watch_interval)
+        current = await asyncio.to_thread(_watched_mtimes)
+        if current == last_seen:
+            continue
+        last_seen = current
+
+        try:
+            await reload_config(app.bot)
+        except ConfigError as e:
+            logger.error(f"Config reload rejected, keeping previous settings: {e}")
+        except Exception as e:
+            logger.exception(f"Config reload failed: {e}")
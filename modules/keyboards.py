@@ -0,0 +1,62 @@
+import hashlib
+from telegram import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup
+from modules.config import Settings, settings
+from modules.logging_config import logger
+
+SUBMIT_REQUEST_DATA = "submit_request"
+TOPIC_PREFIX = "t:"
+LEGACY_TOPIC_PREFIX = "topic:"  # формат кнопок до версионирования
+
+class Keyboards:
+    """
+    Неизменяемый набор готовых клавиатур для одной версии конфигурации.
+    """
+    __slots__ = ("version", "topics", "topic_by_data", "topic_markup", "action_markup", "confirm_markup", "yes_text", "no_text")
+
+    def __init__(self, current: Settings):
+        self.topics = tuple(current.ticket_categories)
+        # Версия меняется вместе со списком категорий — старые кнопки распознаются как устаревшие
+        self.version = hashlib.sha1("\n".join(self.topics).encode("utf-8")).hexdigest()[:6]
+
+        # callback_data вида "t:<версия>:<индекс>" — несколько байт вместо текста категории
+        self.topic_by_data = {
+            f"{TOPIC_PREFIX}{self.version}:{index}": topic
+            for index, topic in enumerate(self.topics)
+        }
+        self.topic_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton(topic, callback_data=data)]
+            for data, topic in self.topic_by_data.items()
+        ])
+
+        button_text = current.telegram_start.get("action_button_text", "Submit a request")
+        self.action_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton(text=button_text, callback_data=SUBMIT_REQUEST_DATA)]
+        ])
+
+        confirm_buttons = current.authorization_ui.get("confirm_change_buttons", {})
+        # Без кавычек YAML читает ключи yes/no как True/False
+        self.yes_text = confirm_buttons.get("yes", confirm_buttons.get(True, "Yes"))
+        self.no_text = confirm_buttons.get("no", confirm_buttons.get(False, "No"))
+        self.confirm_markup = ReplyKeyboardMarkup([[self.yes_text, self.no_text]], resize_keyboard=True)
+
+_keyboards = Keyboards(settings())
+
+def keyboards() -> Keyboards:
+    return _keyboards
+
+def install_keyboards(new_keyboards: Keyboards):
+    """
+    Подменяет набор клавиатур одной операцией присваивания.
+    """
+    global _keyboards
+    _keyboards = new_keyboards
+    logger.info(f"Keyboards rebuilt, topic keyboard version {new_keyboards.version}")
+
+def is_topic_data(data: str) -> bool:
+    return data.startswith(TOPIC_PREFIX) or data.startswith(LEGACY_TOPIC_PREFIX)
+
+def resolve_topic(data: str):
+    """
+    @return Категория или None, если кнопка устарела или не относится к выбору темы
+    """
+    return _keyboards.topic_by_data.get(data)
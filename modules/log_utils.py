@@ -1,61 +1,96 @@
-import logging
 import functools
-from rich.console import Console
+from logging import DEBUG
+from time import perf_counter
 from telegram.error import TelegramError
 from modules.logging_config import logger
+from modules.metrics import handler_duration, handler_errors, db_query_duration, db_errors
+from modules.tracing import start_span, end_span
 import sqlite3
 
-console = Console()
-
-
 def log_async_call(func):
+    name = func.__name__
+    # Уровень задаётся один раз при запуске (LOG_LEVEL) — проверяем его при декорировании,
+    # а не на каждом вызове; без DEBUG обёртка не формирует никаких строк
+    debug = logger.isEnabledFor(DEBUG)
+    latency = handler_duration.labels(name)
+
     @functools.wraps(func)
     async def wrapper(*args, **kwargs):
-        logger.debug(f"{func.__name__} called")
+        if debug:
+            logger.debug("%s called", name)
+        span = start_span(name, "handler")
+        error = None
+        started = perf_counter()
         try:
             result = await func(*args, **kwargs)
-            logger.debug(f"{func.__name__} completed successfully")
+            if debug:
+                logger.debug("%s completed successfully", name)
             return result
 
         except TelegramError as te:
-            logger.error(f"Telegram API error in {func.__name__}: {te}")
-            console.print(f"[red]Telegram API error in {func.__name__}: {te}[/red]")
+            logger.error("Telegram API error in %s: %s", name, te)
+            error = type(te).__name__
+            handler_errors.inc(name, error)
             raise
 
         except sqlite3.DatabaseError as db_err:
-            logger.error(f"Database error in {func.__name__}: {db_err}")
-            console.print(f"[red]Database error in {func.__name__}: {db_err}[/red]")
+            logger.error("Database error in %s: %s", name, db_err)
+            error = type(db_err).__name__
+            handler_errors.inc(name, error)
             raise
 
         except Exception as e:
-            logger.exception(f"Unhandled exception in {func.__name__}: {e}")
-            console.print(f"[red]Unexpected error in {func.__name__}: {e}[/red]")
+            logger.exception("Unhandled exception in %s: %s", name, e)
+            error = type(e).__name__
+            handler_errors.inc(name, error)
             raise
 
+        finally:
+            latency.observe(perf_counter() - started)
+            if span is not None:
+                end_span(span, error)
+
     return wrapper
 
 def log_sync_call(func):
+    name = func.__name__
+    debug = logger.isEnabledFor(DEBUG)
+    # Время запросов к БД считается (и попадает в трассу) по каждой функции modules/storage.py
+    latency = db_query_duration.labels(name) if func.__module__ == "modules.storage" else None
+
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        logger.debug(f"{func.__name__} called")
+        if debug:
+            logger.debug("%s called", name)
+        span = start_span(name, "db") if latency is not None else None
+        error = None
+        started = perf_counter()
         try:
             result = func(*args, **kwargs)
-            logger.debug(f"{func.__name__} completed successfully")
+            if debug:
+                logger.debug("%s completed successfully", name)
             return result
 
         except TelegramError as te:
-            logger.error(f"Telegram API error in {func.__name__}: {te}")
-            console.print(f"[red]Telegram API error in {func.__name__}: {te}[/red]")
+            logger.error("Telegram API error in %s: %s", name, te)
             raise
 
         except sqlite3.DatabaseError as db_err:
-            logger.error(f"Database error in {func.__name__}: {db_err}")
-            console.print(f"[red]Database error in {func.__name__}: {db_err}[/red]")
+            logger.error("Database error in %s: %s", name, db_err)
+            error = type(db_err).__name__
+            if latency is not None:
+                db_errors.inc(name, error)
             raise
 
         except Exception as e:
-            logger.exception(f"Unhandled exception in {func.__name__}: {e}")
-            console.print(f"[red]Unexpected error in {func.__name__}: {e}[/red]")
+            logger.exception("Unhandled exception in %s: %s", name, e)
+            error = type(e).__name__
             raise
 
-    return wrapper
\ No newline at end of file
+        finally:
+            if latency is not None:
+                latency.observe(perf_counter() - started)
+            if span is not None:
+                end_span(span, error)
+
+    return wrapper
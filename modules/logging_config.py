@@ -1,38 +1,165 @@
-from dotenv import load_dotenv
+import os
+import gzip
+import queue
+import atexit
+import shutil
 import logging
 import colorlog
-import os
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+from modules.settings import env_settings
+from modules.tracing import TRACE_LOGGER_NAME, correlation_id, tracing_enabled
+from modules.update_recorder import RECORD_LOGGER_NAME, recording_enabled
+
+# Процесс-воркер (BOT_WORKERS > 1) не пишет в файл сам, а пересылает записи супервизору
+LOG_FORWARDED_ENV = "TG_SUPPORT_BOT_LOG_FORWARDED"
+
+level = env_settings.log_level
+
+def _gzip_namer(name: str) -> str:
+    return name + ".gz"
+
+def _gzip_rotator(source: str, dest: str):
+    # Выполняется в потоке QueueListener, а не в цикле событий
+    with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+def _add_correlation_id(record: logging.LogRecord) -> bool:
+    # Выполняется в потоке, который пишет запись, — там, где виден contextvar апдейта
+    record.trace_id = correlation_id.get()
+    return True
+
+def _not_trace(record: logging.LogRecord) -> bool:
+    # Трассы и записанные апдейты идут только в свои файлы
+    if not hasattr(record, "trace_id"):
+        record.trace_id = "-"
+    return not record.name.startswith((TRACE_LOGGER_NAME, RECORD_LOGGER_NAME))
+
+def _only_trace(record: logging.LogRecord) -> bool:
+    return record.name.startswith(TRACE_LOGGER_NAME)
+
+def _only_updates(record: logging.LogRecord) -> bool:
+    return record.name.startswith(RECORD_LOGGER_NAME)
 
-os.makedirs("logs", exist_ok=True)
+class _GzipFileHandler(logging.FileHandler):
+    """
+    Дописывает в .gz-файл: каждое открытие добавляет новый gzip-член, а сброс после каждой
+    записи оставляет файл читаемым, даже если бот остановлен без закрытия файла.
+    """
+    def _open(self):
+        return gzip.open(self.baseFilename, "at", encoding=self.encoding)
 
-load_dotenv()
-level = os.getenv("LOG_LEVEL", "INFO").upper()
+def _create_rotating_handler(path: str) -> logging.Handler:
+    log_dir = os.path.dirname(path)
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+
+    if env_settings.log_rotation == "time":
+        handler = TimedRotatingFileHandler(
+            path,
+            when=env_settings.log_rotate_when,
+            backupCount=env_settings.log_backup_count,
+            encoding="utf-8",
+            delay=True
+        )
+    else:
+        handler = RotatingFileHandler(
+            path,
+            maxBytes=env_settings.log_max_bytes,
+            backupCount=env_settings.log_backup_count,
+            encoding="utf-8",
+            delay=True
+        )
+    if env_settings.log_compress:
+        handler.namer = _gzip_namer
+        handler.rotator = _gzip_rotator
+    return handler
+
+def _create_file_handler() -> logging.Handler:
+    handler = _create_rotating_handler(env_settings.log_file)
+    handler.addFilter(_not_trace)
+    handler.setFormatter(logging.Formatter(
+        "%(asctime)s [%(levelname)s] %(name)s [%(trace_id)s]: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S"
+    ))
+    return handler
+
+def _create_trace_handler() -> logging.Handler:
+    # Каждая запись — готовая JSON-строка трассы
+    handler = _create_rotating_handler(env_settings.trace_file)
+    handler.addFilter(_only_trace)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    return handler
+
+def _create_update_record_handler() -> logging.Handler:
+    path = env_settings.update_record_file
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    handler_class = _GzipFileHandler if path.endswith(".gz") else logging.FileHandler
+    handler = handler_class(path, encoding="utf-8", delay=True)
+    handler.addFilter(_only_updates)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    return handler
+
+def _create_console_handler() -> logging.Handler:
+    handler = colorlog.StreamHandler()
+    handler.addFilter(_not_trace)
+    handler.setFormatter(colorlog.ColoredFormatter(
+        "%(log_color)s[%(levelname)s]%(reset)s %(message)s",
+        log_colors={
+            'DEBUG':    'cyan',
+            'INFO':     'green',
+            'WARNING':  'yellow',
+            'ERROR':    'red',
+            'CRITICAL': 'bold_red',
+        }
+    ))
+    return handler
 
 # Создаем логгер
 logger = logging.getLogger("tg_support_bot")
 logger.setLevel(getattr(logging, level, logging.INFO))
 
-# Обработчик логов в файл
-file_handler = logging.FileHandler("logs/bot.log", encoding="utf-8")
-file_formatter = logging.Formatter(
-    "%(asctime)s [%(levelname)s] %(name)s: %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S"
-)
-file_handler.setFormatter(file_formatter)
-logger.addHandler(file_handler)
-
-# Обработчик логов в цветную консоль
-console_handler = colorlog.StreamHandler()
-console_formatter = colorlog.ColoredFormatter(
-    "%(log_color)s[%(levelname)s]%(reset)s %(message)s",
-    log_colors={
-        'DEBUG':    'cyan',
-        'INFO':     'green',
-        'WARNING':  'yellow',
-        'ERROR':    'red',
-        'CRITICAL': 'bold_red',
-    }
-)
-console_handler.setFormatter(console_formatter)
-logger.addHandler(console_handler)
-logger.debug(f"Logging initialized at {level} level")
\ No newline at end of file
+# Вызывающий код только кладёт запись в очередь; форматирование вывода,
+# запись в файл, ротация и сжатие выполняются в фоновом потоке QueueListener
+_log_queue = queue.SimpleQueue()
+_queue_handler = QueueHandler(_log_queue)
+_queue_handler.addFilter(_add_correlation_id)
+logger.addHandler(_queue_handler)
+
+_handlers = ()
+_listener = None
+
+# В воркере обработчиков нет: записи копятся в очереди, пока он не вызовет forward_logs_to()
+if not os.environ.get(LOG_FORWARDED_ENV):
+    _handlers = (_create_file_handler(), _create_console_handler())
+    if tracing_enabled():
+        _handlers += (_create_trace_handler(),)
+    if recording_enabled():
+        _handlers += (_create_update_record_handler(),)
+    _listener = QueueListener(_log_queue, *_handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+def start_worker_log_listener(worker_queue) -> QueueListener:
+    """
+    Супервизор: принимает записи воркеров из multiprocessing-очереди и пишет их
+    теми же обработчиками, поэтому файл лога ротирует только один процесс.
+    """
+    listener = QueueListener(worker_queue, *_handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+def forward_logs_to(worker_queue):
+    """
+    Воркер: отправляет записи супервизору, включая накопленные до этого вызова.
+    """
+    global _queue_handler
+    logger.removeHandler(_queue_handler)
+    _queue_handler = QueueHandler(worker_queue)
+    _queue_handler.addFilter(_add_correlation_id)
+    logger.addHandler(_queue_handler)
+    while not _log_queue.empty():
+        worker_queue.put(_log_queue.get())
+
+logger.debug("Logging initialized at %s level", level)
@@ -0,0 +1,165 @@
+import os
+import sys
+import time
+import asyncio
+import threading
+import traceback
+from telegram.ext import Application
+from modules.settings import env_settings
+from modules.metrics import Histogram, Counter
+from modules.log_utils import log_async_call
+from modules.logging_config import logger
+
+# Кадры из этих файлов относятся к коду бота; обёртки log_utils и сам монитор не в счёт
+_PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_SKIPPED_FILES = (os.path.abspath(__file__), os.path.join(_PROJECT_DIR, "modules", "log_utils.py"))
+_ASYNCIO_EVENTS = os.path.join("asyncio", "events.py")
+
+loop_lag = Histogram(
+    "tg_bot_event_loop_lag_seconds", "Delay between the scheduled and actual wake-up of the lag monitor",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+loop_blocked_seconds = Counter(
+    "tg_bot_event_loop_blocked_seconds_total", "Time the event loop was blocked, by handler and blocking function",
+    ("handler", "function")
+)
+loop_stalls = Counter(
+    "tg_bot_event_loop_stalls_total", "Event loop stalls above LOOP_LAG_THRESHOLD", ("handler", "function")
+)
+
+# (обработчик, функция) -> [число остановок, суммарное время, максимум]
+_blocked = {}
+_heartbeat = 0.0
+_pending_sample = None
+
+def _frame_name(frame) -> str:
+    return f"{frame.f_globals.get('__name__', '?')}.{frame.f_code.co_name}"
+
+def _attribute(frame) -> tuple:
+    """
+    Определяет по стеку потока цикла событий, кто его блокирует.
+
+    @return (обработчик, функция): первый кадр бота внутри текущего колбэка цикла
+            и самый глубокий кадр бота (обычно функция storage или email_sender)
+    """
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+
+    # Всё, что выше Handle._run, — сам цикл событий и код запуска
+    start = 0
+    for index, candidate in enumerate(frames):
+        if candidate.f_code.co_filename.endswith(_ASYNCIO_EVENTS) and candidate.f_code.co_name == "_run":
+            start = index + 1
+
+    own = [
+        candidate for candidate in frames[start:]
+        if candidate.f_code.co_filename.startswith(_PROJECT_DIR)
+        and candidate.f_code.co_filename not in _SKIPPED_FILES
+    ]
+    if not own:
+        innermost = frames[-1] if frames else None
+        return "<unknown>", _frame_name(innermost) if innermost else "<unknown>"
+    return own[0].f_code.co_name, _frame_name(own[-1])
+
+def _watchdog(loop_thread_id: int, interval: float, threshold: float, stop: threading.Event):
+    """
+    Поток-сторож: если цикл событий не обновил метку дольше порога,
+    снимает стек его потока. Длительность остановки записывает сам цикл, когда проснётся.
+    """
+    global _pending_sample
+    sampled_heartbeat = None
+    while not stop.wait(interval):
+        heartbeat = _heartbeat
+        if heartbeat == sampled_heartbeat or time.monotonic() - heartbeat < interval + threshold:
+            continue
+        frame = sys._current_frames().get(loop_thread_id)
+        if frame is None:
+            continue
+        _pending_sample = (_attribute(frame), "".join(traceback.format_stack(frame)))
+        sampled_heartbeat = heartbeat
+        del frame
+
+def _record_stall(lag: float):
+    global _pending_sample
+    sample, _pending_sample = _pending_sample, None
+    if sample is None:
+        # Остановка закончилась раньше, чем сторож успел снять стек
+        key, stack = ("<unknown>", "<unknown>"), ""
+    else:
+        key, stack = sample
+
+    stats = _blocked.get(key)
+    if stats is None:
+        stats = _blocked[key] = [0, 0.0, 0.0]
+    stats[0] += 1
+    stats[1] += lag
+    stats[2] = max(stats[2], lag)
+    loop_stalls.inc(*key)
+    loop_blocked_seconds.inc(*key, amount=lag)
+
+    logger.warning(f"Event loop blocked for {lag * 1000:.0f} ms in handler {key[0]} by {key[1]}\n{stack}".rstrip())
+
+def blocking_report(limit: int = 10) -> list:
+    """
+    Что блокировало цикл событий, от наибольшего суммарного времени к наименьшему.
+
+    @return Список (обработчик, функция, число остановок, суммарно секунд, максимум секунд)
+    """
+    ranked = sorted(_blocked.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+    return [(handler, function, count, total, worst) for (handler, function), (count, total, worst) in ranked]
+
+def _log_report():
+    report = blocking_report()
+    if not report:
+        return
+    lines = [
+        f"  {total:8.2f} s  {count:5d} stalls  max {worst * 1000:6.0f} ms  {handler} -> {function}"
+        for handler, function, count, total, worst in report
+    ]
+    logger.warning("Top event loop blockers:\n" + "\n".join(lines))
+
+@log_async_call
+async def loop_lag_monitor(app: Application):
+    """
+    Измеряет задержку пробуждения цикла событий. Если она выше LOOP_LAG_THRESHOLD,
+    остановка приписывается обработчику и функции из стека, снятого потоком-сторожем.
+    """
+    global _heartbeat, _pending_sample
+    threshold = env_settings.loop_lag_threshold
+    interval = max(threshold / 2, 0.01)
+    stop = threading.Event()
+    _heartbeat = time.monotonic()
+    threading.Thread(
+        target=_watchdog, args=(threading.get_ident(), interval, threshold, stop),
+        name="loop-lag-watchdog", daemon=True
+    ).start()
+
+    last_report = time.monotonic()
+    reported_stalls = 0
+    try:
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            now = _heartbeat = time.monotonic()
+
+            lag = max(now - started - interval, 0.0)
+            loop_lag.observe(lag)
+            if lag >= threshold:
+                _record_stall(lag)
+            else:
+                # Снимок на границе порога не должен достаться следующей остановке
+                _pending_sample = None
+
+            # Сводка — не чаще LOOP_LAG_REPORT_INTERVAL и только если были новые остановки
+            if now - last_report >= env_settings.loop_lag_report_interval:
+                last_report = now
+                stalls = sum(stats[0] for stats in _blocked.values())
+                if stalls != reported_stalls:
+                    reported_stalls = stalls
+                    _log_report()
+    finally:
+        stop.set()
+        _log_report()
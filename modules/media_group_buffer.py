@@ -1,6 +1,16 @@
 from collections import defaultdict
 import time
+from modules.metrics import CallbackGauge
 
 MEDIA_GROUP_TIMEOUT_SEC = 2.0
 pending_media_groups = defaultdict(list)
 media_group_timestamps = {}
+
+CallbackGauge(
+    "tg_bot_media_groups_pending", "Media groups waiting in the buffer",
+    lambda: len(pending_media_groups)
+)
+CallbackGauge(
+    "tg_bot_media_group_messages_buffered", "Messages held in the media group buffer",
+    lambda: sum(len(messages) for messages in list(pending_media_groups.values()))
+)
@@ -0,0 +1,202 @@
+import asyncio
+from bisect import bisect_left
+from modules.settings import env_settings
+from modules.logging_config import logger
+
+# Границы корзин гистограмм длительности, в секундах
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = []
+_port_offset = 0
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """
+    Монотонный счётчик с метками. inc() — одна операция со словарём.
+    """
+    __slots__ = ("name", "help", "labelnames", "_values")
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+class _HistogramSeries:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # последняя — +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Histogram:
+    """
+    Гистограмма с фиксированными корзинами. Серия для набора меток создаётся
+    один раз, дальше observe() — бинарный поиск и три сложения.
+    """
+    __slots__ = ("name", "help", "labelnames", "buckets", "_series")
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series = {}
+        _registry.append(self)
+
+    def labels(self, *labels) -> _HistogramSeries:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = _HistogramSeries(self.buckets)
+        return series
+
+    def observe(self, value: float, *labels):
+        self.labels(*labels).observe(value)
+
+    def collect(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, series in self._series.items():
+            cumulative = 0
+            bounds = self.buckets + (float("inf"),)
+            for bound, count in zip(bounds, series.counts):
+                cumulative += count
+                bucket_labels = _format_labels(self.labelnames, labels, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(series.sum)}")
+            lines.append(f"{self.name}_count{label_text} {series.count}")
+        return lines
+
+class CallbackGauge:
+    """
+    Значение вычисляется только в момент запроса /metrics.
+
+    @param callback: Возвращает число или словарь {кортеж меток: число}
+    """
+    __slots__ = ("name", "help", "labelnames", "callback")
+
+    def __init__(self, name: str, help_text: str, callback, labelnames: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.callback = callback
+        _registry.append(self)
+
+    def collect(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            values = self.callback()
+        except Exception as e:
+            logger.error(f"Metric {self.name} callback failed: {e}")
+            return lines
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+def render_metrics() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+# Метрики, общие для нескольких модулей
+handler_duration = Histogram(
+    "tg_bot_handler_duration_seconds", "Duration of async handlers and tasks wrapped by log_async_call", ("handler",)
+)
+handler_errors = Counter(
+    "tg_bot_handler_errors_total", "Exceptions raised by async handlers", ("handler", "error")
+)
+db_query_duration = Histogram(
+    "tg_bot_db_query_duration_seconds", "Duration of storage functions", ("function",)
+)
+db_errors = Counter(
+    "tg_bot_db_errors_total", "Exceptions raised by storage functions", ("function", "error")
+)
+updates_total = Counter(
+    "tg_bot_updates_total", "Incoming updates by the user's FSM state", ("state",)
+)
+smtp_duration = Histogram(
+    "tg_bot_smtp_send_duration_seconds", "Duration of SMTP sends"
+)
+smtp_failures = Counter(
+    "tg_bot_smtp_failures_total", "Failed SMTP sends", ("error",)
+)
+telegram_api_duration = Histogram(
+    "tg_bot_telegram_api_duration_seconds", "Telegram Bot API call latency", ("method",)
+)
+telegram_api_errors = Counter(
+    "tg_bot_telegram_api_errors_total", "Failed Telegram Bot API calls (HTTP status or exception)", ("method", "error")
+)
+
+def set_port_offset(offset: int):
+    """
+    Воркер с номером N отдаёт метрики на METRICS_PORT + N.
+    """
+    global _port_offset
+    _port_offset = offset
+
+async def _handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        # Заголовки запроса не нужны, но их надо дочитать
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+            pass
+
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", render_metrics().encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            status, body, content_type = "404 Not Found", b"Not Found\n", "text/plain"
+
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def serve_metrics():
+    """
+    HTTP-сервер /metrics в формате Prometheus. Запускается, только если задан METRICS_PORT.
+    """
+    port = env_settings.metrics_port + _port_offset
+    server = await asyncio.start_server(_handle_connection, env_settings.metrics_host, port)
+    logger.info(f"Metrics available at http://{env_settings.metrics_host}:{port}/metrics")
+    async with server:
+        await server.serve_forever()
@@ -0,0 +1,149 @@
+import asyncio
+from telegram.ext import BasePersistence, PersistenceInput
+from modules.settings import env_settings
+from modules.storage import db_get_session, db_save_sessions, db_delete_sessions
+from modules.logging_config import logger
+
+# Поля UserSession, которые переживают перезапуск бота
+SESSION_FIELDS = ("state", "selected_topic", "pending_email", "request_timestamp", "request_count")
+
+def session_row(session) -> tuple:
+    return tuple(getattr(session, field) for field in SESSION_FIELDS)
+
+class SQLiteSessionPersistence(BasePersistence):
+    """
+    Хранит FSM-состояние и счётчики лимитов пользователей в таблице user_sessions.
+
+    Сессия загружается лениво при первом апдейте пользователя, поэтому старт
+    не зависит от количества известных пользователей. В БД попадают только
+    изменившиеся сессии, одной транзакцией раз в update_interval секунд.
+    """
+
+    def __init__(self, update_interval: float = env_settings.session_flush_interval):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self._loaded = set()       # пользователи, чья сессия уже прочитана из БД
+        self._persisted = {}       # user_id -> последняя записанная строка
+        self._dirty = {}           # user_id -> строка, ожидающая записи (None — удалить)
+        self._flush_task = None
+        self._flush_lock = None
+
+    async def get_user_data(self):
+        # Ленивая загрузка: данные подтягиваются в refresh_user_data
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data) -> None:
+        if user_id in self._loaded:
+            return
+        self._loaded.add(user_id)
+
+        # Чтение из SQLite блокирующее — как и запись, выполняется в отдельном потоке
+        row = await asyncio.to_thread(db_get_session, user_id)
+        if not row:
+            return
+
+        self._persisted[user_id] = tuple(row[field] for field in SESSION_FIELDS)
+
+        # Состояние, уже выставленное в памяти (например, админ-командой для выгруженного пользователя),
+        # приоритетнее. Остальные поля, включая счётчики лимита, всё равно читаются из БД —
+        # иначе следующая запись затрёт их значениями свежей сессии
+        keep_state = user_data.state is not None
+        for field in SESSION_FIELDS:
+            if field == "state" and keep_state:
+                continue
+            if row[field] is not None:
+                setattr(user_data, field, row[field])
+        # Лимитер пересоздаётся из загруженных счётчиков при следующей проверке
+        user_data.rate_limiter = None
+        logger.debug(f"Session for user {user_id} loaded from DB")
+
+    async def update_user_data(self, user_id: int, data) -> None:
+        row = session_row(data)
+        if self._persisted.get(user_id) == row:
+            return
+        self._dirty[user_id] = row
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._loaded.discard(user_id)
+        self._persisted.pop(user_id, None)
+        self._dirty[user_id] = None
+        self._schedule_flush()
+
+    def forget(self, user_id: int):
+        """
+        Забывает выгруженную из памяти сессию, чтобы при следующем апдейте она была перечитана из БД.
+        """
+        self._loaded.discard(user_id)
+        self._persisted.pop(user_id, None)
+
+    def _schedule_flush(self):
+        # Application вызывает update_user_data для каждого пользователя подряд —
+        # задача запускается после всех вызовов и пишет их одной пачкой
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self) -> None:
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+
+            to_save = [(user_id,) + row for user_id, row in dirty.items() if row is not None]
+            to_delete = [user_id for user_id, row in dirty.items() if row is None]
+
+            try:
+                if to_save:
+                    await asyncio.to_thread(db_save_sessions, to_save)
+                if to_delete:
+                    await asyncio.to_thread(db_delete_sessions, to_delete)
+            except Exception as e:
+                # Возвращаем несохранённое обратно, не затирая более свежие изменения
+                for user_id, row in dirty.items():
+                    self._dirty.setdefault(user_id, row)
+                logger.error(f"Failed to flush {len(dirty)} sessions: {e}")
+                return
+
+            for user_id, row in dirty.items():
+                if row is not None:
+                    self._persisted[user_id] = row
+            logger.debug(f"Flushed sessions: {len(to_save)} saved, {len(to_delete)} deleted")
+
+    # Остальные виды данных бот не хранит
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str):
+        return {}
+
+    async def update_conversation(self, name, key, new_state) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data) -> None:
+        pass
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
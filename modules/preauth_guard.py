@@ -0,0 +1,113 @@
+import time
+from collections import OrderedDict
+from modules.config import settings
+from modules.rate_limiter import TokenBucket
+from modules.logging_config import logger
+
+EMAIL_UNKNOWN = "unknown"
+EMAIL_BANNED = "banned"
+
+class _BoundedBuckets:
+    """
+    Вёдра попыток по ключу с вытеснением самых давних (LRU), чтобы флуд с новых id не раздувал память.
+    """
+
+    def __init__(self, capacity: int, interval_sec: float, max_keys: int):
+        self.capacity = capacity
+        self.interval_sec = interval_sec
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    def has_limits(self, capacity: int, interval_sec: float, max_keys: int) -> bool:
+        return (self.capacity, self.interval_sec, self.max_keys) == (capacity, interval_sec, max_keys)
+
+    def bucket(self, key) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.capacity, self.interval_sec)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+class PreAuthGuard:
+    """
+    Дешёвая проверка попыток авторизации до обращения к SQLite:
+    бюджеты попыток на пользователя и на домен вводимого адреса, отрицательный кэш
+    неизвестных и заблокированных адресов.
+
+    Бюджет домена объединяет попытки разных аккаунтов: перебор адресов одной организации
+    с множества новых id упирается в него, даже если у каждого id попытки ещё есть.
+    """
+
+    def __init__(self, preauth: dict):
+        self._users = None
+        self._domains = None
+        self._negative = OrderedDict()   # email -> (статус, время истечения)
+        self._notified = OrderedDict()   # пользователи, уже предупреждённые о блокировке
+        self.configure(preauth)
+
+    def configure(self, preauth: dict):
+        """
+        Применяет секцию auth.preauth. Счётчики попыток сбрасываются, только если изменились их лимиты.
+        """
+        self.max_tracked_keys = int(preauth.get("max_tracked_keys", 50000))
+        self.negative_cache_ttl = float(preauth.get("negative_cache_ttl_sec", 300))
+        self.negative_cache_size = int(preauth.get("negative_cache_size", 10000))
+
+        user_limits = (int(preauth.get("user_attempts", 5)), float(preauth.get("user_interval_sec", 600)), self.max_tracked_keys)
+        if self._users is None or not self._users.has_limits(*user_limits):
+            self._users = _BoundedBuckets(*user_limits)
+
+        domain_limits = (int(preauth.get("domain_attempts", 200)), float(preauth.get("domain_interval_sec", 600)), self.max_tracked_keys)
+        if self._domains is None or not self._domains.has_limits(*domain_limits):
+            self._domains = _BoundedBuckets(*domain_limits)
+
+    def allow_attempt(self, telegram_id: int, email: str) -> bool:
+        now = time.time()
+        buckets = (self._users.bucket(telegram_id), self._domains.bucket(email.rpartition("@")[2].lower()))
+        # Попытка списывается со всех бюджетов, только если её пропускают все: отклонённая не тратит ничего
+        if any(bucket.wait_time(now) > 0 for bucket in buckets):
+            return False
+        for bucket in buckets:
+            bucket.acquire(now)
+        self._notified.pop(telegram_id, None)
+        return True
+
+    def should_notify(self, telegram_id: int) -> bool:
+        """
+        Предупреждаем о превышении один раз, остальные попытки отбрасываются молча.
+        """
+        if telegram_id in self._notified:
+            return False
+        self._notified[telegram_id] = True
+        if len(self._notified) > self.max_tracked_keys:
+            self._notified.popitem(last=False)
+        return True
+
+    def cached_status(self, email: str):
+        entry = self._negative.get(email)
+        if entry is None:
+            return None
+        status, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._negative[email]
+            return None
+        return status
+
+    def remember(self, email: str, status: str):
+        self._negative[email] = (status, time.monotonic() + self.negative_cache_ttl)
+        self._negative.move_to_end(email)
+        while len(self._negative) > self.negative_cache_size:
+            self._negative.popitem(last=False)
+
+    def clear(self):
+        # Правила списка разрешённых изменились — любой закэшированный статус мог устареть
+        self._negative.clear()
+
+    def invalidate(self, email: str):
+        if self._negative.pop(email, None):
+            logger.debug(f"Negative cache entry for {email} invalidated")
+
+preauth_guard = PreAuthGuard(settings().auth_config.get("preauth") or {})
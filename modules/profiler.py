@@ -0,0 +1,173 @@
+import os
+import sys
+import time
+import threading
+import tracemalloc
+from collections import Counter
+from types import ModuleType, FunctionType, MethodType, BuiltinFunctionType, CoroutineType
+from modules.settings import env_settings
+from modules.logging_config import logger
+
+# Кадры, в которых поток просто ждёт (select цикла событий, пул потоков, очереди, поток логов)
+_IDLE_FRAMES = frozenset({
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+    ("handlers.py", "dequeue"),
+    ("connection.py", "_recv"),
+})
+# Объекты, которые не относятся к размеру сессии или сообщения, а лишь доступны по ссылке
+_OPAQUE_TYPES = (type, ModuleType, FunctionType, MethodType, BuiltinFunctionType, CoroutineType, threading.Thread)
+
+_cpu_lock = threading.Lock()
+_cpu_stop = threading.Event()
+_baseline = None
+
+def _report_path(prefix: str) -> str:
+    # Отчёты лежат рядом с логом (по умолчанию logs/)
+    directory = os.path.dirname(env_settings.log_file) or "."
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"{prefix}-{time.strftime('%Y%m%d-%H%M%S')}.txt")
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def cpu_profile_running() -> bool:
+    return _cpu_lock.locked()
+
+def stop_cpu_profile():
+    _cpu_stop.set()
+
+def run_cpu_profile(seconds: float) -> tuple:
+    """
+    Сэмплирующий профиль всех потоков процесса: раз в PROFILING_SAMPLE_INTERVAL
+    снимает их стеки через sys._current_frames(). Выполняется в отдельном потоке
+    и не замедляет профилируемый код, кроме коротких захватов GIL.
+
+    @param seconds: Длительность; досрочно останавливается через stop_cpu_profile()
+    @return (путь к отчёту, число сэмплов)
+    @raise RuntimeError: Если профиль уже снимается
+    """
+    if not _cpu_lock.acquire(blocking=False):
+        raise RuntimeError("CPU profile is already running")
+    try:
+        _cpu_stop.clear()
+        own_id = threading.get_ident()
+        self_counts = Counter()
+        total_counts = Counter()
+        folded = Counter()
+        samples = 0
+        deadline = time.monotonic() + seconds
+
+        while time.monotonic() < deadline and not _cpu_stop.wait(env_settings.profiling_sample_interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in _IDLE_FRAMES:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                samples += 1
+                self_counts[stack[0]] += 1
+                for label in set(stack):
+                    total_counts[label] += 1
+                thread_name = thread_names.get(thread_id, str(thread_id))
+                folded[";".join([thread_name] + stack[::-1])] += 1
+
+        path = _report_path("profile")
+        with open(path, "w", encoding="utf-8") as report:
+            report.write(f"CPU profile: {samples} samples, interval {env_settings.profiling_sample_interval * 1000:.1f} ms\n")
+            for title, counts in (("self", self_counts), ("cumulative", total_counts)):
+                report.write(f"\nTop functions by {title} samples:\n")
+                for label, count in counts.most_common(30):
+                    report.write(f"  {count:7d}  {100 * count / max(samples, 1):5.1f}%  {label}\n")
+        # Формат для flamegraph.pl / speedscope
+        with open(path[:-len(".txt")] + ".folded", "w", encoding="utf-8") as report:
+            for stack, count in folded.most_common():
+                report.write(f"{stack} {count}\n")
+
+        logger.info(f"CPU profile written to {path} ({samples} samples)")
+        return path, samples
+    finally:
+        _cpu_lock.release()
+
+def take_memory_baseline():
+    """
+    Включает tracemalloc (если ещё не включён) и запоминает снимок для сравнения.
+    """
+    global _baseline
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(env_settings.profiling_trace_frames)
+    _baseline = tracemalloc.take_snapshot()
+    logger.info("tracemalloc baseline taken")
+
+def stop_memory_tracing():
+    global _baseline
+    _baseline = None
+    tracemalloc.stop()
+    logger.info("tracemalloc stopped")
+
+def deep_sizeof(objects, seen: set) -> int:
+    """
+    Суммарный размер объектов со всем, на что они ссылаются (dict, коллекции, __dict__, __slots__).
+    Объекты из seen не считаются повторно — так общие ссылки (бот, приложение) не попадают в размер.
+    """
+    size = 0
+    stack = list(objects)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _OPAQUE_TYPES):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif isinstance(obj, (str, bytes, bytearray, int, float)):
+            continue
+        else:
+            if hasattr(obj, "__dict__"):
+                stack.append(obj.__dict__)
+            for cls in type(obj).__mro__:
+                for slot in cls.__dict__.get("__slots__", ()):
+                    value = getattr(obj, slot, None)
+                    if value is not None:
+                        stack.append(value)
+    return size
+
+def write_memory_report(breakdown: dict) -> str:
+    """
+    Пишет отчёт о памяти: разбивку по структурам бота и, если снят базовый снимок,
+    прирост по строкам кода относительно него.
+
+    @param breakdown: Имя структуры -> (число элементов, байт)
+    @return Путь к отчёту
+    """
+    path = _report_path("memory")
+    with open(path, "w", encoding="utf-8") as report:
+        report.write("Bot data structures (deep size):\n")
+        for name, (count, size) in breakdown.items():
+            report.write(f"  {size / 1024:10.1f} KiB  {count:7d} items  {name}\n")
+
+        if _baseline is not None and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            report.write(f"\ntracemalloc: current {current / 1024:.1f} KiB, peak {peak / 1024:.1f} KiB\n")
+            report.write("\nTop allocations since baseline:\n")
+            for stat in snapshot.compare_to(_baseline, "lineno")[:30]:
+                report.write(f"  {stat}\n")
+        else:
+            report.write("\ntracemalloc baseline not taken, allocation diff skipped\n")
+
+    logger.info(f"Memory report written to {path}")
+    return path
@@ -0,0 +1,238 @@
+import time
+from collections import deque, namedtuple
+from modules.config import settings
+from modules.settings import env_settings
+from modules.logging_config import logger
+
+# allowed — можно отправлять; delay — через сколько секунд (режим queue);
+# scope — какой лимит сработал; wait — сколько ждать до следующей попытки
+RateDecision = namedtuple("RateDecision", "allowed delay scope wait")
+
+class TokenBucket:
+    """
+    Ведро на capacity запросов, пополняемое равномерно: capacity за interval_sec.
+
+    Хранится не число токенов, а «уровень» — сколько токенов сейчас израсходовано.
+    Пара (level, updated) сохраняется в сессии как request_count/request_timestamp.
+    """
+    __slots__ = ("capacity", "rate", "level", "updated")
+
+    def __init__(self, capacity: int, interval_sec: float, level: float = 0.0, updated: float = 0.0):
+        self.capacity = capacity
+        self.rate = capacity / interval_sec
+        self.level = level
+        self.updated = updated
+
+    def _current_level(self, now: float) -> float:
+        return max(0.0, self.level - (now - self.updated) * self.rate)
+
+    def wait_time(self, now: float, reserve: float = 0.0) -> float:
+        """
+        @param reserve: Доля ёмкости, недоступная этому запросу (резерв под приоритетные)
+        """
+        overflow = self._current_level(now) + 1 - self.capacity * (1 - reserve)
+        return overflow / self.rate if overflow > 0 else 0.0
+
+    def acquire(self, now: float):
+        self.level = self._current_level(now) + 1
+        self.updated = now
+
+    def release(self):
+        self.level = max(0.0, self.level - 1)
+
+    def has_limits(self, capacity: int, interval_sec: float) -> bool:
+        return self.capacity == capacity and self.rate == capacity / interval_sec
+
+    def snapshot(self) -> tuple:
+        return self.level, self.updated
+
+class SlidingWindowLog:
+    """
+    Точный лимит: не больше limit запросов за любые interval_sec секунд.
+    Время проверки — амортизированное O(1): каждая метка удаляется из лога один раз.
+    """
+    __slots__ = ("limit", "window", "log")
+
+    def __init__(self, limit: int, interval_sec: float, count: int = 0, last: float = 0.0):
+        self.limit = limit
+        self.window = interval_sec
+        # Из сессии восстанавливается только счётчик — считаем, что все запросы были последними
+        self.log = deque([last] * min(int(count), limit))
+
+    def _expire(self, now: float):
+        threshold = now - self.window
+        while self.log and self.log[0] <= threshold:
+            self.log.popleft()
+
+    def wait_time(self, now: float, reserve: float = 0.0) -> float:
+        self._expire(now)
+        allowed = int(self.limit * (1 - reserve))
+        if allowed <= 0:
+            return self.window
+        if len(self.log) < allowed:
+            return 0.0
+        return self.log[len(self.log) - allowed] + self.window - now
+
+    def acquire(self, now: float):
+        self.log.append(now)
+
+    def release(self):
+        if self.log:
+            self.log.pop()
+
+    def has_limits(self, capacity: int, interval_sec: float) -> bool:
+        return self.limit == capacity and self.window == interval_sec
+
+    def snapshot(self) -> tuple:
+        return len(self.log), (self.log[-1] if self.log else 0)
+
+ALGORITHMS = {
+    "token_bucket": TokenBucket,
+    "sliding_window": SlidingWindowLog,
+}
+
+class RateLimiter:
+    """
+    Лимиты обращений на пользователя, на категорию и на весь бот (секция message_limits).
+
+    Лимит пользователя хранится в его сессии и переживает перезапуск,
+    лимиты категорий и общий — в памяти процесса. При BOT_WORKERS > 1 у каждого воркера свои счётчики,
+    поэтому лимиты категорий и общий делятся между воркерами поровну.
+    """
+
+    def __init__(self, limits: dict):
+        self.limiter_class = None
+        self.topic_limit = None
+        self.global_limit = None
+        self._topics = {}
+        self._global = None
+        self.configure(limits)
+
+    def configure(self, limits: dict):
+        """
+        Применяет (новые) настройки. Счётчики лимитов, параметры которых не изменились, сохраняются.
+        """
+        old_class, old_topic_limit, old_global_limit = self.limiter_class, self.topic_limit, self.global_limit
+
+        algorithm = limits.get("algorithm", "token_bucket")
+        if algorithm not in ALGORITHMS:
+            logger.error(f"Unknown rate limit algorithm '{algorithm}', using token_bucket")
+            algorithm = "token_bucket"
+        self.limiter_class = ALGORITHMS[algorithm]
+
+        self.max_requests = int(limits.get("max_requests", 1))
+        self.interval_sec = float(limits.get("interval_sec", 60))
+        self.topic_limit = self._parse_limit(limits.get("topic"))
+        self.global_limit = self._parse_limit(limits.get("global"))
+
+        shedding = limits.get("shedding") or {}
+        self.shed_mode = shedding.get("mode", "reject")
+        self.high_priority_reserve = float(shedding.get("high_priority_reserve", 0))
+        self.max_queue_delay = float(shedding.get("max_queue_delay_sec", 60))
+
+        if self.limiter_class is not old_class or self.topic_limit != old_topic_limit:
+            self._topics = {}
+        if self.limiter_class is not old_class or self.global_limit != old_global_limit:
+            self._global = self.limiter_class(*self.global_limit) if self.global_limit else None
+
+    @staticmethod
+    def _parse_limit(section):
+        if not section:
+            return None
+        max_requests = int(section["max_requests"])
+        workers = max(env_settings.bot_workers, 1)
+        # Апдейты распределяются по воркерам по пользователю, так что поток обращений делится примерно поровну:
+        # доля лимита на воркер в сумме даёт настроенный лимит, а не N× его
+        per_worker = max(max_requests // workers, 1)
+        if workers > 1 and max_requests % workers:
+            logger.warning(
+                f"Shared rate limit of {max_requests} requests is not divisible by BOT_WORKERS={workers}, "
+                f"each worker allows {per_worker} (total {per_worker * workers})"
+            )
+        return per_worker, float(section["interval_sec"])
+
+    def _user_limiter(self, session):
+        limiter = session.rate_limiter
+        # После перезагрузки конфигурации лимитер сессии пересоздаётся из сохранённого снимка
+        if (
+            limiter is None
+            or type(limiter) is not self.limiter_class
+            or not limiter.has_limits(self.max_requests, self.interval_sec)
+        ):
+            session.rate_limiter = self.limiter_class(
+                self.max_requests, self.interval_sec,
+                session.request_count or 0, session.request_timestamp or 0
+            )
+        return session.rate_limiter
+
+    def _topic_limiter(self, topic: str):
+        if not self.topic_limit or topic is None:
+            return None
+        limiter = self._topics.get(topic)
+        if limiter is None:
+            limiter = self._topics[topic] = self.limiter_class(*self.topic_limit)
+        return limiter
+
+    def _sync_session(self, session):
+        session.request_count, session.request_timestamp = session.rate_limiter.snapshot()
+
+    def user_wait(self, session) -> float:
+        """
+        Сколько секунд пользователю ждать до следующего обращения (0 — можно сейчас).
+        """
+        return self._user_limiter(session).wait_time(time.time())
+
+    def acquire(self, session, topic: str = None, priority: int = 0) -> RateDecision:
+        """
+        Проверяет все лимиты и, если обращение разрешено, списывает его сразу со всех.
+
+        @param priority: Обращения с priority > 0 могут использовать резерв общего лимита
+        """
+        now = time.time()
+        user = self._user_limiter(session)
+
+        wait = user.wait_time(now)
+        if wait > 0:
+            return RateDecision(False, 0.0, "user", wait)
+
+        delay = 0.0
+        shared = [("topic", self._topic_limiter(topic)), ("global", self._global)]
+        for scope, limiter in shared:
+            if limiter is None:
+                continue
+            reserve = self.high_priority_reserve if scope == "global" and priority <= 0 else 0.0
+            wait = limiter.wait_time(now, reserve)
+            if wait <= 0:
+                continue
+            # При перегрузке обращение либо ставится в очередь, либо отклоняется
+            if self.shed_mode == "queue" and wait <= self.max_queue_delay:
+                delay = max(delay, wait)
+            else:
+                logger.warning(f"{scope} rate limit exceeded (topic: {topic}, priority: {priority})")
+                return RateDecision(False, 0.0, scope, wait)
+
+        user.acquire(now)
+        for _, limiter in shared:
+            if limiter is not None:
+                limiter.acquire(now)
+        self._sync_session(session)
+        return RateDecision(True, delay, None, 0.0)
+
+    def release(self, session, topic: str = None):
+        """
+        Возвращает списанное обращение, если его не удалось принять.
+        """
+        self._user_limiter(session).release()
+        for limiter in (self._topic_limiter(topic), self._global):
+            if limiter is not None:
+                limiter.release()
+        self._sync_session(session)
+
+def format_wait(wait_sec: float) -> str:
+    wait_sec = int(wait_sec + 0.999)
+    hours = wait_sec // 3600
+    minutes = (wait_sec % 3600) // 60
+    seconds = wait_sec % 60
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+rate_limiter = RateLimiter(settings().message_limits)
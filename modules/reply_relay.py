@@ -0,0 +1,139 @@
+from collections import OrderedDict
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import ContextTypes, filters
+from modules.settings import env_settings
+from modules.config import Settings, settings
+from modules.destinations import CHAT, default_destinations
+from modules.storage import db_add_ticket_messages, db_get_ticket_message, db_add_ticket_duplicate, db_get_ticket_duplicates
+from modules.template_engine import render_template
+from modules.log_utils import log_async_call
+from modules.logging_config import logger
+
+# Сколько последних медиагрупп сотрудников помнить, чтобы заголовок ответа ушёл один раз на альбом
+_ANNOUNCED_GROUPS_LIMIT = 256
+
+class TicketMessageIndex:
+    """
+    Сообщение обращения в чате поддержки -> (ticket_id, telegram_id, user_message_id).
+
+    Все записи хранятся в таблице ticket_messages (поиск по первичному ключу),
+    недавние — в LRU в памяти: сотрудники отвечают в основном на свежие обращения.
+    """
+
+    def __init__(self, max_size: int = env_settings.reply_index_cache_size):
+        self.max_size = max_size
+        self._cache = OrderedDict()
+
+    def _put(self, key: tuple, value: tuple):
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def remember(self, chat_id: int, message_ids: list, ticket_id: str, telegram_id: int, user_message_id: int):
+        value = (ticket_id, telegram_id, user_message_id)
+        db_add_ticket_messages([(chat_id, message_id, *value) for message_id in message_ids])
+        for message_id in message_ids:
+            self._put((chat_id, message_id), value)
+
+    def remember_duplicate(self, ticket_id: str, duplicate_id: str, telegram_id: int, user_message_id: int):
+        """
+        Привязывает автора похожего обращения к исходному: своих сообщений в чате поддержки у него нет.
+        """
+        db_add_ticket_duplicate(ticket_id, duplicate_id, telegram_id, user_message_id)
+
+    def duplicates(self, ticket_id: str) -> list:
+        """
+        @return (duplicate_id, telegram_id, user_message_id) схлопнутых обращений; ответы сотрудников редки,
+        поэтому список читается из БД без кэша
+        """
+        return db_get_ticket_duplicates(ticket_id)
+
+    def lookup(self, chat_id: int, message_id: int):
+        """
+        @return (ticket_id, telegram_id, user_message_id) или None, если сообщение не относится к обращению
+        """
+        key = (chat_id, message_id)
+        value = self._cache.get(key)
+        if value is not None:
+            self._cache.move_to_end(key)
+            return value
+        value = db_get_ticket_message(chat_id, message_id)
+        if value is not None:
+            self._put(key, value)
+        return value
+
+    def __len__(self):
+        return len(self._cache)
+
+ticket_messages = TicketMessageIndex()
+_announced_groups = OrderedDict()
+
+def support_chat_ids(current: Settings) -> frozenset:
+    destinations = list(default_destinations())
+    for policy in current.category_policies.values():
+        destinations.extend(policy.destinations or ())
+    return frozenset(
+        destination.target for destination in destinations
+        if destination.kind == CHAT and isinstance(destination.target, int)
+    )
+
+# Чаты поддержки: SUPPORT_CHAT_ID и получатели категорий. Список меняется при перезагрузке конфигурации
+_support_chats = filters.Chat(chat_id=support_chat_ids(settings()), allow_empty=False)
+
+def update_support_chats(current: Settings):
+    _support_chats.chat_ids = support_chat_ids(current)
+
+def relay_enabled() -> bool:
+    return env_settings.reply_relay
+
+def relay_filter() -> filters.BaseFilter:
+    """
+    Ответы (reply) в чатах поддержки. Регистрируется раньше route_message.
+    """
+    return _support_chats & filters.REPLY & filters.UpdateType.MESSAGE
+
+def _first_in_group(media_group_id: str) -> bool:
+    if media_group_id is None:
+        return True
+    if media_group_id in _announced_groups:
+        return False
+    _announced_groups[media_group_id] = True
+    while len(_announced_groups) > _ANNOUNCED_GROUPS_LIMIT:
+        _announced_groups.popitem(last=False)
+    return True
+
+@log_async_call
+async def handle_support_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    original = message.reply_to_message
+    # Обычная переписка сотрудников между собой не интересна — только ответы на сообщения бота
+    if original.from_user is None or original.from_user.id != context.bot.id:
+        return
+
+    target = ticket_messages.lookup(message.chat_id, original.message_id)
+    if target is None:
+        return
+    agent = message.from_user
+    # Ответ на исходное обращение получают и авторы похожих, схлопнутых в него
+    targets = [target] + ticket_messages.duplicates(target[0])
+    announce = _first_in_group(message.media_group_id)
+
+    for ticket_id, telegram_id, user_message_id in targets:
+        try:
+            if announce:
+                await context.bot.send_message(
+                    chat_id=telegram_id,
+                    text=render_template("support_reply.txt", ticket_id=ticket_id),
+                    reply_to_message_id=user_message_id,
+                    allow_sending_without_reply=True,
+                )
+            # copy_message переносит текст и любое вложение одним вызовом, без скачивания файла
+            await context.bot.copy_message(chat_id=telegram_id, from_chat_id=message.chat_id, message_id=message.message_id)
+        except TelegramError as e:
+            logger.error(f"Failed to relay reply to ticket {ticket_id} to user {telegram_id}: {e}")
+            await message.reply_text(render_template("support_reply_failed.txt", telegram_id=telegram_id, error=str(e)))
+            continue
+
+        logger.info(f"Agent {agent.id if agent else None} replied to ticket {ticket_id}, relayed to user {telegram_id}")
@@ -0,0 +1,158 @@
+import time
+import asyncio
+import telegram
+from telegram import Update
+from telegram.ext import Application, ContextTypes
+from modules.states import UserState
+from modules.fsm import can_transition, state_timeout, InvalidTransitionError
+from modules.settings import env_settings
+from modules.log_utils import log_async_call
+from modules.metrics import updates_total
+from modules.logging_config import logger
+
+class UserSession:
+    """
+    Компактная сессия пользователя (вместо dict в context.user_data).
+    """
+    __slots__ = (
+        "_state", "selected_topic", "pending_email", "request_timestamp", "request_count",
+        "rate_limiter", "last_seen",
+    )
+
+    def __init__(self):
+        self._state = None
+        self.selected_topic = None
+        self.pending_email = None
+        self.request_timestamp = 0
+        self.request_count = 0
+        self.rate_limiter = None    # состояние лимита пользователя, см. modules/rate_limiter.py
+        self.last_seen = time.monotonic()
+
+    def __deepcopy__(self, memo):
+        # Persistence читает только простые поля — поверхностной копии достаточно
+        copy = UserSession.__new__(UserSession)
+        for field in UserSession.__slots__:
+            setattr(copy, field, getattr(self, field))
+        return copy
+
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, new_state):
+        # Переходы сверяются с таблицей modules/fsm.py. Недопустимый переход — ошибка в обработчике:
+        # исключение прерывает его, иначе он ответил бы пользователю так, будто состояние сменилось
+        if not can_transition(self._state, new_state):
+            raise InvalidTransitionError(f"Invalid FSM transition {self._state} -> {new_state}")
+        self._state = new_state
+
+    def reset_flow(self):
+        self.state = UserState.IDLE
+        self.selected_topic = None
+        self.pending_email = None
+
+    def is_abandoned(self, now: float) -> bool:
+        timeout = state_timeout(self._state)
+        return timeout is not None and now - self.last_seen > timeout
+
+context_types = ContextTypes(user_data=UserSession)
+
+# Публичный Application.drop_user_data удаляет сессию и из БД, а при выгрузке она должна там остаться.
+# Поэтому сессия убирается из внутреннего словаря Application — он есть в PTB 20.x (закреплена в requirements.txt)
+_UNLOAD_SUPPORTED = telegram.__version_info__[0] == 20
+
+def unload_user_data(app: Application, user_id: int) -> bool:
+    """
+    Убирает сессию пользователя из памяти, не удаляя её из БД.
+
+    @return False, если в этой версии PTB выгрузка не поддерживается и сессия осталась в памяти
+    """
+    user_data = getattr(app, "_user_data", None)
+    if not _UNLOAD_SUPPORTED or not isinstance(user_data, dict):
+        return False
+    user_data.pop(user_id, None)
+    return True
+
+async def set_session_state(app: Application, user_id: int, state):
+    """
+    Меняет состояние сессии другого пользователя (например, из админ-команды).
+
+    Выгруженная сессия сначала читается из БД: иначе defaultdict создал бы пустую сессию,
+    и следующая запись затёрла бы сохранённые счётчики лимита и выбранную тему.
+    """
+    session = app.user_data[user_id]
+    if app.persistence:
+        await app.persistence.refresh_user_data(user_id, session)
+    session.state = state
+    app.mark_data_for_update_persistence(user_ids=user_id)
+
+async def touch_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Вызывается до основных обработчиков (group=-1) для команд, нажатий кнопок
+    и сообщений, которые принимает хотя бы одно состояние (fsm.SESSION_FILTER).
+    """
+    if not update.effective_user:
+        return
+
+    session = context.user_data
+    now = time.monotonic()
+    if session.is_abandoned(now):
+        logger.info(f"Session of user {update.effective_user.id} timed out in state {session.state}, reset to IDLE")
+        session.reset_flow()
+    session.last_seen = now
+    updates_total.inc(session.state or "NONE")
+
+@log_async_call
+async def session_eviction_loop(app: Application):
+    """
+    Периодически сбрасывает брошенные диалоги и выгружает неактивные сессии из памяти.
+    Выгруженная сессия остаётся в БД и лениво подгружается при следующем апдейте.
+    """
+    while True:
+        await asyncio.sleep(env_settings.session_eviction_interval)
+
+        now = time.monotonic()
+        sessions = app.user_data
+
+        abandoned = [user_id for user_id, session in sessions.items() if session.is_abandoned(now)]
+        for user_id in abandoned:
+            sessions[user_id].reset_flow()
+        if abandoned:
+            app.mark_data_for_update_persistence(user_ids=abandoned)
+            logger.info(f"Reset {len(abandoned)} abandoned sessions to IDLE")
+
+        idle = [user_id for user_id, session in sessions.items() if now - session.last_seen > env_settings.session_idle_ttl]
+
+        # LRU: если активных сессий всё равно больше лимита — выгружаем самые старые
+        overflow = len(sessions) - len(idle) - env_settings.session_max_resident
+        if overflow > 0:
+            idle_set = set(idle)
+            by_age = sorted(
+                (session.last_seen, user_id) for user_id, session in sessions.items()
+                if user_id not in idle_set
+            )
+            idle.extend(user_id for _, user_id in by_age[:overflow])
+
+        if not idle:
+            continue
+
+        # Сначала дописываем изменения в БД, затем освобождаем память
+        await app.update_persistence()
+        if app.persistence:
+            await app.persistence.flush()
+
+        evicted = 0
+        for user_id in idle:
+            session = sessions.get(user_id)
+            # Пользователь мог написать, пока шла запись
+            if session is None or session.last_seen > now:
+                continue
+            if not unload_user_data(app, user_id):
+                logger.warning(f"Session eviction is not supported with python-telegram-bot {telegram.__version__}")
+                break
+            if app.persistence:
+                app.persistence.forget(user_id)
+            evicted += 1
+
+        logger.debug(f"Evicted {evicted} idle sessions, {len(sessions)} resident")
@@ -0,0 +1,186 @@
+import os
+from dataclasses import dataclass
+from typing import Optional
+from dotenv import load_dotenv
+
+_TRUE_VALUES = ("1", "true", "yes", "on")
+
+def _str(name: str, default: Optional[str] = None) -> Optional[str]:
+    value = os.getenv(name)
+    return value if value not in (None, "") else default
+
+def _int(name: str, default: int) -> int:
+    value = _str(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer, got '{value}'") from None
+
+def _float(name: str, default: float) -> float:
+    value = _str(name)
+    if value is None:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a number, got '{value}'") from None
+
+def _bool(name: str, default: bool) -> bool:
+    value = _str(name)
+    if value is None:
+        return default
+    return value.lower() in _TRUE_VALUES
+
+@dataclass(frozen=True)
+class EnvSettings:
+    """
+    Параметры из окружения и .env. Читаются один раз при запуске процесса.
+    """
+    # Telegram
+    bot_token: Optional[str]
+    bot_workers: int
+    root_admin_id: int
+    webhook_url: Optional[str]
+    webhook_listen: str
+    webhook_port: int
+    webhook_path: str
+    telegram_api_url: Optional[str]
+
+    # Доставка обращений
+    support_email: Optional[str]
+    support_chat_id: Optional[str]
+    email_sender: Optional[str]
+    email_password: Optional[str]
+    smtp_server: Optional[str]
+    smtp_port: int
+    smtp_starttls: bool
+    pipeline_queue_size: int
+    pipeline_workers: int
+    pipeline_drain_timeout: float
+    pipeline_priority_aging: float
+    delivery_timeout: float
+    reply_relay: bool
+    reply_index_cache_size: int
+    dedup_window: float
+    dedup_max_distance: int
+    dedup_min_similarity: float
+    dedup_min_length: int
+    dedup_max_entries: int
+
+    # Хранилище и сессии
+    db_path: str
+    session_flush_interval: float
+    session_idle_ttl: float
+    session_flow_timeout: float
+    session_max_resident: int
+    session_eviction_interval: float
+
+    # Воркеры
+    worker_check_interval: float
+    worker_shutdown_timeout: float
+
+    # Шаблоны и конфигурация
+    template_cache_dir: str
+    template_auto_reload: bool
+    render_cache_size: int
+    config_watch_interval: float
+    allowlist_refresh_interval: float
+    admin_roles_refresh_interval: float
+
+    # Метрики
+    metrics_port: int
+    metrics_host: str
+    loop_lag_threshold: float
+    loop_lag_report_interval: float
+    profiling_enabled: bool
+    profiling_sample_interval: float
+    profiling_trace_frames: int
+    trace_sample_rate: float
+    trace_slow_ms: float
+    trace_file: str
+    update_record_file: Optional[str]
+    update_record_redact: bool
+
+    # Логирование
+    log_level: str
+    log_file: str
+    log_rotation: str
+    log_max_bytes: int
+    log_rotate_when: str
+    log_backup_count: int
+    log_compress: bool
+
+def load_env_settings() -> EnvSettings:
+    load_dotenv()
+    return EnvSettings(
+        bot_token=_str("BOT_TOKEN"),
+        bot_workers=_int("BOT_WORKERS", 1),
+        root_admin_id=_int("ROOT_ADMIN_ID", 0),
+        webhook_url=_str("WEBHOOK_URL"),
+        webhook_listen=_str("WEBHOOK_LISTEN", "0.0.0.0"),
+        webhook_port=_int("WEBHOOK_PORT", 8443),
+        webhook_path=_str("WEBHOOK_PATH", ""),
+        telegram_api_url=_str("TELEGRAM_API_URL"),
+
+        support_email=_str("SUPPORT_EMAIL"),
+        support_chat_id=_str("SUPPORT_CHAT_ID"),
+        email_sender=_str("EMAIL_SENDER"),
+        email_password=_str("EMAIL_PASSWORD"),
+        smtp_server=_str("SMTP_SERVER"),
+        smtp_port=_int("SMTP_PORT", 587),
+        smtp_starttls=_bool("SMTP_STARTTLS", True),
+        pipeline_queue_size=_int("PIPELINE_QUEUE_SIZE", 100),
+        pipeline_workers=_int("PIPELINE_WORKERS", 4),
+        pipeline_drain_timeout=_float("PIPELINE_DRAIN_TIMEOUT", 5.0),
+        pipeline_priority_aging=_float("PIPELINE_PRIORITY_AGING", 60),
+        delivery_timeout=_float("DELIVERY_TIMEOUT", 30),
+        reply_relay=_bool("REPLY_RELAY", True),
+        reply_index_cache_size=_int("REPLY_INDEX_CACHE_SIZE", 10000),
+        dedup_window=_float("DEDUP_WINDOW", 600),
+        dedup_max_distance=_int("DEDUP_MAX_DISTANCE", 12),
+        dedup_min_similarity=_float("DEDUP_MIN_SIMILARITY", 0.8),
+        dedup_min_length=_int("DEDUP_MIN_LENGTH", 20),
+        dedup_max_entries=_int("DEDUP_MAX_ENTRIES", 200),
+
+        db_path=_str("DB_PATH", "database/db.sqlite3"),
+        session_flush_interval=_float("SESSION_FLUSH_INTERVAL", 10),
+        session_idle_ttl=_float("SESSION_IDLE_TTL", 1800),
+        session_flow_timeout=_float("SESSION_FLOW_TIMEOUT", 900),
+        session_max_resident=_int("SESSION_MAX_RESIDENT", 10000),
+        session_eviction_interval=_float("SESSION_EVICTION_INTERVAL", 60),
+
+        worker_check_interval=_float("WORKER_CHECK_INTERVAL", 1.0),
+        worker_shutdown_timeout=_float("WORKER_SHUTDOWN_TIMEOUT", 10.0),
+
+        template_cache_dir=_str("TEMPLATE_CACHE_DIR", ".cache/jinja"),
+        template_auto_reload=_bool("TEMPLATE_AUTO_RELOAD", False),
+        render_cache_size=_int("RENDER_CACHE_SIZE", 1024),
+        config_watch_interval=_float("CONFIG_WATCH_INTERVAL", 5),
+        allowlist_refresh_interval=_float("ALLOWLIST_REFRESH_INTERVAL", 30),
+        admin_roles_refresh_interval=_float("ADMIN_ROLES_REFRESH_INTERVAL", 30),
+
+        metrics_port=_int("METRICS_PORT", 0),
+        metrics_host=_str("METRICS_HOST", "127.0.0.1"),
+        loop_lag_threshold=_float("LOOP_LAG_THRESHOLD", 0.1),
+        loop_lag_report_interval=_float("LOOP_LAG_REPORT_INTERVAL", 300),
+        profiling_enabled=_bool("PROFILING_ENABLED", False),
+        profiling_sample_interval=_float("PROFILING_SAMPLE_INTERVAL", 0.005),
+        profiling_trace_frames=_int("PROFILING_TRACE_FRAMES", 10),
+        trace_sample_rate=_float("TRACE_SAMPLE_RATE", 0),
+        trace_slow_ms=_float("TRACE_SLOW_MS", 0),
+        trace_file=_str("TRACE_FILE", "logs/trace.jsonl"),
+        update_record_file=_str("UPDATE_RECORD_FILE"),
+        update_record_redact=_bool("UPDATE_RECORD_REDACT", True),
+
+        log_level=_str("LOG_LEVEL", "INFO").upper(),
+        log_file=_str("LOG_FILE", "logs/bot.log"),
+        log_rotation=_str("LOG_ROTATION", "size").lower(),
+        log_max_bytes=_int("LOG_MAX_BYTES", 10 * 1024 * 1024),
+        log_rotate_when=_str("LOG_ROTATE_WHEN", "midnight"),
+        log_backup_count=_int("LOG_BACKUP_COUNT", 7),
+        log_compress=_bool("LOG_COMPRESS", True),
+    )
+
+env_settings = load_env_settings()
@@ -0,0 +1,215 @@
+import os
+import asyncio
+import multiprocessing
+from telegram import Bot, Update
+from telegram.ext import Updater
+from modules.settings import env_settings
+from modules.hot_reload import setup_bot_commands
+from modules.metrics import set_port_offset
+from modules.telegram_request import api_base_urls
+from modules.update_recorder import create_update_queue
+from modules.preauth_guard import preauth_guard
+from modules.auth_utils import admin_roles
+from modules.logging_config import logger, LOG_FORWARDED_ENV, forward_logs_to, start_worker_log_listener
+
+def shard_for(update: Update, num_workers: int) -> int:
+    """
+    Номер воркера для апдейта. Все апдейты одного пользователя попадают
+    в один воркер, поэтому их порядок сохраняется.
+    """
+    if update.effective_user:
+        key = update.effective_user.id
+    elif update.effective_chat:
+        key = update.effective_chat.id
+    else:
+        key = update.update_id
+    return key % num_workers
+
+# Изменения чужих сессий и кэшей. Сессия пользователя живёт только в его воркере (shard_for),
+# поэтому изменение из другого воркера передаётся через супервизор воркеру-владельцу
+CONTROL_KEY = "control"
+CONTROL_SESSION_STATE = "session_state"
+CONTROL_INVALIDATE_EMAIL = "invalidate_email"
+CONTROL_RELOAD_ADMINS = "reload_admins"
+
+# Очередь воркер -> супервизор; None — бот работает одним процессом
+_control_queue = None
+
+async def apply_control(app, message: dict):
+    """
+    Применяет изменение в воркере, которому его направил супервизор.
+    """
+    # Импорт внутри функции: session тянет за собой обработчики диалога
+    from modules.session import set_session_state
+
+    kind = message[CONTROL_KEY]
+    if kind == CONTROL_SESSION_STATE:
+        await set_session_state(app, message["user_id"], message["state"])
+    elif kind == CONTROL_INVALIDATE_EMAIL:
+        preauth_guard.invalidate(message["email"])
+    elif kind == CONTROL_RELOAD_ADMINS:
+        await asyncio.to_thread(admin_roles.reload)
+    else:
+        logger.error(f"Unknown control message: {kind}")
+
+async def send_control(app, message: dict):
+    """
+    Передаёт изменение воркеру-владельцу: с user_id — воркеру этого пользователя, без него — всем воркерам.
+    Когда бот работает одним процессом, изменение применяется сразу.
+    """
+    if _control_queue is None:
+        await apply_control(app, message)
+    else:
+        _control_queue.put(message)
+
+async def set_user_state(app, user_id: int, state):
+    await send_control(app, {CONTROL_KEY: CONTROL_SESSION_STATE, "user_id": user_id, "state": state})
+
+async def invalidate_email(app, email: str):
+    # Отрицательный кэш у каждого воркера свой, а в каком воркере спросят этот адрес, неизвестно
+    await send_control(app, {CONTROL_KEY: CONTROL_INVALIDATE_EMAIL, "email": email})
+
+async def reload_admin_roles(app):
+    # Снятый админ не должен сохранять права в других воркерах до admin_roles_refresh_loop
+    await send_control(app, {CONTROL_KEY: CONTROL_RELOAD_ADMINS})
+
+def worker_main(index: int, queue, log_queue, control_queue):
+    """
+    Точка входа процесса-воркера: полноценный Application без Updater,
+    апдейты и изменения от других воркеров приходят из очереди супервизора.
+    """
+    global _control_queue
+    _control_queue = control_queue
+    forward_logs_to(log_queue)
+    set_port_offset(index)
+    try:
+        asyncio.run(_worker_loop(index, queue))
+    except KeyboardInterrupt:
+        pass
+
+async def _worker_loop(index: int, queue):
+    # Импорт внутри функции: telegram_bot сам импортирует этот модуль
+    from telegram_bot import build_application, start_background_tasks, cancel_background_tasks
+    from modules.ticket_pipeline import drain_ticket_pipeline
+
+    app = build_application(with_updater=False)
+    async with app:
+        await app.start()
+        start_background_tasks(app)
+        logger.info(f"Worker {index} started (pid {os.getpid()})")
+        try:
+            while True:
+                data = await asyncio.to_thread(queue.get)
+                if data is None:
+                    break
+                if CONTROL_KEY in data:
+                    try:
+                        await apply_control(app, data)
+                    except Exception as e:
+                        logger.exception(f"Worker {index} failed to apply control message {data[CONTROL_KEY]}: {e}")
+                    continue
+                await app.update_queue.put(Update.de_json(data, app.bot))
+        finally:
+            # post_stop вызывают только run_polling/run_webhook — здесь конвейер дописывается вручную
+            await app.stop()
+            await drain_ticket_pipeline(env_settings.pipeline_drain_timeout)
+            cancel_background_tasks()
+            logger.info(f"Worker {index} stopped")
+
+def run_supervisor(token: str, num_workers: int):
+    """
+    Запускает num_workers процессов-воркеров и один приём апдейтов (polling или webhook),
+    который раскладывает апдейты по воркерам по telegram_id. Упавший воркер перезапускается.
+    """
+    if env_settings.dedup_window > 0:
+        # Окно похожих обращений у каждого воркера своё, а пользователи раскладываются по воркерам по telegram_id
+        logger.warning(
+            f"Duplicate detection is per worker: similar tickets from users of different workers are not merged, "
+            f"one incident may reach support up to {num_workers} times"
+        )
+    # spawn работает одинаково на Windows и Linux
+    mp = multiprocessing.get_context("spawn")
+    queues = [mp.Queue() for _ in range(num_workers)]
+    processes = [None] * num_workers
+
+    # Логи воркеров пишет супервизор: ротировать общий файл из нескольких процессов нельзя
+    log_queue = mp.Queue()
+    log_listener = start_worker_log_listener(log_queue)
+    os.environ[LOG_FORWARDED_ENV] = "1"
+    control_queue = mp.Queue()
+
+    def spawn(index: int):
+        process = mp.Process(
+            target=worker_main, args=(index, queues[index], log_queue, control_queue),
+            name=f"bot-worker-{index}", daemon=True
+        )
+        process.start()
+        processes[index] = process
+
+    for index in range(num_workers):
+        spawn(index)
+
+    try:
+        asyncio.run(_run_ingress(token, queues, processes, spawn, control_queue))
+    finally:
+        logger.info("Stopping workers...")
+        for queue in queues:
+            queue.put(None)
+        for process in processes:
+            process.join(timeout=env_settings.worker_shutdown_timeout)
+            if process.is_alive():
+                logger.warning(f"Worker {process.name} did not stop in time, terminating")
+                process.terminate()
+        log_listener.stop()
+
+async def _monitor_workers(processes: list, spawn):
+    while True:
+        await asyncio.sleep(env_settings.worker_check_interval)
+        for index, process in enumerate(processes):
+            if not process.is_alive():
+                logger.error(f"Worker {index} exited with code {process.exitcode}, restarting")
+                spawn(index)
+
+async def _route_control(control_queue, queues: list):
+    while True:
+        message = await asyncio.to_thread(control_queue.get)
+        if message is None:
+            return
+        user_id = message.get("user_id")
+        # Тот же ключ, что у shard_for: в личном чате id пользователя — его telegram_id
+        targets = queues if user_id is None else [queues[user_id % len(queues)]]
+        for queue in targets:
+            queue.put(message)
+
+async def _run_ingress(token: str, queues: list, processes: list, spawn, control_queue):
+    bot = Bot(token, **api_base_urls())
+    update_queue = create_update_queue()
+    updater = Updater(bot, update_queue)
+    monitor = asyncio.create_task(_monitor_workers(processes, spawn))
+    router = asyncio.create_task(_route_control(control_queue, queues))
+
+    async with updater:
+        await setup_bot_commands(bot)
+
+        if env_settings.webhook_url:
+            await updater.start_webhook(
+                listen=env_settings.webhook_listen,
+                port=env_settings.webhook_port,
+                url_path=env_settings.webhook_path,
+                webhook_url=env_settings.webhook_url
+            )
+            logger.info(f"Supervisor is listening for webhook updates on {env_settings.webhook_listen}:{env_settings.webhook_port}")
+        else:
+            await updater.start_polling()
+            logger.info("Supervisor is polling for messages")
+
+        try:
+            while True:
+                update = await update_queue.get()
+                queues[shard_for(update, len(queues))].put(update.to_dict())
+        finally:
+            monitor.cancel()
+            # Поток, ждущий очередь, не отменить — маршрутизатор останавливается по None
+            control_queue.put(None)
+            await router
+            await updater.stop()
@@ -1,19 +1,19 @@
 import os
 import sqlite3
-from dotenv import load_dotenv
+from modules.settings import env_settings
 from modules.log_utils import log_sync_call
 from modules.logging_config import logger
 
-load_dotenv()
-DB_PATH = os.getenv("DB_PATH", "database/db.sqlite3")
-ROOT_ADMIN_ID = int(os.getenv("ROOT_ADMIN_ID", 0))
 
 @log_sync_call
 def db_init():
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
+    os.makedirs(os.path.dirname(env_settings.db_path), exist_ok=True)
+    conn = sqlite3.connect(env_settings.db_path)
     cursor = conn.cursor()
 
+    # WAL позволяет нескольким процессам-воркерам читать, пока другой пишет
+    cursor.execute("PRAGMA journal_mode=WAL")
+
     # Таблица разрешенных email-адресов
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS allowed_emails (
@@ -46,6 +46,12 @@ def db_init():
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_telegram_id ON users(telegram_id)")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_email_id ON users(email_id)")
 
+    # Адрес, который пользователь ввёл, но которого нет в allowed_emails
+    cursor.execute("PRAGMA table_info(users)")
+    if "requested_email" not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE users ADD COLUMN requested_email TEXT")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_requested_email ON users(requested_email)")
+
     # Триггер для обновления updated_at
     cursor.execute("""
         CREATE TRIGGER IF NOT EXISTS trg_users_updated_at
@@ -66,13 +72,62 @@ def db_init():
 
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_admins_telegram_id ON admins(telegram_id)")
 
+    # Таблица FSM-сессий (состояние диалога и счётчики лимитов)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            telegram_id INTEGER PRIMARY KEY,
+            state TEXT,
+            selected_topic TEXT,
+            pending_email TEXT,
+            request_timestamp INTEGER DEFAULT 0,
+            request_count INTEGER DEFAULT 0,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # Правила списка разрешённых адресов: домены, поддомены, шаблоны локальной части
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS allow_rules (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            pattern TEXT UNIQUE NOT NULL,
+            is_ban INTEGER DEFAULT 0,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # Сообщения обращений в чате поддержки: по ответу сотрудника находим пользователя.
+    # Первичный ключ (chat_id, message_id) — поиск идёт прямо по индексу таблицы
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS ticket_messages (
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            ticket_id TEXT NOT NULL,
+            telegram_id INTEGER NOT NULL,
+            user_message_id INTEGER,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (chat_id, message_id)
+        ) WITHOUT ROWID
+    """)
+
+    # Похожие обращения, схлопнутые в исходное: ответ сотрудника на исходное уходит и их авторам
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS ticket_duplicates (
+            ticket_id TEXT NOT NULL,
+            duplicate_id TEXT NOT NULL,
+            telegram_id INTEGER NOT NULL,
+            user_message_id INTEGER,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (ticket_id, duplicate_id)
+        ) WITHOUT ROWID
+    """)
+
     conn.commit()
     conn.close()
     logger.info("Database initialized")
 
 @log_sync_call
 def db_add_allowed_email(email: str):
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(env_settings.db_path)
     try:
         cursor = conn.cursor()
 
@@ -93,6 +148,14 @@ def db_add_allowed_email(email: str):
                 WHERE email_id = ? AND is_authorized = 0
             """, (email_id,))
             logger.debug(f"Authorized {cursor.rowcount} users for email {email}")
+
+            # Пользователи, которые уже пытались войти с этим адресом
+            cursor.execute("""
+                UPDATE users
+                SET email_id = ?, is_authorized = 1, requested_email = NULL
+                WHERE requested_email = ?
+            """, (email_id, email))
+            logger.debug(f"Linked {cursor.rowcount} users who requested email {email}")
         else:
             logger.warning(f"Email {email} inserted, but id not found (unexpected)")
 
@@ -108,7 +171,7 @@ def db_get_telegram_ids_by_email(email: str) -> list[int]:
     """
     Возвращает список telegram_id всех пользователей, у которых задан данный email.
     """
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(env_settings.db_path)
     cursor = conn.cursor()
 
     cursor.execute("SELECT id FROM allowed_emails WHERE email = ?", (email,))
@@ -127,7 +190,7 @@ def db_get_telegram_ids_by_email(email: str) -> list[int]:
 
 @log_sync_call
 def db_remove_allowed_email(email: str):
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(env_settings.db_path)
     cursor = conn.cursor()
     cursor.execute("DELETE FROM allowed_emails WHERE email = ?", (email,))
     conn.commit()
@@ -135,7 +198,7 @@ def db_remove_allowed_email(email: str):
     
 @log_sync_call
 def db_unlink_users_from_email(email: str):
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(env_settings.db_path)
     cursor = conn.cursor()
 
     cursor.execute("SELECT id FROM allowed_emails WHERE email = ?", (email,))
@@ -157,9 +220,40 @@ def db_unlink_users_from_email(email: str):
     conn.commit()
     conn.close()
 
+@log_sync_call
+def db_list_authorized_emails() -> list[tuple]:
+    """
+    @return Пары (telegram_id, email) авторизованных пользователей
+    """
+    conn = sqlite3.connect(env_settings.db_path)
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT users.telegram_id, allowed_emails.email
+        FROM users JOIN allowed_emails ON allowed_emails.id = users.email_id
+        WHERE users.is_authorized = 1
+    """)
+    rows = cursor.fetchall()
+    conn.close()
+    return rows
+
+@log_sync_call
+def db_revoke_users(telegram_ids: list) -> int:
+    """
+    Снимает авторизацию, не отвязывая email: после удаления правила пользователь войдёт тем же адресом
+    @param telegram_ids Идентификаторы пользователей
+    @return Число пользователей, у которых снята авторизация
+    """
+    conn = sqlite3.connect(env_settings.db_path)
+    cursor = conn.cursor()
+    cursor.executemany("UPDATE users SET is_authorized = 0 WHERE telegram_id = ?", [(i,) for i in telegram_ids])
+    revoked = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return revoked
+
 @log_sync_call
 def db_ban_allowed_email(email: str):
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(env_settings.db_path)
     cursor = conn.cursor()
     cursor.execute("UPDATE allowed_emails SET is_banned = 1 WHERE email = ?", (email,))
     conn.commit()
@@ -167,7 +261,7 @@ def db_ban_allowed_email(email: str):
 
 @log_sync_call
 def db_unban_allowed_email(email: str):
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(env_settings.db_path)
     cursor = conn.cursor()
     cursor.execute("UPDATE allowed_emails SET is_banned = 0 WHERE email = ?", (email,))
     conn.commit()
@@ -175,7 +269,7 @@ def db_unban_allowed_email(email: str):
 
 @log_sync_call
 def db_get_user_by_telegram_id(telegram_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(env_settings.db_path)
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
@@ -185,7 +279,7 @@ def db_get_user_by_telegram_id(telegram_id: int):
     
 @log_sync_call
 def db_get_users_by_email(email: str) -> list[dict]:
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(env_settings.db_path)
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
 
@@ -207,7 +301,7 @@ def db_get_users_by_email(email: str) -> list[dict]:
     
 @log_sync_call
 def db_get_email_by_id(email_id: int) -> str:
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(env_settings.db_path)
     cursor = conn.cursor()
     cursor.execute("SELECT email FROM allowed_emails WHERE id = ?", (email_id,))
     row = cursor.fetchone()
@@ -216,7 +310,7 @@ def db_get_email_by_id(email_id: int) -> str:
     
 @log_sync_call
 def db_get_email_row(email: str):
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(env_settings.db_path)
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM allowed_emails WHERE email = ?", (email,))
@@ -226,32 +320,34 @@ def db_get_email_row(email: str):
 
 @log_sync_call
 def db_add_user(email: str, telegram_id: int, username: str = None, full_name: str = None, authorized: bool = True):
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(env_settings.db_path)
     cursor = conn.cursor()
 
     cursor.execute("SELECT id, is_banned FROM allowed_emails WHERE email = ?", (email,))
     email_row = cursor.fetchone()
 
-    if not email_row:
-        cursor.execute("INSERT INTO allowed_emails (email, is_banned) VALUES (?, 1)", (email,))
-        conn.commit()
-        cursor.execute("SELECT id, is_banned FROM allowed_emails WHERE email = ?", (email,))
-        email_row = cursor.fetchone()
+    if email_row:
+        email_id, is_banned = email_row
+        requested_email = None
+    else:
+        # Неизвестный адрес не добавляется в allowed_emails — он запоминается у пользователя
+        # и будет привязан, когда администратор добавит его через /add_email
+        email_id, is_banned = None, 1
+        requested_email = email
 
-    email_id, is_banned = email_row
     is_authorized = int(authorized and not is_banned)
 
     cursor.execute("""
-        INSERT OR REPLACE INTO users (telegram_id, username, full_name, email_id, is_authorized)
-        VALUES (?, ?, ?, ?, ?)
-    """, (telegram_id, username, full_name, email_id, is_authorized))
+        INSERT OR REPLACE INTO users (telegram_id, username, full_name, email_id, is_authorized, requested_email)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (telegram_id, username, full_name, email_id, is_authorized, requested_email))
 
     conn.commit()
     conn.close()
     
 @log_sync_call
 def db_update_user_email(telegram_id: int, new_email: str):
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(env_settings.db_path)
     cursor = conn.cursor()
     cursor.execute("SELECT id, is_banned FROM allowed_emails WHERE email = ?", (new_email,))
     email_row = cursor.fetchone()
@@ -270,7 +366,7 @@ def db_update_user_email(telegram_id: int, new_email: str):
     
 @log_sync_call
 def db_is_admin(telegram_id: int) -> bool:
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(env_settings.db_path)
     cursor = conn.cursor()
     cursor.execute("SELECT COUNT(*) FROM admins WHERE telegram_id = ?", (telegram_id,))
     result = cursor.fetchone()
@@ -279,23 +375,25 @@ def db_is_admin(telegram_id: int) -> bool:
 
 @log_sync_call
 def db_add_admin(telegram_id: int, is_top_level: bool = False):
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(env_settings.db_path)
     cursor = conn.cursor()
     cursor.execute("INSERT OR REPLACE INTO admins (telegram_id, is_top_level) VALUES (?, ?)", (telegram_id, int(is_top_level)))
     conn.commit()
     conn.close()
 
 @log_sync_call
-def db_remove_admin(telegram_id: int):
-    conn = sqlite3.connect(DB_PATH)
+def db_remove_admin(telegram_id: int) -> bool:
+    conn = sqlite3.connect(env_settings.db_path)
     cursor = conn.cursor()
     cursor.execute("DELETE FROM admins WHERE telegram_id = ?", (telegram_id,))
+    removed = cursor.rowcount > 0
     conn.commit()
     conn.close()
+    return removed
 
 @log_sync_call
 def db_list_admins():
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(env_settings.db_path)
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM admins")
@@ -303,3 +401,154 @@ def db_list_admins():
     conn.close()
     return [dict(row) for row in rows]
 
+@log_sync_call
+def db_get_session(telegram_id: int):
+    conn = sqlite3.connect(env_settings.db_path)
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT state, selected_topic, pending_email, request_timestamp, request_count
+        FROM user_sessions WHERE telegram_id = ?
+    """, (telegram_id,))
+    row = cursor.fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+@log_sync_call
+def db_save_sessions(sessions: list[tuple]):
+    """
+    Сохраняет пачку сессий одной транзакцией.
+
+    @param sessions: Кортежи (telegram_id, state, selected_topic, pending_email, request_timestamp, request_count)
+    """
+    conn = sqlite3.connect(env_settings.db_path)
+    try:
+        conn.executemany("""
+            INSERT INTO user_sessions (telegram_id, state, selected_topic, pending_email, request_timestamp, request_count)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(telegram_id) DO UPDATE SET
+                state = excluded.state,
+                selected_topic = excluded.selected_topic,
+                pending_email = excluded.pending_email,
+                request_timestamp = excluded.request_timestamp,
+                request_count = excluded.request_count,
+                updated_at = CURRENT_TIMESTAMP
+        """, sessions)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise e
+    finally:
+        conn.close()
+
+@log_sync_call
+def db_delete_sessions(telegram_ids: list[int]):
+    conn = sqlite3.connect(env_settings.db_path)
+    try:
+        conn.executemany("DELETE FROM user_sessions WHERE telegram_id = ?", [(i,) for i in telegram_ids])
+        conn.commit()
+    finally:
+        conn.close()
+
+@log_sync_call
+def db_add_allow_rule(pattern: str, is_ban: bool = False):
+    conn = sqlite3.connect(env_settings.db_path)
+    cursor = conn.cursor()
+    # REPLACE удаляет старую строку и вставляет новую — меняется id, а с ним версия правил
+    cursor.execute("INSERT OR REPLACE INTO allow_rules (pattern, is_ban) VALUES (?, ?)", (pattern, int(is_ban)))
+    conn.commit()
+    conn.close()
+
+@log_sync_call
+def db_remove_allow_rule(pattern: str) -> bool:
+    conn = sqlite3.connect(env_settings.db_path)
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM allow_rules WHERE pattern = ?", (pattern,))
+    removed = cursor.rowcount > 0
+    conn.commit()
+    conn.close()
+    return removed
+
+@log_sync_call
+def db_list_allow_rules() -> list[tuple]:
+    """
+    @return Пары (шаблон, is_ban) в порядке добавления
+    """
+    conn = sqlite3.connect(env_settings.db_path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT pattern, is_ban FROM allow_rules ORDER BY id")
+    rows = cursor.fetchall()
+    conn.close()
+    return [(row[0], bool(row[1])) for row in rows]
+
+@log_sync_call
+def db_allow_rules_version() -> tuple:
+    """
+    Дешёвый признак изменения правил: id с AUTOINCREMENT не переиспользуются,
+    поэтому любое добавление меняет MAX(id), а удаление — COUNT(*).
+    """
+    conn = sqlite3.connect(env_settings.db_path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*), MAX(id) FROM allow_rules")
+    row = cursor.fetchone()
+    conn.close()
+    return tuple(row)
+
+@log_sync_call
+def db_add_ticket_messages(rows: list[tuple]):
+    """
+    Сохраняет сообщения одного обращения в чате поддержки одной транзакцией.
+
+    @param rows: Кортежи (chat_id, message_id, ticket_id, telegram_id, user_message_id)
+    """
+    conn = sqlite3.connect(env_settings.db_path)
+    try:
+        conn.executemany("""
+            INSERT OR REPLACE INTO ticket_messages (chat_id, message_id, ticket_id, telegram_id, user_message_id)
+            VALUES (?, ?, ?, ?, ?)
+        """, rows)
+        conn.commit()
+    finally:
+        conn.close()
+
+@log_sync_call
+def db_get_ticket_message(chat_id: int, message_id: int):
+    """
+    @return (ticket_id, telegram_id, user_message_id) или None
+    """
+    conn = sqlite3.connect(env_settings.db_path)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT ticket_id, telegram_id, user_message_id FROM ticket_messages WHERE chat_id = ? AND message_id = ?",
+        (chat_id, message_id)
+    )
+    row = cursor.fetchone()
+    conn.close()
+    return tuple(row) if row else None
+
+@log_sync_call
+def db_add_ticket_duplicate(ticket_id: str, duplicate_id: str, telegram_id: int, user_message_id: int):
+    conn = sqlite3.connect(env_settings.db_path)
+    try:
+        conn.execute("""
+            INSERT OR REPLACE INTO ticket_duplicates (ticket_id, duplicate_id, telegram_id, user_message_id)
+            VALUES (?, ?, ?, ?)
+        """, (ticket_id, duplicate_id, telegram_id, user_message_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+@log_sync_call
+def db_get_ticket_duplicates(ticket_id: str) -> list[tuple]:
+    """
+    @return Кортежи (duplicate_id, telegram_id, user_message_id) обращений, схлопнутых в ticket_id
+    """
+    conn = sqlite3.connect(env_settings.db_path)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT duplicate_id, telegram_id, user_message_id FROM ticket_duplicates WHERE ticket_id = ?",
+        (ticket_id,)
+    )
+    rows = cursor.fetchall()
+    conn.close()
+    return [tuple(row) for row in rows]
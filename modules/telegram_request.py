@@ -0,0 +1,39 @@
+import time
+from telegram.request import HTTPXRequest
+from modules.settings import env_settings
+from modules.metrics import telegram_api_duration, telegram_api_errors
+from modules.tracing import start_span, end_span
+
+def api_base_urls() -> dict:
+    """
+    Адреса Bot API, если задан TELEGRAM_API_URL (локальный telegram-bot-api или фейковый сервер
+    нагрузочного теста). Иначе пусто — используются адреса api.telegram.org по умолчанию.
+    """
+    if not env_settings.telegram_api_url:
+        return {}
+    root = env_settings.telegram_api_url.rstrip("/")
+    return {"base_url": f"{root}/bot", "base_file_url": f"{root}/file/bot"}
+
+class InstrumentedRequest(HTTPXRequest):
+    """
+    HTTPXRequest, который замеряет задержку каждого вызова Bot API по имени метода.
+    """
+    async def do_request(self, url: str, method: str, *args, **kwargs) -> tuple:
+        api_method = url.rsplit("/", 1)[-1]
+        span = start_span(api_method, "telegram")
+        error = None
+        started = time.perf_counter()
+        try:
+            status, payload = await super().do_request(url, method, *args, **kwargs)
+            if status >= 400:
+                error = str(status)
+                telegram_api_errors.inc(api_method, error)
+            return status, payload
+        except Exception as e:
+            error = type(e).__name__
+            telegram_api_errors.inc(api_method, error)
+            raise
+        finally:
+            telegram_api_duration.observe(time.perf_counter() - started, api_method)
+            if span is not None:
+                end_span(span, error)
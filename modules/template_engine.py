@@ -1,12 +1,79 @@
+import os
 import logging
-from jinja2 import Environment, FileSystemLoader, select_autoescape, TemplateNotFound
+from collections import OrderedDict
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, select_autoescape, meta, TemplateNotFound
+from modules.settings import env_settings
+from modules.tracing import start_span, end_span
 
 logger = logging.getLogger("tg_support_bot.template")
 
-env = Environment(
-    loader=FileSystemLoader("templates"),
-    autoescape=select_autoescape(["txt", "html"])
-)
+TEMPLATES_DIR = "templates"
+
+# Шаблоны, результат которых зависит только от переданного контекста, а контекст берётся из конфигурации
+# (категория, лимит длины, имя команды) — их рендер кэшируется. Шаблоны с данными пользователя (username, email)
+# сюда не входят: каждый такой рендер уникален, он только занимал бы кэш и держал в памяти чужие данные
+PURE_TEMPLATES = frozenset({
+    "email_required.txt",
+    "email_subject.txt",
+    "enter_message.txt",
+    "message_too_long.txt",
+})
+
+os.makedirs(env_settings.template_cache_dir, exist_ok=True)
+
+def _create_environment() -> Environment:
+    return Environment(
+        loader=FileSystemLoader(TEMPLATES_DIR),
+        autoescape=select_autoescape(["txt", "html"]),
+        bytecode_cache=FileSystemBytecodeCache(env_settings.template_cache_dir),
+        # В продакшене шаблоны не перечитываются с диска (нет stat() на каждый вызов)
+        auto_reload=env_settings.template_auto_reload
+    )
+
+env = _create_environment()
+
+_constant_renders = {}          # шаблоны без переменных: имя -> готовый текст
+_render_cache = OrderedDict()   # (имя, контекст) -> текст, для PURE_TEMPLATES
+
+def prepare_templates() -> tuple:
+    """
+    Компилирует все шаблоны из templates/ в новом окружении и заранее рендерит шаблоны без переменных.
+    Текущее окружение не трогает — можно вызывать из отдельного потока.
+
+    @return Пара (окружение, готовые тексты) для install_templates
+    """
+    new_env = _create_environment()
+    constant_renders = {}
+    for template_name in new_env.list_templates():
+        try:
+            template = new_env.get_template(template_name)
+            source = new_env.loader.get_source(new_env, template_name)[0]
+            if not meta.find_undeclared_variables(new_env.parse(source)):
+                constant_renders[template_name] = template.render()
+        except Exception as e:
+            logger.error(f"Template warm-up failed for {template_name}: {e}")
+    return new_env, constant_renders
+
+def install_templates(prepared: tuple):
+    global env, _constant_renders, _render_cache
+    env, _constant_renders = prepared
+    _render_cache = OrderedDict()
+    logger.debug(f"Templates warmed up, {len(_constant_renders)} constant")
+
+def templates_mtime() -> tuple:
+    """
+    Последнее время изменения и число файлов в templates/ — для отслеживания правок.
+    """
+    latest = 0
+    count = 0
+    for entry in os.scandir(TEMPLATES_DIR):
+        if entry.is_file():
+            latest = max(latest, entry.stat().st_mtime_ns)
+            count += 1
+    return latest, count
+
+def warm_up_templates():
+    install_templates(prepare_templates())
 
 def render_template(template_name: str, fallback: str = "⚠ Template error", **kwargs) -> str:
     """
@@ -17,12 +84,39 @@ def render_template(template_name: str, fallback: str = "⚠ Template error", **
     @param kwargs: Template context
     @return Rendered string or fallback
     """
+    constant = _constant_renders.get(template_name)
+    if constant is not None:
+        return constant
+
+    cache_key = None
+    if template_name in PURE_TEMPLATES:
+        cache_key = (template_name, tuple(sorted(kwargs.items())))
+        try:
+            cached = _render_cache.get(cache_key)
+        except TypeError:
+            # Нехэшируемый контекст — рендерим без кэша
+            cache_key = cached = None
+        if cached is not None:
+            _render_cache.move_to_end(cache_key)
+            return cached
+
+    # В трассу попадают только настоящие рендеры, без попаданий в кэш
+    span = start_span(template_name, "template")
     try:
         template = env.get_template(template_name)
-        return template.render(**kwargs)
+        rendered = template.render(**kwargs)
     except TemplateNotFound:
         logger.error(f"Template not found: {template_name}")
         return f"[ERROR] Template '{template_name}' not found"
     except Exception as e:
         logger.error(f"Template rendering failed: {e}")
-        return fallback
\ No newline at end of file
+        return fallback
+    finally:
+        if span is not None:
+            end_span(span)
+
+    if cache_key is not None:
+        _render_cache[cache_key] = rendered
+        if len(_render_cache) > env_settings.render_cache_size:
+            _render_cache.popitem(last=False)
+    return rendered
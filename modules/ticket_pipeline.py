@@ -0,0 +1,461 @@
+import uuid
+import time
+import heapq
+import asyncio
+import itertools
+import mimetypes
+from telegram import Bot, Message, ReplyKeyboardRemove, InputMediaPhoto
+from modules.settings import env_settings
+from modules.config import category_policy
+from modules.destinations import CHAT, EMAIL, Destination, default_destinations
+from modules.template_engine import render_template
+from modules.metrics import CallbackGauge, Counter, Histogram
+from modules.tracing import correlation_id, start_trace, resume_span, end_span
+from modules.reply_relay import ticket_messages
+from modules.dedup import duplicate_index, dedup_enabled, schedule_summary_update
+from modules.logging_config import logger
+
+# Стадии конвейера: intake -> dedup -> enrich -> render -> fan-out -> acknowledge
+STAGES = ("dedup", "enrich", "render", "fanout", "acknowledge")
+
+_queues = {}
+_bot = None
+_deferred = set()
+# Дубликат, который ждёт отправки исходного обращения: воркер стадии не передаёт его дальше
+_PARKED = object()
+# Принятые, но ещё не подтверждённые обращения (для отчёта о памяти)
+_in_flight = {}
+
+class Ticket:
+    """
+    Обращение, проходящее через стадии конвейера.
+    """
+    __slots__ = (
+        "ticket_id", "telegram_id", "username", "email", "topic", "text", "messages",
+        "attachments", "text_summary", "subject", "html_body", "delivered", "created_at", "trace",
+        "duplicate_of", "priority", "sla_sec", "destinations", "report",
+    )
+
+    def __init__(self, telegram_id: int, username: str, email: str, topic: str, text: str, messages: list):
+        self.ticket_id = uuid.uuid4().hex[:12]
+        self.telegram_id = telegram_id
+        self.username = username
+        self.email = email
+        self.topic = topic
+        self.text = text
+        self.messages = messages    # одно сообщение или вся медиагруппа
+        self.attachments = []
+        self.text_summary = ""
+        self.subject = ""
+        self.html_body = ""
+        self.delivered = False
+        self.created_at = time.monotonic()
+        self.trace = None           # корневой спан трассы обращения, если она пишется
+        self.duplicate_of = None    # ticket_id похожего обращения, в которое схлопнуто это
+        self.report = None          # запись в окне поиска похожих, если обращение стало исходным
+        policy = category_policy(topic)
+        self.priority = policy.priority
+        self.sla_sec = policy.sla_sec
+        self.destinations = policy.destinations or default_destinations()
+
+class TicketQueue(asyncio.Queue):
+    """
+    Очередь стадии конвейера: куча по приоритету категории со старением.
+
+    Обращение с приоритетом p стоит в очереди так, будто принято на p * PIPELINE_PRIORITY_AGING секунд раньше.
+    Порядок одинаков на всех стадиях, поэтому срочное обращение не ждёт за обычными ни на загрузке вложений,
+    ни на отправке, пока чат или SMTP упираются в лимиты. Обычное обращение, прождавшее дольше этой форы,
+    уходит раньше новых срочных — голодания нет.
+    """
+
+    def __init__(self, stage: str, maxsize: int = 0):
+        self.stage = stage
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        self._queue = []
+        self._order = itertools.count()     # при равном ключе — порядок поступления
+
+    def _put(self, ticket):
+        key = ticket.created_at - ticket.priority * env_settings.pipeline_priority_aging
+        heapq.heappush(self._queue, (key, next(self._order), time.monotonic(), ticket))
+
+    def _get(self):
+        _, _, enqueued_at, ticket = heapq.heappop(self._queue)
+        if self.stage == "fanout":
+            delivery_queue_wait.observe(time.monotonic() - enqueued_at, ticket.priority)
+        return ticket
+
+def make_attachment(data: bytes, filename: str, fallback_type: str = "application/octet-stream"):
+    mimetype, _ = mimetypes.guess_type(filename)
+    if mimetype:
+        maintype, subtype = mimetype.split("/", 1)
+    else:
+        maintype, subtype = fallback_type.split("/", 1)
+
+    return {
+        "data": data,
+        "maintype": maintype,
+        "subtype": subtype,
+        "filename": filename
+    }
+
+def submit_ticket(ticket: Ticket, delay: float = 0.0) -> bool:
+    """
+    Стадия intake: ставит обращение в очередь без ожидания.
+
+    @param delay: Отложить постановку на delay секунд (режим очереди при перегрузке)
+    @return False, если конвейер переполнен — пользователю нужно ответить «занято»
+    """
+    queue = _queues.get(STAGES[0])
+    if queue is None:
+        logger.error("Ticket pipeline is not started")
+        return False
+    # Трасса обращения продолжается в воркерах стадий, а не в задаче апдейта
+    ticket.trace = start_trace(ticket.ticket_id, "ticket", activate=False, topic=ticket.topic, messages=len(ticket.messages))
+    if delay > 0:
+        task = asyncio.get_running_loop().create_task(_submit_later(ticket, delay))
+        _deferred.add(task)
+        task.add_done_callback(_deferred.discard)
+        _in_flight[ticket.ticket_id] = ticket
+        logger.info(f"Ticket {ticket.ticket_id} from user {ticket.telegram_id} deferred for {delay:.1f}s")
+        return True
+    try:
+        queue.put_nowait(ticket)
+    except asyncio.QueueFull:
+        logger.warning(f"Ticket pipeline is full, rejecting ticket from user {ticket.telegram_id}")
+        if ticket.trace is not None:
+            end_span(ticket.trace, "QueueFull")
+        return False
+    _in_flight[ticket.ticket_id] = ticket
+    logger.info(f"Ticket {ticket.ticket_id} from user {ticket.telegram_id} accepted")
+    return True
+
+async def _submit_later(ticket: Ticket, delay: float):
+    await asyncio.sleep(delay)
+    # Обращение уже принято — ждём места в очереди, а не отклоняем
+    await _queues[STAGES[0]].put(ticket)
+
+def in_flight_tickets() -> list:
+    return list(_in_flight.values())
+
+async def drain_ticket_pipeline(timeout: float) -> list:
+    """
+    Ждёт, пока принятые обращения пройдут конвейер. Вызывается при остановке, пока бот ещё может отправлять сообщения,
+    и до отмены воркеров стадий.
+
+    @return Идентификаторы обращений, не успевших пройти конвейер за timeout секунд
+    """
+    deadline = time.monotonic() + timeout
+    while _in_flight and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    dropped = list(_in_flight.values())
+    if dropped:
+        # Пользователи уже получили ticket_accepted.txt — по этой строке их можно найти и попросить повторить
+        logger.error(
+            f"Pipeline stopped with {len(dropped)} undelivered tickets: "
+            + ", ".join(f"{ticket.ticket_id} (user {ticket.telegram_id})" for ticket in dropped)
+        )
+    elif timeout > 0:
+        logger.info("Ticket pipeline drained")
+    return [ticket.ticket_id for ticket in dropped]
+
+def pipeline_queue_sizes() -> dict:
+    return {stage: queue.qsize() for stage, queue in _queues.items()}
+
+CallbackGauge(
+    "tg_bot_pipeline_queue_depth", "Tickets waiting in each pipeline stage queue",
+    lambda: {(stage,): size for stage, size in pipeline_queue_sizes().items()}, ("stage",)
+)
+
+delivery_queue_wait = Histogram(
+    "tg_bot_delivery_queue_wait_seconds", "Time tickets wait for delivery by category priority", ("priority",)
+)
+sla_breaches = Counter(
+    "tg_bot_ticket_sla_breaches_total", "Tickets delivered later than their category SLA", ("priority",)
+)
+delivery_failures = Counter(
+    "tg_bot_delivery_failures_total", "Failed or timed out ticket sends by destination", ("destination", "error")
+)
+
+def _media_items(message: Message) -> list:
+    """
+    Вложения сообщения: (вид, file_id, имя файла для email, MIME по умолчанию).
+    """
+    items = []
+    if message.photo:
+        # Последнее фото — самое большое; Telegram photo = JPEG
+        items.append(("photo", message.photo[-1].file_id, f"photo_{message.message_id}.jpg", "image/jpeg"))
+    if message.document:
+        items.append(("document", message.document.file_id, message.document.file_name or f"document_{message.message_id}", "application/octet-stream"))
+    if message.video:
+        items.append(("video", message.video.file_id, f"video_{message.message_id}.mp4", "video/mp4"))
+    if message.voice:
+        items.append(("voice", message.voice.file_id, f"voice_{message.message_id}.ogg", "audio/ogg"))
+    if message.audio:
+        items.append(("audio", message.audio.file_id, message.audio.file_name or f"audio_{message.message_id}.mp3", "audio/mpeg"))
+    return items
+
+async def _dedup(ticket: Ticket):
+    # Счётчик похожих обращений показывается в чате поддержки — без чата схлопывать некуда
+    if not dedup_enabled() or not any(destination.kind == CHAT for destination in ticket.destinations):
+        return
+    original = duplicate_index.check(ticket)
+    if original is None:
+        ticket.report = duplicate_index.report(ticket.ticket_id)
+        return
+    # Похожее обращение уже принято: вместо новой отправки растёт счётчик под ним в чате поддержки
+    ticket.duplicate_of = original.ticket_id
+    schedule_summary_update(_bot, original)
+    if original.delivered:
+        _attach_duplicate(original, ticket)
+    else:
+        # Подтверждать рано: если исходное не дойдёт до чата, это обращение уйдёт как обычное
+        original.pending.append(ticket)
+    logger.info(f"Ticket {ticket.ticket_id} from user {ticket.telegram_id} collapsed into similar ticket {original.ticket_id}")
+
+def _attach_duplicate(report, ticket: Ticket):
+    ticket.delivered = True
+    if env_settings.reply_relay:
+        # Ответ сотрудника на исходное обращение уйдёт и автору этого
+        try:
+            ticket_messages.remember_duplicate(
+                report.ticket_id, ticket.ticket_id, ticket.telegram_id, ticket.messages[0].message_id
+            )
+        except Exception as e:
+            logger.error(f"Failed to link ticket {ticket.ticket_id} to similar ticket {report.ticket_id}: {e}")
+
+def _settle_duplicates(ticket: Ticket, delivered: bool):
+    """
+    Решает судьбу похожих обращений, ждущих исходное: после отправки в чат они подтверждаются,
+    а если исходное до чата не дошло — идут дальше по конвейеру как обычные.
+    """
+    report, ticket.report = ticket.report, None
+    if report is None:
+        return
+    if delivered:
+        report.delivered = True
+    else:
+        # Под недоставленным обращением негде показать счётчик — похожие пойдут как новые
+        duplicate_index.forget(ticket.topic, ticket.ticket_id)
+    pending, report.pending = report.pending, []
+    for duplicate in pending:
+        if delivered:
+            _attach_duplicate(report, duplicate)
+            stage = "acknowledge"
+        else:
+            duplicate.duplicate_of = None
+            logger.info(f"Ticket {duplicate.ticket_id} resubmitted: similar ticket {report.ticket_id} was not delivered")
+            stage = "enrich"
+        # Не ждём места в очереди в воркере стадии: он сам может держать конвейер
+        task = asyncio.get_running_loop().create_task(_queues[stage].put(duplicate))
+        _deferred.add(task)
+        task.add_done_callback(_deferred.discard)
+
+def _has_email(ticket: Ticket) -> bool:
+    return any(destination.kind == EMAIL for destination in ticket.destinations)
+
+async def _enrich(ticket: Ticket):
+    # Вложения скачиваются только для email — в чат они пересылаются по file_id
+    if not _has_email(ticket):
+        return
+    for message in ticket.messages:
+        for kind, file_id, filename, fallback_type in _media_items(message):
+            try:
+                file = await _bot.get_file(file_id)
+                file_bytes = await file.download_as_bytearray()
+                ticket.attachments.append(make_attachment(bytes(file_bytes), filename, fallback_type))
+            except Exception as e:
+                logger.error(f"Failed to download {kind} from user {ticket.telegram_id}: {e}")
+
+async def _render(ticket: Ticket):
+    ticket.text_summary = render_template(
+        "ticket_summary.txt",
+        username=ticket.username,
+        telegram_id=ticket.telegram_id,
+        email=ticket.email,
+        topic=ticket.topic,
+        message=ticket.text
+    )
+    if _has_email(ticket):
+        ticket.subject = render_template("email_subject.txt", topic=ticket.topic)
+        ticket.html_body = render_template(
+            "support_email.html",
+            telegram_username=ticket.username,
+            telegram_id=ticket.telegram_id,
+            email=ticket.email,
+            topic=ticket.topic,
+            message=ticket.text
+        )
+
+async def _send_to_chat(ticket: Ticket, destination: Destination) -> bool:
+    chat_id, thread_id = destination.target, destination.thread_id
+    text = ticket.text_summary
+    if env_settings.reply_relay:
+        text = f"{text}\n\n{render_template('support_reply_hint.txt', ticket_id=ticket.ticket_id)}"
+    summary = await _bot.send_message(chat_id=chat_id, text=text, message_thread_id=thread_id)
+    sent = [summary]
+
+    if len(ticket.messages) > 1:
+        media = [
+            InputMediaPhoto(media=message.photo[-1].file_id)
+            for message in ticket.messages if message.photo
+        ]
+        if media:
+            sent.extend(await _bot.send_media_group(chat_id=chat_id, media=media, message_thread_id=thread_id))
+    else:
+        for kind, file_id, _, _ in _media_items(ticket.messages[0]):
+            try:
+                # send_photo, send_document, send_video, send_voice, send_audio
+                sent.append(await getattr(_bot, f"send_{kind}")(chat_id, file_id, message_thread_id=thread_id))
+            except Exception as e:
+                logger.error(f"Failed to send {kind} from user {ticket.telegram_id} to {destination}: {e}")
+
+    logger.info(f"Ticket {ticket.ticket_id} from user {ticket.telegram_id} sent to {destination}")
+
+    report = ticket.report
+    if report is not None:
+        # Похожие обращения могли прийти, пока это отправлялось
+        report.messages.append(summary)
+        report.text = text
+        if report.similar:
+            schedule_summary_update(_bot, report)
+
+    if env_settings.reply_relay:
+        # Ответ сотрудника на любое из этих сообщений уйдёт пользователю
+        try:
+            ticket_messages.remember(
+                summary.chat_id, [message.message_id for message in sent],
+                ticket.ticket_id, ticket.telegram_id, ticket.messages[0].message_id
+            )
+        except Exception as e:
+            logger.error(f"Failed to index support chat messages of ticket {ticket.ticket_id}: {e}")
+    return True
+
+async def _send_to_email(ticket: Ticket, destination: Destination) -> bool:
+    # Почтовый стек (smtplib, email) загружается только при первой отправке письма
+    from modules.email_sender import send_email
+
+    # smtplib блокирующий — выполняется в отдельном потоке. Поток нельзя отменить, поэтому срок всей отправки
+    # соблюдает сам send_email: по таймауту письмо действительно не отправлено, а поток не зависает
+    await asyncio.to_thread(
+        send_email,
+        subject=ticket.subject,
+        to_address=destination.target,
+        text_body=ticket.text_summary,
+        html_body=ticket.html_body,
+        attachments=ticket.attachments,
+        timeout=destination.timeout or env_settings.delivery_timeout
+    )
+    logger.info(f"Ticket {ticket.ticket_id} from user {ticket.telegram_id} sent to {destination}")
+    return True
+
+_senders = {
+    CHAT: _send_to_chat,
+    EMAIL: _send_to_email,
+}
+
+async def _deliver(ticket: Ticket, destination: Destination) -> bool:
+    """
+    Отправка одному получателю. Ошибка или таймаут одного получателя не мешают остальным.
+    """
+    timeout = destination.timeout or env_settings.delivery_timeout
+    sender = _senders[destination.kind]
+    try:
+        if destination.kind == EMAIL:
+            # wait_for не остановил бы поток SMTP: письмо, посчитанное таймаутом, могло бы всё равно уйти
+            return await sender(ticket, destination)
+        return await asyncio.wait_for(sender(ticket, destination), timeout)
+    except (asyncio.TimeoutError, TimeoutError):
+        delivery_failures.inc(str(destination), "Timeout")
+        logger.error(f"Ticket {ticket.ticket_id} delivery to {destination} timed out after {timeout}s")
+    except Exception as e:
+        delivery_failures.inc(str(destination), type(e).__name__)
+        logger.error(f"Failed to deliver ticket {ticket.ticket_id} to {destination}: {e}")
+    return False
+
+async def _fanout(ticket: Ticket):
+    # Все получатели параллельно: ожидание пользователя — самый медленный из них, а не сумма
+    results = await asyncio.gather(*(_deliver(ticket, destination) for destination in ticket.destinations))
+    chat_results = [result for result, destination in zip(results, ticket.destinations) if destination.kind == CHAT]
+    _settle_duplicates(ticket, any(chat_results))
+    ticket.delivered = any(results)
+    elapsed = time.monotonic() - ticket.created_at
+    if ticket.delivered and ticket.sla_sec is not None and elapsed > ticket.sla_sec:
+        sla_breaches.inc(ticket.priority)
+        logger.warning(f"Ticket {ticket.ticket_id} ({ticket.topic}) delivered in {elapsed:.0f}s, SLA is {ticket.sla_sec}s")
+    # Вложения больше не нужны — не держим их в памяти до подтверждения
+    ticket.attachments = []
+
+async def _acknowledge(ticket: Ticket):
+    first = ticket.messages[0]
+    if ticket.delivered:
+        await first.reply_text(render_template("ticket_sent.txt"), reply_markup=ReplyKeyboardRemove())
+    else:
+        await first.reply_text("An unexpected error occurred. Please try again later.")
+    logger.info(f"Ticket {ticket.ticket_id} processed in {time.monotonic() - ticket.created_at:.2f}s")
+
+_handlers = {
+    "dedup": _dedup,
+    "enrich": _enrich,
+    "render": _render,
+    "fanout": _fanout,
+    "acknowledge": _acknowledge,
+}
+
+async def _stage_worker(stage: str, queue: asyncio.Queue, next_queue):
+    handler = _handlers[stage]
+    while True:
+        ticket = await queue.get()
+        target = next_queue
+        # Строки лога стадии помечаются идентификатором обращения
+        correlation_token = correlation_id.set(ticket.ticket_id)
+        span = resume_span(ticket.trace, stage, "stage")
+        error = None
+        try:
+            await handler(ticket)
+            # Схлопнутый дубликат получает подтверждение, как только исходное дошло до чата поддержки
+            if ticket.duplicate_of is not None and target is not None:
+                target = _queues["acknowledge"] if ticket.delivered else _PARKED
+        except Exception as e:
+            logger.exception(f"Ticket {ticket.ticket_id} failed at stage {stage}: {e}")
+            error = type(e).__name__
+            # Похожие, ждущие это обращение, не должны ждать его вечно
+            _settle_duplicates(ticket, False)
+            # Сломанное обращение сразу уходит на подтверждение с ошибкой
+            if target is not None:
+                target = _queues["acknowledge"]
+        finally:
+            if span is not None:
+                end_span(span, error)
+            correlation_id.reset(correlation_token)
+            queue.task_done()
+        if target is _PARKED:
+            continue
+        if target is None:
+            _in_flight.pop(ticket.ticket_id, None)
+            if ticket.trace is not None:
+                end_span(ticket.trace)
+        else:
+            # Ждём места в следующей очереди — так давление передаётся до intake
+            await target.put(ticket)
+
+def start_ticket_pipeline(bot: Bot) -> list:
+    """
+    Создаёт очереди стадий и запускает их воркеры.
+
+    @return Список задач, которые нужно отменить при остановке
+    """
+    global _bot
+    _bot = bot
+    for stage in STAGES:
+        _queues[stage] = TicketQueue(stage, maxsize=env_settings.pipeline_queue_size)
+
+    tasks = []
+    for index, stage in enumerate(STAGES):
+        next_queue = _queues[STAGES[index + 1]] if index + 1 < len(STAGES) else None
+        for _ in range(env_settings.pipeline_workers):
+            tasks.append(asyncio.create_task(_stage_worker(stage, _queues[stage], next_queue)))
+
+    logger.debug(f"Ticket pipeline started: {len(STAGES)} stages x {env_settings.pipeline_workers} workers")
+    return tasks
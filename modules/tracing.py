@@ -0,0 +1,146 @@
+import json
+import time
+import random
+import logging
+from contextvars import ContextVar
+from modules.settings import env_settings
+
+# Дочерний логгер: записи идут через общую очередь логов, но попадают только в TRACE_FILE
+TRACE_LOGGER_NAME = "tg_support_bot.trace"
+
+# Идентификатор апдейта или обращения — есть всегда, попадает в каждую строку лога
+correlation_id = ContextVar("correlation_id", default="-")
+# Текущий спан — только если трасса записывается
+_current_span = ContextVar("trace_span", default=None)
+
+_trace_logger = logging.getLogger(TRACE_LOGGER_NAME)
+_trace_logger.setLevel(logging.INFO)
+
+def tracing_enabled() -> bool:
+    return env_settings.trace_sample_rate > 0 or env_settings.trace_slow_ms > 0
+
+class Trace:
+    """
+    Дерево спанов одного апдейта или обращения. Пишется целиком, когда закрывается корневой спан.
+    """
+    __slots__ = ("trace_id", "parent_trace_id", "sampled", "wall_started", "attrs", "spans", "next_id")
+
+    def __init__(self, trace_id: str, sampled: bool, parent_trace_id: str = None, attrs: dict = None):
+        self.trace_id = trace_id
+        self.parent_trace_id = parent_trace_id
+        self.sampled = sampled
+        self.wall_started = time.time()
+        self.attrs = attrs or {}
+        self.spans = []
+        self.next_id = 0
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "kind", "started", "duration", "error", "token")
+
+    def __init__(self, trace: Trace, parent_id, name: str, kind: str):
+        self.trace = trace
+        self.span_id = trace.next_id
+        trace.next_id += 1
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.started = time.perf_counter()
+        self.duration = None
+        self.error = None
+        self.token = None
+
+def _should_sample() -> bool:
+    return env_settings.trace_sample_rate >= 1 or random.random() < env_settings.trace_sample_rate
+
+def start_trace(trace_id: str, name: str, activate: bool = True, **attrs):
+    """
+    Начинает трассу с корневым спаном.
+
+    Если трасса не попала в выборку TRACE_SAMPLE_RATE, она всё равно записывается при
+    TRACE_SLOW_MS > 0 — решение, писать ли её, принимается по длительности в конце.
+    Трасса, начатая внутри другой (обращение из апдейта), наследует её решение и ссылается на неё.
+
+    @param activate: False — не делать корневой спан текущим (трасса продолжится в другой задаче через resume_span)
+    @return Корневой спан или None, если трасса не записывается
+    """
+    parent = _current_span.get()
+    if parent is not None:
+        trace = Trace(trace_id, parent.trace.sampled, parent.trace.trace_id, attrs)
+    elif not tracing_enabled():
+        return None
+    else:
+        sampled = _should_sample()
+        if not sampled and env_settings.trace_slow_ms <= 0:
+            return None
+        trace = Trace(trace_id, sampled, attrs=attrs)
+
+    root = Span(trace, None, name, "root")
+    if activate:
+        root.token = _current_span.set(root)
+    return root
+
+def start_span(name: str, kind: str):
+    """
+    Открывает дочерний спан текущей трассы.
+
+    @return Спан или None, если текущий апдейт не трассируется (стоимость — одно чтение contextvar)
+    """
+    parent = _current_span.get()
+    if parent is None:
+        return None
+    span = Span(parent.trace, parent.span_id, name, kind)
+    span.token = _current_span.set(span)
+    return span
+
+def resume_span(root: Span, name: str, kind: str):
+    """
+    Открывает спан трассы, начатой в другой задаче (стадия конвейера обращений).
+    """
+    if root is None:
+        return None
+    span = Span(root.trace, root.span_id, name, kind)
+    span.token = _current_span.set(span)
+    return span
+
+def end_span(span: Span, error: str = None):
+    span.duration = time.perf_counter() - span.started
+    span.error = error
+    if span.token is not None:
+        _current_span.reset(span.token)
+        span.token = None
+    if span.parent_id is None:
+        _finish_trace(span)
+    else:
+        span.trace.spans.append(span)
+
+def _finish_trace(root: Span):
+    trace = root.trace
+    duration_ms = root.duration * 1000
+    slow = env_settings.trace_slow_ms > 0 and duration_ms >= env_settings.trace_slow_ms
+    # Трасса с ошибкой пишется, даже если не попала в выборку и не медленная
+    error = root.error or next((span.error for span in trace.spans if span.error), None)
+    if not (trace.sampled or slow or error):
+        return
+
+    spans = sorted(trace.spans, key=lambda span: span.started)
+    _trace_logger.info(json.dumps({
+        "trace_id": trace.trace_id,
+        "parent_trace_id": trace.parent_trace_id,
+        "name": root.name,
+        "start": round(trace.wall_started, 6),
+        "duration_ms": round(duration_ms, 3),
+        "error": error,
+        "attrs": trace.attrs,
+        "spans": [
+            {
+                "id": span.span_id,
+                "parent": span.parent_id,
+                "name": span.name,
+                "kind": span.kind,
+                "offset_ms": round((span.started - root.started) * 1000, 3),
+                "duration_ms": round(span.duration * 1000, 3),
+                "error": span.error,
+            }
+            for span in spans
+        ],
+    }, ensure_ascii=False, default=str))
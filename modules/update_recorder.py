@@ -0,0 +1,87 @@
+import re
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from telegram import Update
+from modules.settings import env_settings
+
+# Дочерний логгер: запись в файл идёт в потоке QueueListener, а не в цикле событий
+RECORD_LOGGER_NAME = "tg_support_bot.updates"
+
+EMAIL_PATTERN = re.compile(r"[^\s@]+@([^\s@]+\.[^\s@]+)")
+# Поля с текстом пользователя и его именем
+_TEXT_FIELDS = frozenset({"text", "caption"})
+_NAME_FIELDS = frozenset({"first_name", "last_name", "username"})
+
+_record_logger = logging.getLogger(RECORD_LOGGER_NAME)
+_record_logger.setLevel(logging.INFO)
+
+def recording_enabled() -> bool:
+    return bool(env_settings.update_record_file)
+
+def _pseudonym(value: str, length: int) -> str:
+    # Один и тот же адрес в записи всегда заменяется одинаково
+    digest = hashlib.blake2b(value.encode("utf-8"), digest_size=32).hexdigest()
+    return (digest * (length // len(digest) + 1))[:length]
+
+def _redact_email(match: re.Match) -> str:
+    local = match.group(0)[:match.start(1) - match.start(0) - 1]
+    return f"{_pseudonym(match.group(0).lower(), len(local))}@{match.group(1)}"
+
+def redact_text(text: str) -> str:
+    """
+    Заменяет текст заполнителем той же длины (смещения entities остаются верными).
+    Команда в начале сохраняется, у адресов сохраняются домен и длина, а локальная часть
+    заменяется хэшем — повторный ввод того же адреса и опечатки остаются различимы.
+    """
+    command = ""
+    if text.startswith("/"):
+        command, _, text = text.partition(" ")
+        command += " " if text else ""
+    parts = []
+    position = 0
+    for match in EMAIL_PATTERN.finditer(text):
+        parts.append(re.sub(r"\S", "x", text[position:match.start()]))
+        parts.append(_redact_email(match))
+        position = match.end()
+    parts.append(re.sub(r"\S", "x", text[position:]))
+    return command + "".join(parts)
+
+def redact(data):
+    """
+    Копия словаря апдейта без текста сообщений и имён пользователей.
+    """
+    if isinstance(data, dict):
+        redacted = {}
+        for key, value in data.items():
+            if key in _TEXT_FIELDS and isinstance(value, str):
+                redacted[key] = redact_text(value)
+            elif key in _NAME_FIELDS and isinstance(value, str):
+                redacted[key] = _pseudonym(value, 8)
+            else:
+                redacted[key] = redact(value)
+        return redacted
+    if isinstance(data, list):
+        return [redact(item) for item in data]
+    return data
+
+def record_update(update: Update):
+    data = update.to_dict()
+    if env_settings.update_record_redact:
+        data = redact(data)
+    _record_logger.info(json.dumps({"t": round(time.time(), 6), "update": data}, ensure_ascii=False))
+
+class UpdateRecordingQueue(asyncio.Queue):
+    """
+    Очередь апдейтов, которая записывает каждый апдейт в момент поступления
+    (до очереди обработки) — так в записи сохраняются настоящие всплески нагрузки.
+    """
+    async def put(self, item):
+        if isinstance(item, Update):
+            record_update(item)
+        await super().put(item)
+
+def create_update_queue() -> asyncio.Queue:
+    return UpdateRecordingQueue() if recording_enabled() else asyncio.Queue()
@@ -1,97 +1,221 @@
-import os
 import asyncio
-from dotenv import load_dotenv
-from telegram import BotCommand
-from telegram.ext import Application, ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
-from jinja2 import Environment, FileSystemLoader
-from rich.console import Console
-import colorlog
-from modules.template_engine import render_template
+from telegram.ext import Application, ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler, filters
+from modules.settings import env_settings
+from modules.template_engine import warm_up_templates
 from modules.routing import route_message, handle_inline_button
 from modules.common import handle_start_command, handle_help_command, handle_my_id_command
-from modules.admin_commands import handle_add_email, handle_ban_email, handle_remove_email, handle_check_email
+from modules.admin_commands import (
+    handle_add_email, handle_ban_email, handle_remove_email, handle_check_email, handle_reload_config,
+    handle_profile, handle_profile_stop, handle_memory_baseline, handle_memory_report, handle_memory_stop,
+    handle_allow_rule, handle_ban_rule, handle_remove_rule, handle_rules,
+    handle_add_admin, handle_remove_admin, handle_admins,
+)
 from modules.storage import db_init
-from modules.config import telegram_menu
+from modules.persistence import SQLiteSessionPersistence
+from modules.session import context_types, touch_session, session_eviction_loop
+from modules.fsm import MESSAGE_FILTER, SESSION_FILTER
+from modules.reply_relay import handle_support_reply, relay_enabled, relay_filter
+from modules.hot_reload import setup_bot_commands, config_watch_loop
 from modules.log_utils import log_async_call, log_sync_call
 from modules.logging_config import logger
 from modules.flow import check_media_group_expiry_loop
-
-# Консоль и логгер
-console = Console()
-
-# Загрузка .env
-load_dotenv()
-BOT_TOKEN = os.getenv("BOT_TOKEN")
+from modules.ticket_pipeline import start_ticket_pipeline, drain_ticket_pipeline
+from modules.sharding import run_supervisor
+from modules.telegram_request import InstrumentedRequest, api_base_urls
+from modules.metrics import serve_metrics
+from modules.loop_monitor import loop_lag_monitor
+from modules.tracing import correlation_id, start_trace, end_span
+from modules.update_recorder import UpdateRecordingQueue, recording_enabled
+from modules.allowlist import allowlist, allowlist_refresh_loop
+from modules.auth_utils import admin_roles, admin_roles_refresh_loop
 
 background_tasks = []
 
-@log_async_call
-async def setup_bot_commands(app: Application):
-    await app.bot.set_my_commands([
-        BotCommand(cmd["command"], cmd["description"]) for cmd in telegram_menu
-    ])
+class TracedApplication(Application):
+    """
+    Application, в котором каждый апдейт получает идентификатор для логов
+    и, если попал в выборку, трассу со спанами обработчиков, БД, шаблонов и вызовов API.
+    """
+    __slots__ = ()
 
-@log_async_call
-async def post_init(app: Application):
-    await setup_bot_commands(app)
+    async def process_update(self, update: object):
+        update_id = getattr(update, "update_id", None)
+        token = correlation_id.set(f"u{update_id}")
+        root = start_trace(f"u{update_id}", "update")
+        error = None
+        try:
+            await super().process_update(update)
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            if root is not None:
+                end_span(root, error)
+            correlation_id.reset(token)
+
+def start_background_tasks(app: Application):
+    if env_settings.loop_lag_threshold > 0:
+        # Первым, чтобы видеть остановки цикла и в остальных фоновых задачах
+        task = asyncio.create_task(loop_lag_monitor(app))
+        background_tasks.append(task)
+        logger.debug("Background task loop_lag_monitor started")
 
     # Запускаем фоновую задачу, но не через app.create_task
     task = asyncio.create_task(check_media_group_expiry_loop(app))
     background_tasks.append(task)
     logger.debug("Background task check_media_group_expiry_loop started")
 
+    task = asyncio.create_task(session_eviction_loop(app))
+    background_tasks.append(task)
+    logger.debug("Background task session_eviction_loop started")
+
+    if env_settings.config_watch_interval > 0:
+        task = asyncio.create_task(config_watch_loop(app))
+        background_tasks.append(task)
+        logger.debug("Background task config_watch_loop started")
+
+    if env_settings.allowlist_refresh_interval > 0:
+        task = asyncio.create_task(allowlist_refresh_loop(app))
+        background_tasks.append(task)
+        logger.debug("Background task allowlist_refresh_loop started")
+
+    if env_settings.admin_roles_refresh_interval > 0:
+        task = asyncio.create_task(admin_roles_refresh_loop(app))
+        background_tasks.append(task)
+        logger.debug("Background task admin_roles_refresh_loop started")
+
+    if env_settings.metrics_port > 0:
+        task = asyncio.create_task(serve_metrics())
+        background_tasks.append(task)
+        logger.debug("Background task serve_metrics started")
+
+    background_tasks.extend(start_ticket_pipeline(app.bot))
+
+def cancel_background_tasks():
+    for task in background_tasks:
+        if not task.done():
+            task.cancel()
+        coro = getattr(task, 'get_coro', lambda: None)()
+        name = getattr(coro, '__name__', 'unknown')
+        logger.debug(f"Cancelled task: {name}")
+    background_tasks.clear()
+
+@log_async_call
+async def post_init(app: Application):
+    await setup_bot_commands(app.bot)
+    start_background_tasks(app)
+
+@log_async_call
+async def post_stop(app: Application):
+    # Апдейты уже обработаны, бот ещё работает — дописываем принятые обращения до отмены воркеров конвейера
+    await drain_ticket_pipeline(env_settings.pipeline_drain_timeout)
+
+def command(name: str, callback) -> CommandHandler:
+    # Правка сообщения с командой не должна выполнять её повторно
+    return CommandHandler(name, callback, filters=filters.UpdateType.MESSAGE)
+
+def build_application(with_updater: bool = True) -> Application:
+    """
+    Собирает Application со всеми обработчиками.
+
+    @param with_updater: False для воркеров, которые получают апдейты от супервизора
+    """
+    builder = (
+        ApplicationBuilder()
+        .application_class(TracedApplication)
+        .token(env_settings.bot_token)
+        # Размер пула как у запроса по умолчанию в ApplicationBuilder
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .persistence(SQLiteSessionPersistence())
+        .context_types(context_types)
+        .post_init(post_init)
+        .post_stop(post_stop)
+    )
+    urls = api_base_urls()
+    if urls:
+        builder = builder.base_url(urls["base_url"]).base_file_url(urls["base_file_url"])
+    if not with_updater:
+        builder = builder.updater(None)
+    elif recording_enabled():
+        # Воркеры не пишут: при BOT_WORKERS > 1 апдейты записывает супервизор
+        builder = builder.update_queue(UpdateRecordingQueue())
+    app = builder.build()
+
+    warm_up_templates()
+    allowlist.reload()
+    admin_roles.reload()
+
+    # Апдейты вне таблицы состояний (стикеры, правки сообщений) не создают сессию и не читают БД
+    app.add_handler(MessageHandler(SESSION_FILTER, touch_session), group=-1)
+    app.add_handler(CallbackQueryHandler(touch_session), group=-1)
+    app.add_handler(command("start", handle_start_command))
+    app.add_handler(command("help", handle_help_command))
+    app.add_handler(command("myid", handle_my_id_command))
+    app.add_handler(command("add_email", handle_add_email))
+    app.add_handler(command("ban_email", handle_ban_email))
+    app.add_handler(command("remove_email", handle_remove_email))
+    app.add_handler(command("check_email", handle_check_email))
+    app.add_handler(command("allow_rule", handle_allow_rule))
+    app.add_handler(command("ban_rule", handle_ban_rule))
+    app.add_handler(command("remove_rule", handle_remove_rule))
+    app.add_handler(command("rules", handle_rules))
+    app.add_handler(command("add_admin", handle_add_admin))
+    app.add_handler(command("remove_admin", handle_remove_admin))
+    app.add_handler(command("admins", handle_admins))
+    app.add_handler(command("reload", handle_reload_config))
+    if env_settings.profiling_enabled:
+        # Без PROFILING_ENABLED команд профилирования нет вовсе, tracemalloc не включается
+        app.add_handler(command("profile", handle_profile))
+        app.add_handler(command("profile_stop", handle_profile_stop))
+        app.add_handler(command("memory_baseline", handle_memory_baseline))
+        app.add_handler(command("memory_report", handle_memory_report))
+        app.add_handler(command("memory_stop", handle_memory_stop))
+    if relay_enabled():
+        # Ответы сотрудников в чате поддержки идут пользователю, а не в FSM
+        app.add_handler(MessageHandler(relay_filter(), handle_support_reply))
+    app.add_handler(MessageHandler(MESSAGE_FILTER, route_message))
+    app.add_handler(CallbackQueryHandler(handle_inline_button))
+    return app
+
 # Запуск
 @log_sync_call
 def run_telegram_bot():
-    if not BOT_TOKEN:
+    if not env_settings.bot_token:
         logger.critical("BOT_TOKEN not set in .env")
-        console.print("[bold red]Error: BOT_TOKEN not set in .env[/bold red]")
         exit(1)
 
     logger.info("Starting Telegram bot...")
     db_init()
 
-    app = ApplicationBuilder().token(BOT_TOKEN).post_init(post_init).build()
-
-    app.add_handler(CommandHandler("start", handle_start_command))
-    app.add_handler(CommandHandler("help", handle_help_command))
-    app.add_handler(CommandHandler("myid", handle_my_id_command))
-    app.add_handler(CommandHandler("add_email", handle_add_email))
-    app.add_handler(CommandHandler("ban_email", handle_ban_email))
-    app.add_handler(CommandHandler("remove_email", handle_remove_email))
-    app.add_handler(CommandHandler("check_email", handle_check_email))
-    app.add_handler(MessageHandler(
-        (
-            filters.TEXT |
-            filters.PHOTO |
-            filters.Document.ALL |
-            filters.VIDEO |
-            filters.AUDIO |
-            filters.VOICE
-        ) & ~filters.COMMAND,
-        route_message
-    ))
-    app.add_handler(CallbackQueryHandler(handle_inline_button))
+    if env_settings.bot_workers > 1:
+        logger.info(f"Telegram bot is running with {env_settings.bot_workers} workers")
+        run_supervisor(env_settings.bot_token, env_settings.bot_workers)
+        return
 
-    console.print("[bold green]Telegram bot is running[/bold green]")
-    logger.info("Telegram bot is now polling for messages")
+    app = build_application()
 
     try:
-        app.run_polling(close_loop=False)
+        if env_settings.webhook_url:
+            logger.info(f"Telegram bot is now listening for webhook updates on {env_settings.webhook_listen}:{env_settings.webhook_port}")
+            app.run_webhook(
+                listen=env_settings.webhook_listen,
+                port=env_settings.webhook_port,
+                url_path=env_settings.webhook_path,
+                webhook_url=env_settings.webhook_url,
+                close_loop=False
+            )
+        else:
+            logger.info("Telegram bot is now polling for messages")
+            app.run_polling(close_loop=False)
     finally:
         logger.info("Bot is shutting down, cancelling background tasks...")
-        for task in background_tasks:
-            if not task.done():
-                task.cancel()
-            coro = getattr(task, 'get_coro', lambda: None)()
-            name = getattr(coro, '__name__', 'unknown')
-            logger.debug(f"Cancelled task: {name}")
+        cancel_background_tasks()
 
 if __name__ == "__main__":
     try:
         run_telegram_bot()
     except KeyboardInterrupt:
-        console.print("\n[yellow][!] Stopped by user (Ctrl+C).[/yellow]")
+        logger.info("Stopped by user (Ctrl+C)")
     finally:
         # 
         pass
\ No newline at end of file
@@ -0,0 +1,482 @@
+"""
+Микробенчмарки горячих путей бота и сравнение с сохранёнными результатами (baseline).
+
+Измеряются все функции modules/storage.py на базах с 1k, 100k и 1M пользователей и адресов,
+render_template для каждого шаблона из templates/, накладные расходы маршрутизации route_message
+и декораторов log_async_call / log_sync_call. Каждый вызов замеряется отдельно; в результатах —
+медиана, p95 и среднее в микросекундах.
+
+Запуск из корня проекта:
+    python tools/benchmark.py run --output baseline.json
+    python tools/benchmark.py run --sizes 1000 100000 --only storage templates --output current.json
+    python tools/benchmark.py run --compare baseline.json --threshold 0.15
+    python tools/benchmark.py compare baseline.json current.json --threshold 0.15
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+from types import SimpleNamespace
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GROUPS = ("storage", "templates", "routing", "decorators")
+DEFAULT_SIZES = (1_000, 100_000, 1_000_000)
+DEFAULT_THRESHOLD = 0.2
+DEFAULT_MIN_DELTA_US = 0.1
+FIRST_TELEGRAM_ID = 1_000_000
+NEW_TELEGRAM_ID = 50_000_000
+SUPPORT_CHAT_ID = -1000000000001
+ADMINS = 10
+# Значения переменных шаблонов; остальные получают строку SAMPLE_TEXT
+SAMPLE_TEXT = "Пример текста обращения"
+SAMPLE_CONTEXT = {
+    "username": "benchmark_user",
+    "telegram_username": "@benchmark_user",
+    "telegram_id": FIRST_TELEGRAM_ID,
+    "email": "user1@bench.test",
+    "old_email": "user1@bench.test",
+    "new_email": "user2@bench.test",
+    "emails": ["user1@bench.test", "user2@bench.test", "user3@bench.test"],
+    "topic": "Доступ",
+    "message": SAMPLE_TEXT * 20,
+    "max_length": 4000,
+    "max_requests": 5,
+    "interval_minutes": 60,
+    "wait_str": "5 мин",
+    "seconds": 30,
+    "samples": 6000,
+    "count": 3,
+    "running": True,
+    "profiling": True,
+    "sections": [("sessions", 1000, 512.0), ("pending_media_groups", 2, 10.5)],
+}
+
+def percentile(values: list, share: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(share * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def summarize(timings: list) -> dict:
+    # Время в микросекундах
+    return {
+        "median_us": round(percentile(timings, 0.5) * 1e6, 3),
+        "p95_us": round(percentile(timings, 0.95) * 1e6, 3),
+        "mean_us": round(sum(timings) / len(timings) * 1e6, 3),
+        "calls": len(timings),
+    }
+
+def measure(call, setup=None, min_time: float = 0.5, min_calls: int = 20, max_calls: int = 100_000) -> dict:
+    """
+    Вызывает call(*setup(i)) до тех пор, пока суммарное время вызовов не превысит min_time.
+    setup выполняется вне замера — в нём готовятся данные для разрушающих операций.
+    """
+    timings = []
+    spent = 0.0
+    i = 0
+    while i < max_calls and (i < min_calls or spent < min_time):
+        args = setup(i) if setup else ()
+        started = time.perf_counter()
+        call(*args)
+        elapsed = time.perf_counter() - started
+        timings.append(elapsed)
+        spent += elapsed
+        i += 1
+    return summarize(timings)
+
+async def measure_async(call, setup=None, min_time: float = 0.5, min_calls: int = 20, max_calls: int = 100_000) -> dict:
+    timings = []
+    spent = 0.0
+    i = 0
+    while i < max_calls and (i < min_calls or spent < min_time):
+        args = setup(i) if setup else ()
+        started = time.perf_counter()
+        await call(*args)
+        elapsed = time.perf_counter() - started
+        timings.append(elapsed)
+        spent += elapsed
+        i += 1
+    return summarize(timings)
+
+async def measure_batched(call, is_async: bool, min_time: float = 0.5, batch: int = 1000) -> dict:
+    """
+    Для вызовов в доли микросекунды: замеряется пачка из batch вызовов, а не каждый,
+    иначе результат определяет сам perf_counter().
+    """
+    for _ in range(batch):  # прогрев
+        if is_async:
+            await call()
+        else:
+            call()
+    timings = []
+    spent = 0.0
+    while len(timings) < 20 or spent < min_time:
+        started = time.perf_counter()
+        if is_async:
+            for _ in range(batch):
+                await call()
+        else:
+            for _ in range(batch):
+                call()
+        elapsed = time.perf_counter() - started
+        timings.append(elapsed / batch)
+        spent += elapsed
+    stats = summarize(timings)
+    stats["calls"] *= batch
+    return stats
+
+def configure_environment(workdir: str, log_level: str):
+    # Настройки читаются из окружения один раз при импорте модулей бота — задаём их заранее
+    os.environ["DB_PATH"] = os.path.join(workdir, "bench.sqlite3")
+    os.environ["LOG_FILE"] = os.path.join(workdir, "bench.log")
+    os.environ["TEMPLATE_CACHE_DIR"] = os.path.join(workdir, "jinja")
+    os.environ["LOG_LEVEL"] = log_level
+    os.environ.setdefault("BOT_TOKEN", "0:BENCHMARK")
+    os.chdir(PROJECT_DIR)
+    sys.path.insert(0, PROJECT_DIR)
+
+def seed_database(db_path: str, size: int):
+    """
+    Пересоздаёт базу: size адресов в allowed_emails, по пользователю, сессии и сообщению обращения
+    в чате поддержки на каждый адрес, ADMINS админов.
+    """
+    from modules import storage
+
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    storage.db_init()
+
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.executemany(
+            "INSERT INTO allowed_emails (id, email, is_banned) VALUES (?, ?, 0)",
+            ((i + 1, f"user{i}@bench.test") for i in range(size))
+        )
+        conn.executemany(
+            "INSERT INTO users (telegram_id, username, full_name, email_id, is_authorized, request_count) "
+            "VALUES (?, ?, ?, ?, 1, 0)",
+            ((FIRST_TELEGRAM_ID + i, f"user{i}", f"User {i}", i + 1) for i in range(size))
+        )
+        conn.executemany(
+            "INSERT INTO user_sessions (telegram_id, state, selected_topic, request_timestamp, request_count) "
+            "VALUES (?, 'IDLE', NULL, 0, 0)",
+            ((FIRST_TELEGRAM_ID + i,) for i in range(size))
+        )
+        conn.executemany(
+            "INSERT INTO admins (telegram_id, is_top_level) VALUES (?, 0)",
+            ((FIRST_TELEGRAM_ID + i,) for i in range(min(ADMINS, size)))
+        )
+        conn.executemany(
+            "INSERT INTO ticket_messages (chat_id, message_id, ticket_id, telegram_id, user_message_id) "
+            "VALUES (?, ?, ?, ?, ?)",
+            ((SUPPORT_CHAT_ID, i + 1, f"{i:012x}", FIRST_TELEGRAM_ID + i, i + 1) for i in range(size))
+        )
+        conn.commit()
+        conn.execute("ANALYZE")
+    finally:
+        conn.close()
+
+def storage_cases(size: int) -> list:
+    """
+    (имя функции, вызов, setup) для каждой функции modules/storage.py.
+    """
+    from modules import storage
+
+    rng = random.Random(size)
+
+    def email():
+        return f"user{rng.randrange(size)}@bench.test"
+
+    def telegram_id():
+        return FIRST_TELEGRAM_ID + rng.randrange(size)
+
+    def new_email(prefix: str):
+        return lambda i: (f"{prefix}{i}@bench.test",)
+
+    def added_email(prefix: str):
+        # Адрес добавляется вне замера, чтобы удаляющая операция каждый раз работала с существующей строкой
+        def setup(i):
+            address = f"{prefix}{i}@bench.test"
+            storage.db_add_allowed_email(address)
+            return (address,)
+        return setup
+
+    def added_admin(i):
+        storage.db_add_admin(NEW_TELEGRAM_ID + i)
+        return (NEW_TELEGRAM_ID + i,)
+
+    def ticket_message_batch(i):
+        return ([(SUPPORT_CHAT_ID, size + i * 3 + n + 1, f"new{i:09x}", NEW_TELEGRAM_ID + i, 1) for n in range(3)],)
+
+    def added_rule(i):
+        storage.db_add_allow_rule(f"removed{i}.bench.test")
+        return (f"removed{i}.bench.test",)
+
+    def session_batch(i):
+        return ([(telegram_id(), "WAITING_FOR_TOPIC", None, None, 0, 0) for _ in range(100)],)
+
+    return [
+        ("db_init", storage.db_init, None),
+        ("db_get_user_by_telegram_id", storage.db_get_user_by_telegram_id, lambda i: (telegram_id(),)),
+        ("db_get_users_by_email", storage.db_get_users_by_email, lambda i: (email(),)),
+        ("db_get_telegram_ids_by_email", storage.db_get_telegram_ids_by_email, lambda i: (email(),)),
+        ("db_get_email_by_id", storage.db_get_email_by_id, lambda i: (rng.randrange(size) + 1,)),
+        ("db_get_email_row", storage.db_get_email_row, lambda i: (email(),)),
+        ("db_is_admin", storage.db_is_admin, lambda i: (telegram_id(),)),
+        ("db_list_admins", storage.db_list_admins, None),
+        ("db_get_session", storage.db_get_session, lambda i: (telegram_id(),)),
+        ("db_add_allowed_email", storage.db_add_allowed_email, new_email("added")),
+        ("db_ban_allowed_email", storage.db_ban_allowed_email, lambda i: (email(),)),
+        ("db_unban_allowed_email", storage.db_unban_allowed_email, lambda i: (email(),)),
+        ("db_remove_allowed_email", storage.db_remove_allowed_email, added_email("removed")),
+        ("db_unlink_users_from_email", storage.db_unlink_users_from_email, added_email("unlinked")),
+        ("db_add_user", storage.db_add_user, lambda i: (email(), NEW_TELEGRAM_ID + i, f"new{i}", f"New {i}")),
+        ("db_update_user_email", storage.db_update_user_email, lambda i: (telegram_id(), email())),
+        ("db_add_admin", storage.db_add_admin, lambda i: (NEW_TELEGRAM_ID + size + i,)),
+        ("db_remove_admin", storage.db_remove_admin, added_admin),
+        ("db_save_sessions", storage.db_save_sessions, session_batch),
+        ("db_delete_sessions", storage.db_delete_sessions, lambda i: ([telegram_id() for _ in range(100)],)),
+        ("db_add_allow_rule", storage.db_add_allow_rule, lambda i: (f"added{i}.bench.test",)),
+        ("db_remove_allow_rule", storage.db_remove_allow_rule, added_rule),
+        ("db_list_allow_rules", storage.db_list_allow_rules, None),
+        ("db_allow_rules_version", storage.db_allow_rules_version, None),
+        ("db_add_ticket_messages", storage.db_add_ticket_messages, ticket_message_batch),
+        ("db_get_ticket_message", storage.db_get_ticket_message, lambda i: (SUPPORT_CHAT_ID, rng.randrange(size) + 1)),
+    ]
+
+def bench_storage(args, results: dict):
+    from modules.settings import env_settings
+
+    for size in args.sizes:
+        started = time.perf_counter()
+        seed_database(env_settings.db_path, size)
+        print(f"\nstorage, {size} users (seeded in {time.perf_counter() - started:.1f} s):")
+        for name, call, setup in storage_cases(size):
+            record(results, f"storage/{name}@{size}", measure(call, setup, args.min_time))
+
+def bench_templates(args, results: dict):
+    from jinja2 import meta
+    from modules.template_engine import env, render_template, warm_up_templates
+
+    # Как при запуске бота: шаблоны скомпилированы, шаблоны без переменных отрендерены заранее
+    warm_up_templates()
+    print("\ntemplates:")
+    for name in env.list_templates():
+        source = env.loader.get_source(env, name)[0]
+        variables = meta.find_undeclared_variables(env.parse(source))
+        context = {variable: SAMPLE_CONTEXT.get(variable, SAMPLE_TEXT) for variable in variables}
+        record(results, f"templates/{name}", measure(lambda: render_template(name, **context), min_time=args.min_time))
+
+def fake_update(text: str = "hello", media_group_id: str = None):
+    """
+    Минимальные Update и context для route_message: ответы бота никуда не отправляются.
+    """
+    from modules.session import UserSession
+
+    async def reply(*args, **kwargs):
+        return None
+
+    user = SimpleNamespace(id=FIRST_TELEGRAM_ID, first_name="Bench", username="bench")
+    message = SimpleNamespace(
+        text=text, caption=None, media_group_id=media_group_id, reply_text=reply,
+        # Поля, которые проверяют фильтры состояний modules/fsm.py
+        photo=None, document=None, video=None, audio=None, voice=None,
+    )
+    update = SimpleNamespace(
+        effective_user=user, effective_chat=SimpleNamespace(id=FIRST_TELEGRAM_ID),
+        message=message, effective_message=message, callback_query=None,
+        edited_message=None, channel_post=None, edited_channel_post=None,
+    )
+    context = SimpleNamespace(user_data=UserSession(), bot=SimpleNamespace(send_message=reply))
+    return update, context
+
+async def bench_routing(args, results: dict):
+    from modules.states import UserState
+    from modules.routing import route_message
+    from modules.media_group_buffer import pending_media_groups, media_group_timestamps
+
+    print("\nrouting:")
+
+    # Неизвестное состояние: route_message -> handle_unknown_message (кэшированный шаблон и отправка)
+    update, context = fake_update()
+    context.user_data.state = "BENCHMARK"
+    record(results, "routing/route_message:unknown_state",
+           await measure_async(route_message, lambda i: (update, context), args.min_time))
+
+    # Текст в ожидании кнопки обращения: route_message -> handle_request_button (лимит, клавиатура категорий)
+    update, context = fake_update()
+
+    def waiting_for_button(i):
+        context.user_data.state = UserState.WAITING_FOR_REQUEST_BUTTON
+        return update, context
+    record(results, "routing/route_message:request_button",
+           await measure_async(route_message, waiting_for_button, args.min_time))
+
+    # Сообщение медиагруппы, которая уже собирается: только буферизация
+    update, context = fake_update(text=None, media_group_id="bench")
+    context.user_data.state = UserState.WAITING_FOR_MESSAGE_TEXT
+
+    def buffered(i):
+        pending_media_groups["bench"].clear()
+        media_group_timestamps["bench"] = time.time()
+        return update, context
+    record(results, "routing/route_message:media_group_buffered",
+           await measure_async(route_message, buffered, args.min_time))
+    pending_media_groups.pop("bench", None)
+    media_group_timestamps.pop("bench", None)
+
+async def bench_decorators(args, results: dict):
+    from modules.log_utils import log_async_call, log_sync_call
+
+    async def async_noop():
+        return None
+
+    def sync_noop():
+        return None
+
+    print("\ndecorators:")
+    plain_async = await measure_batched(async_noop, True, args.min_time)
+    decorated_async = await measure_batched(log_async_call(async_noop), True, args.min_time)
+    plain_sync = await measure_batched(sync_noop, False, args.min_time)
+    decorated_sync = await measure_batched(log_sync_call(sync_noop), False, args.min_time)
+    record(results, "decorators/async_plain", plain_async)
+    record(results, "decorators/log_async_call", decorated_async)
+    record(results, "decorators/sync_plain", plain_sync)
+    record(results, "decorators/log_sync_call", decorated_sync)
+    print(f"  log_async_call overhead {decorated_async['median_us'] - plain_async['median_us']:.3f} us, "
+          f"log_sync_call overhead {decorated_sync['median_us'] - plain_sync['median_us']:.3f} us")
+
+def record(results: dict, name: str, stats: dict):
+    results[name] = stats
+    print(f"  {stats['median_us']:12.2f} us  p95 {stats['p95_us']:12.2f} us  {stats['calls']:7d} calls  {name}")
+
+def git_revision() -> str:
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_DIR,
+                                capture_output=True, text=True)
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+def run(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="tg_bot_bench_")
+    configure_environment(workdir, args.log_level)
+
+    results = {}
+
+    async def run_async():
+        if "routing" in args.only:
+            await bench_routing(args, results)
+        if "decorators" in args.only:
+            await bench_decorators(args, results)
+
+    try:
+        if "storage" in args.only:
+            bench_storage(args, results)
+        if "templates" in args.only:
+            bench_templates(args, results)
+        asyncio.run(run_async())
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "sizes": list(args.sizes),
+            "log_level": args.log_level,
+            "min_time": args.min_time,
+        },
+        "results": results,
+    }
+
+def compare(baseline: dict, current: dict, threshold: float, min_delta_us: float) -> int:
+    """
+    Сравнивает медианы. Регрессия — рост больше чем на threshold (доля) и больше чем на min_delta_us.
+
+    @return Число регрессий
+    """
+    print(f"\nBaseline {baseline['meta'].get('revision')} ({baseline['meta'].get('created')}) -> "
+          f"current {current['meta'].get('revision')} ({current['meta'].get('created')}), "
+          f"threshold {threshold * 100:.0f}%")
+    regressions = improvements = 0
+    for name, stats in sorted(current["results"].items()):
+        before = baseline["results"].get(name)
+        if before is None:
+            print(f"  {'new':>12}  {stats['median_us']:12.2f} us  {name}")
+            continue
+        old, new = before["median_us"], stats["median_us"]
+        change = (new - old) / old if old else 0.0
+        mark = ""
+        if change > threshold and new - old > min_delta_us:
+            mark = "  REGRESSION"
+            regressions += 1
+        elif change < -threshold and old - new > min_delta_us:
+            mark = "  improved"
+            improvements += 1
+        print(f"  {change * 100:+11.1f}%  {old:12.2f} -> {new:12.2f} us  {name}{mark}")
+
+    missing = sorted(set(baseline["results"]) - set(current["results"]))
+    if missing:
+        print(f"\nNot measured in current run: {len(missing)} (e.g. {missing[0]})")
+    print(f"\n{regressions} regression(s), {improvements} improvement(s)")
+    return regressions
+
+def load(path: str) -> dict:
+    with open(path, encoding="utf-8") as source:
+        return json.load(source)
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Storage, template, routing and decorator microbenchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Выполнить бенчмарки")
+    run_parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES),
+                            help="Размеры базы (число пользователей и адресов)")
+    run_parser.add_argument("--only", nargs="+", choices=GROUPS, default=list(GROUPS))
+    run_parser.add_argument("--min-time", type=float, default=0.5,
+                            help="Минимальное суммарное время замера одной функции, с")
+    run_parser.add_argument("--log-level", default="WARNING",
+                            help="LOG_LEVEL бота во время замера (INFO добавляет стоимость записей лога)")
+    run_parser.add_argument("--output", help="Сохранить результаты в JSON (например, как baseline)")
+    run_parser.add_argument("--compare", help="Сразу сравнить с этим baseline")
+
+    compare_parser = commands.add_parser("compare", help="Сравнить два файла результатов")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+
+    for sub in (run_parser, compare_parser):
+        sub.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                         help="Допустимый рост медианы (доля), выше — регрессия")
+        sub.add_argument("--min-delta-us", type=float, default=DEFAULT_MIN_DELTA_US,
+                         help="Рост меньше этого (мкс) не считается регрессией — шум быстрых вызовов")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        regressions = compare(load(args.baseline), load(args.current), args.threshold, args.min_delta_us)
+        return 1 if regressions else 0
+
+    # Пути из командной строки — относительно каталога запуска, а замер идёт из корня проекта
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = load(args.compare) if args.compare else None
+    current = run(args)
+    if output:
+        with open(output, "w", encoding="utf-8") as target:
+            json.dump(current, target, indent=2, ensure_ascii=False)
+        print(f"\nResults written to {output}")
+    if baseline is not None:
+        return 1 if compare(baseline, current, args.threshold, args.min_delta_us) else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+"""
+Проверка времени запуска: импортирует модуль бота в чистом интерпретаторе
+с python -X importtime и завершается с кодом 1, если медианное время импорта
+превышает бюджет или при старте загружены модули, которые должны грузиться лениво.
+
+Запуск из корня проекта:
+    python tools/check_import_time.py
+    python tools/check_import_time.py --budget-ms 500 --runs 7 --top 15
+"""
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+
+DEFAULT_MODULE = "telegram_bot"
+DEFAULT_BUDGET_MS = 800
+DEFAULT_RUNS = 5
+# Тяжёлые необязательные зависимости, которые не должны импортироваться при старте
+DEFAULT_FORBIDDEN = ("rich", "smtplib")
+
+def measure(module: str) -> dict:
+    """
+    Один импорт в отдельном процессе.
+
+    @return Словарь имя модуля -> (собственное время, накопленное время) в микросекундах
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr}")
+
+    timings = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        if not self_us.strip().isdigit():
+            continue  # строка заголовка
+        timings[name.strip()] = (int(self_us), int(cumulative_us))
+    return timings
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Import-time budget check")
+    parser.add_argument("--module", default=DEFAULT_MODULE)
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("IMPORT_TIME_BUDGET_MS", DEFAULT_BUDGET_MS)))
+    parser.add_argument("--runs", type=int, default=DEFAULT_RUNS)
+    parser.add_argument("--top", type=int, default=10, help="Сколько самых тяжёлых модулей показать")
+    parser.add_argument("--forbid", nargs="*", default=list(DEFAULT_FORBIDDEN),
+                        help="Модули, которые не должны импортироваться при старте")
+    args = parser.parse_args()
+
+    runs = [measure(args.module) for _ in range(args.runs)]
+    totals_ms = [run[args.module][1] / 1000 for run in runs]
+    median_ms = statistics.median(totals_ms)
+
+    print(f"import {args.module}: median {median_ms:.1f} ms over {args.runs} runs "
+          f"(min {min(totals_ms):.1f}, max {max(totals_ms):.1f}), budget {args.budget_ms:.0f} ms")
+
+    last = runs[-1]
+    print(f"\nTop {args.top} modules by self time:")
+    heaviest = sorted(last.items(), key=lambda item: item[1][0], reverse=True)[:args.top]
+    for name, (self_us, cumulative_us) in heaviest:
+        print(f"  {self_us / 1000:8.1f} ms  (cumulative {cumulative_us / 1000:8.1f} ms)  {name}")
+
+    failed = False
+    loaded = [
+        forbidden for forbidden in args.forbid
+        if any(name == forbidden or name.startswith(forbidden + ".") for name in last)
+    ]
+    if loaded:
+        print(f"\nFAIL: modules that must be imported lazily were loaded at startup: {', '.join(loaded)}")
+        failed = True
+    if median_ms > args.budget_ms:
+        print(f"\nFAIL: import time {median_ms:.1f} ms exceeds budget {args.budget_ms:.0f} ms")
+        failed = True
+
+    if not failed:
+        print("\nOK")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,514 @@
+"""
+Нагрузочный тест без сети: фейковый Bot API (getUpdates, sendMessage, sendMediaGroup, getFile
+и скачивание файлов), приёмник SMTP и синтетические пользователи, которые проходят полный сценарий
+/start -> email -> кнопка «Отправить обращение» -> категория -> сообщение.
+
+Бот запускается отдельным процессом (telegram_bot.run_telegram_bot) во временном каталоге с копией
+config/ и templates/ и с TELEGRAM_API_URL, указывающим на фейковый сервер. Всё работает на localhost.
+
+Запуск из корня проекта:
+    python tools/load_test.py --users 200 --rate 20
+    python tools/load_test.py --users 500 --rate 50 --photo-ratio 0.2 --album-ratio 0.1 --json results.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from collections import defaultdict
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import yaml
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN = "123456:LOADTEST"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "LoadTestBot", "username": "load_test_bot"}
+SUPPORT_CHAT_ID = -1000000000001
+SUPPORT_EMAIL = "support@loadtest.local"
+USER_EMAIL = "loadtest@example.com"
+FIRST_USER_ID = 10_000_000
+ERROR_PREFIX = "An unexpected error occurred"
+
+STAGES = ("start", "auth", "request_button", "topic", "submit", "delivery", "ticket_total")
+
+def percentile(values: list, share: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(share * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+class FakeBotApi:
+    """
+    Минимальный HTTP/1.1-сервер Bot API. Апдейты синтетических пользователей отдаются через
+    long polling getUpdates, а сообщения бота раскладываются по входящим ящикам чатов.
+    """
+    def __init__(self, file_size: int):
+        self.file_size = file_size
+        self.updates = []
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.new_update = asyncio.Event()
+        self.inboxes = defaultdict(asyncio.Queue)
+        self.calls = defaultdict(int)
+        self.support_messages = 0
+        self.polling = asyncio.Event()
+
+    # Апдейты от пользователей
+
+    def message_id(self) -> int:
+        self.next_message_id += 1
+        return self.next_message_id
+
+    def push_update(self, payload: dict):
+        payload["update_id"] = self.next_update_id
+        self.next_update_id += 1
+        self.updates.append(payload)
+        self.new_update.set()
+
+    async def get_updates(self, params: dict) -> list:
+        self.polling.set()
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        limit = int(params.get("limit") or 100)
+        # offset подтверждает все апдейты с меньшим номером
+        self.updates = [update for update in self.updates if update["update_id"] >= offset]
+        if not self.updates and timeout > 0:
+            self.new_update.clear()
+            try:
+                await asyncio.wait_for(self.new_update.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:limit]
+
+    # Ответы бота
+
+    def bot_message(self, params: dict, **content) -> dict:
+        chat_id = int(params["chat_id"])
+        message = {
+            "message_id": self.message_id(),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "from": BOT_USER,
+            **content,
+        }
+        if "reply_markup" in params:
+            # Как и Telegram, в ответе возвращается только inline-клавиатура
+            markup = json.loads(params["reply_markup"])
+            if "inline_keyboard" in markup:
+                message["reply_markup"] = markup
+        if chat_id == SUPPORT_CHAT_ID:
+            self.support_messages += 1
+        else:
+            self.inboxes[chat_id].put_nowait(message)
+        return message
+
+    async def call(self, method: str, params: dict):
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return await self.get_updates(params)
+        if method == "getMe":
+            return BOT_USER
+        if method == "sendMessage":
+            return self.bot_message(params, text=params.get("text", ""))
+        if method in ("sendPhoto", "sendDocument", "sendVideo", "sendVoice", "sendAudio"):
+            return self.bot_message(params, caption=params.get("caption", ""))
+        if method == "sendMediaGroup":
+            media = json.loads(params.get("media", "[]"))
+            return [self.bot_message(params, caption="") for _ in media]
+        if method == "getFile":
+            file_id = params["file_id"]
+            return {"file_id": file_id, "file_unique_id": file_id, "file_size": self.file_size, "file_path": f"photos/{file_id}.jpg"}
+        # deleteWebhook, setMyCommands, answerCallbackQuery и прочее
+        return True
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                verb, target = request_line.decode("latin-1").split()[:2]
+                # PTB кодирует «:» токена в пути файла как %3A
+                path = unquote(urlsplit(target).path)
+                if verb == "GET" and path.startswith(f"/file/bot{TOKEN}/"):
+                    status, content_type, payload = "200 OK", "application/octet-stream", os.urandom(self.file_size)
+                else:
+                    method = path.rsplit("/", 1)[-1]
+                    params = {}
+                    if headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+                        params = {key: values[0] for key, values in parse_qs(body.decode("utf-8")).items()}
+                    elif headers.get("content-type", "").startswith("application/json") and body:
+                        params = json.loads(body)
+                    result = await self.call(method, params)
+                    status, content_type = "200 OK", "application/json"
+                    payload = json.dumps({"ok": True, "result": result}).encode("utf-8")
+
+                writer.write(
+                    f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                    f"Content-Length: {len(payload)}\r\n\r\n".encode("latin-1") + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # CancelledError — незавершённый long polling остановленного бота при выходе
+            pass
+        finally:
+            writer.close()
+
+class SmtpSink:
+    """
+    Приёмник SMTP без TLS: принимает любую авторизацию и считает письма.
+    """
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        def reply(line: str):
+            writer.write((line + "\r\n").encode("ascii"))
+
+        reply("220 loadtest ESMTP")
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode("utf-8", "replace").strip()
+                verb = command.split(" ", 1)[0].upper()
+                if verb == "EHLO":
+                    reply("250-loadtest")
+                    reply("250-AUTH PLAIN LOGIN")
+                    reply("250 8BITMIME")
+                elif verb == "AUTH":
+                    reply("235 Authentication successful")
+                elif verb == "DATA":
+                    reply("354 End data with <CR><LF>.<CR><LF>")
+                    await writer.drain()
+                    size = 0
+                    while True:
+                        data_line = await reader.readline()
+                        if data_line in (b".\r\n", b".\n", b""):
+                            break
+                        size += len(data_line)
+                    self.messages += 1
+                    self.bytes += size
+                    reply("250 OK")
+                elif verb == "QUIT":
+                    reply("221 Bye")
+                    await writer.drain()
+                    break
+                else:
+                    # HELO, MAIL, RCPT, RSET, NOOP
+                    reply("250 OK")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+class SyntheticUser:
+    def __init__(self, index: int, api: FakeBotApi, timeout: float, stats: dict, errors: dict):
+        self.user_id = FIRST_USER_ID + index
+        self.user = {"id": self.user_id, "is_bot": False, "first_name": f"User{index}", "username": f"loadtest_user_{index}"}
+        self.api = api
+        self.timeout = timeout
+        self.stats = stats
+        self.errors = errors
+        self.inbox = api.inboxes[self.user_id]
+
+    def _message(self, **content) -> dict:
+        return {
+            "message_id": self.api.message_id(),
+            "date": int(time.time()),
+            "chat": {"id": self.user_id, "type": "private", "first_name": self.user["first_name"]},
+            "from": self.user,
+            **content,
+        }
+
+    def send_text(self, text: str, entities: list = None):
+        message = self._message(text=text)
+        if entities:
+            message["entities"] = entities
+        self.api.push_update({"message": message})
+
+    def send_photo(self, caption: str, media_group_id: str = None):
+        file_id = f"photo{self.api.message_id()}"
+        message = self._message(
+            caption=caption,
+            photo=[{"file_id": file_id, "file_unique_id": file_id, "width": 1280, "height": 960, "file_size": self.api.file_size}]
+        )
+        if media_group_id:
+            message["media_group_id"] = media_group_id
+        self.api.push_update({"message": message})
+
+    def press(self, message: dict, data: str):
+        self.api.push_update({"callback_query": {
+            "id": str(self.api.message_id()),
+            "from": self.user,
+            "message": message,
+            "chat_instance": str(self.user_id),
+            "data": data,
+        }})
+
+    async def expect(self, stage: str, started: float, predicate=None) -> dict:
+        """
+        Ждёт сообщение бота, подходящее под predicate, и записывает задержку стадии.
+
+        @raise RuntimeError: Таймаут или сообщение об ошибке от бота
+        """
+        deadline = started + self.timeout
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                self.errors[stage]["timeout"] += 1
+                raise RuntimeError(f"{stage}: timeout")
+            try:
+                message = await asyncio.wait_for(self.inbox.get(), remaining)
+            except asyncio.TimeoutError:
+                continue
+            if message.get("text", "").startswith(ERROR_PREFIX):
+                self.errors[stage]["bot_error"] += 1
+                raise RuntimeError(f"{stage}: bot error")
+            if predicate is None or predicate(message):
+                self.stats[stage].append((time.perf_counter() - started) * 1000)
+                return message
+
+    async def run(self, media: str, album_size: int):
+        started = time.perf_counter()
+        self.send_text("/start", [{"type": "bot_command", "offset": 0, "length": 6}])
+        await self.expect("start", started)
+
+        stage_started = time.perf_counter()
+        self.send_text(USER_EMAIL)
+        welcome = await self.expect("auth", stage_started, lambda message: _buttons(message))
+
+        stage_started = time.perf_counter()
+        self.press(welcome, _buttons(welcome)[0])
+        topics = await self.expect("request_button", stage_started, lambda message: _buttons(message))
+
+        stage_started = time.perf_counter()
+        self.press(topics, random.choice(_buttons(topics)))
+        await self.expect("topic", stage_started)
+
+        submitted = time.perf_counter()
+        text = f"Load test ticket from user {self.user_id}: " + "lorem ipsum " * random.randint(5, 50)
+        if media == "album":
+            group_id = f"album{self.user_id}"
+            for _ in range(album_size):
+                self.send_photo(text, group_id)
+        elif media == "photo":
+            self.send_photo(text)
+        else:
+            self.send_text(text)
+        await self.expect("submit", submitted)
+
+        stage_started = time.perf_counter()
+        await self.expect("delivery", stage_started)
+        self.stats["ticket_total"].append((time.perf_counter() - submitted) * 1000)
+
+def _buttons(message: dict) -> list:
+    markup = message.get("reply_markup") or {}
+    return [button["callback_data"] for row in markup.get("inline_keyboard", []) for button in row if "callback_data" in button]
+
+def prepare_workdir(workdir: str, keep_config: bool, project_dir: str = PROJECT_DIR):
+    """
+    Копия config/ и templates/: бот читает их по относительным путям. По умолчанию
+    убираются пауза после авторизации и лимиты, чтобы мерить сам бот, а не ограничения.
+
+    @param project_dir: Каталог проверяемой версии бота (по умолчанию текущий проект)
+    """
+    shutil.copytree(os.path.join(project_dir, "templates"), os.path.join(workdir, "templates"))
+    shutil.copytree(os.path.join(project_dir, "config"), os.path.join(workdir, "config"))
+    if keep_config:
+        return
+
+    auth_path = os.path.join(workdir, "config", "auth.yaml")
+    with open(auth_path, encoding="utf-8") as source:
+        auth = yaml.safe_load(source)
+    auth["auth"]["delay_after_auth_success"] = 0
+    with open(auth_path, "w", encoding="utf-8") as target:
+        yaml.safe_dump(auth, target, allow_unicode=True)
+
+    ui_path = os.path.join(workdir, "config", "ui_config.yaml")
+    with open(ui_path, encoding="utf-8") as source:
+        ui_config = yaml.safe_load(source)
+    limits = ui_config["message_limits"]
+    limits["max_requests"] = 1_000_000
+    for scope in ("topic", "global"):
+        if isinstance(limits.get(scope), dict):
+            limits[scope]["max_requests"] = 1_000_000
+    with open(ui_path, "w", encoding="utf-8") as target:
+        yaml.safe_dump(ui_config, target, allow_unicode=True)
+
+def bot_environment(workdir: str, api_port: int, smtp_port: int, workers: int, project_dir: str = PROJECT_DIR) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": project_dir + os.pathsep + env.get("PYTHONPATH", ""),
+        "BOT_TOKEN": TOKEN,
+        "BOT_WORKERS": str(workers),
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{api_port}",
+        # Пустое значение не даёт .env проекта включить webhook
+        "WEBHOOK_URL": "",
+        "SUPPORT_CHAT_ID": str(SUPPORT_CHAT_ID),
+        "SUPPORT_EMAIL": SUPPORT_EMAIL,
+        "EMAIL_SENDER": "bot@loadtest.local",
+        "EMAIL_PASSWORD": "loadtest",
+        "SMTP_SERVER": "127.0.0.1",
+        "SMTP_PORT": str(smtp_port),
+        "SMTP_STARTTLS": "0",
+        # Тексты синтетических обращений почти одинаковы — без этого они схлопнулись бы в одно
+        "DEDUP_WINDOW": "0",
+        "DB_PATH": os.path.join(workdir, "database", "db.sqlite3"),
+        "LOG_FILE": os.path.join(workdir, "logs", "bot.log"),
+        "TEMPLATE_CACHE_DIR": os.path.join(workdir, ".cache", "jinja"),
+        "ROOT_ADMIN_ID": "0",
+        "METRICS_PORT": env.get("METRICS_PORT", "0"),
+    })
+    return env
+
+def seed_database(workdir: str, env: dict):
+    result = subprocess.run(
+        [sys.executable, "-c",
+         "from modules.storage import db_init, db_add_allowed_email\n"
+         f"db_init()\ndb_add_allowed_email({USER_EMAIL!r})"],
+        cwd=workdir, env=env, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Database seeding failed:\n{result.stderr}")
+
+def report(stats: dict, errors: dict, users: int, elapsed: float, api: FakeBotApi, smtp: SmtpSink) -> dict:
+    completed = len(stats["ticket_total"])
+    result = {
+        "users": users,
+        "completed": completed,
+        "elapsed_sec": round(elapsed, 3),
+        "tickets_per_sec": round(completed / elapsed, 3) if elapsed > 0 else 0.0,
+        "stages": {},
+        "errors": {stage: dict(kinds) for stage, kinds in errors.items() if kinds},
+        "support_chat_messages": api.support_messages,
+        "emails": smtp.messages,
+        "api_calls": dict(api.calls),
+    }
+    print(f"\nUsers: {users}, completed tickets: {completed}, elapsed {elapsed:.1f}s, "
+          f"throughput {result['tickets_per_sec']:.2f} tickets/s")
+    print(f"Support chat messages: {api.support_messages}, emails received: {smtp.messages} ({smtp.bytes / 1024:.0f} KiB)")
+    print(f"\n{'stage':<16}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'errors':>8}")
+    for stage in STAGES:
+        values = stats.get(stage) or []
+        failed = sum(errors[stage].values())
+        if not values and not failed:
+            continue
+        row = {"count": len(values), "errors": failed}
+        if values:
+            row.update(p50=percentile(values, 0.5), p95=percentile(values, 0.95), p99=percentile(values, 0.99), max=max(values))
+            print(f"{stage:<16}{len(values):>7}{row['p50']:>10.1f}{row['p95']:>10.1f}{row['p99']:>10.1f}{row['max']:>10.1f}{failed:>8}")
+        else:
+            print(f"{stage:<16}{0:>7}{'-':>10}{'-':>10}{'-':>10}{'-':>10}{failed:>8}")
+        result["stages"][stage] = row
+    error_rate = 1 - completed / users if users else 0.0
+    result["error_rate"] = round(error_rate, 4)
+    print(f"\nError rate: {100 * error_rate:.1f}%")
+    return result
+
+async def run(args) -> int:
+    api = FakeBotApi(args.file_size)
+    smtp = SmtpSink()
+    api_server = await asyncio.start_server(api.handle, "127.0.0.1", 0)
+    smtp_server = await asyncio.start_server(smtp.handle, "127.0.0.1", 0)
+    api_port = api_server.sockets[0].getsockname()[1]
+    smtp_port = smtp_server.sockets[0].getsockname()[1]
+
+    workdir = tempfile.mkdtemp(prefix="tg_bot_load_")
+    bot = None
+    try:
+        prepare_workdir(workdir, args.keep_config)
+        env = bot_environment(workdir, api_port, smtp_port, args.workers)
+        seed_database(workdir, env)
+
+        with open(os.path.join(workdir, "bot.out"), "wb") as output:
+            bot = subprocess.Popen(
+                [sys.executable, "-c", "import telegram_bot; telegram_bot.run_telegram_bot()"],
+                cwd=workdir, env=env, stdout=output, stderr=subprocess.STDOUT
+            )
+        print(f"Fake Bot API on 127.0.0.1:{api_port}, SMTP sink on 127.0.0.1:{smtp_port}, bot pid {bot.pid}, workdir {workdir}")
+
+        try:
+            await asyncio.wait_for(api.polling.wait(), args.startup_timeout)
+        except asyncio.TimeoutError:
+            print(f"Bot did not start polling within {args.startup_timeout}s, see {workdir}/bot.out")
+            return 1
+
+        stats = defaultdict(list)
+        errors = defaultdict(lambda: defaultdict(int))
+        tasks = []
+        started = time.perf_counter()
+        for index in range(args.users):
+            # Равномерный поток новых пользователей с частотой --rate в секунду
+            delay = started + index / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            roll = random.random()
+            media = "album" if roll < args.album_ratio else "photo" if roll < args.album_ratio + args.photo_ratio else "text"
+            user = SyntheticUser(index, api, args.timeout, stats, errors)
+            tasks.append(asyncio.create_task(user.run(media, args.album_size)))
+
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        elapsed = time.perf_counter() - started
+        for result in results:
+            if isinstance(result, Exception) and not isinstance(result, RuntimeError):
+                errors["driver"][type(result).__name__] += 1
+
+        # Письма уходят параллельно подтверждению — даём им дойти до приёмника
+        await asyncio.sleep(1)
+        summary = report(stats, errors, args.users, elapsed, api, smtp)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as target:
+                json.dump(summary, target, indent=2)
+            print(f"Results written to {args.json}")
+        return 0 if summary["error_rate"] <= args.max_error_rate else 1
+    finally:
+        if bot is not None and bot.poll() is None:
+            bot.terminate()
+            try:
+                bot.wait(10)
+            except subprocess.TimeoutExpired:
+                bot.kill()
+        api_server.close()
+        smtp_server.close()
+        if args.keep_workdir:
+            print(f"Workdir kept: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Offline end-to-end load test")
+    parser.add_argument("--users", type=int, default=100, help="Сколько синтетических пользователей пройдут сценарий")
+    parser.add_argument("--rate", type=float, default=10.0, help="Новых пользователей в секунду")
+    parser.add_argument("--workers", type=int, default=1, help="BOT_WORKERS для запускаемого бота")
+    parser.add_argument("--photo-ratio", type=float, default=0.0, help="Доля обращений с одним фото")
+    parser.add_argument("--album-ratio", type=float, default=0.0, help="Доля обращений-медиагрупп")
+    parser.add_argument("--album-size", type=int, default=3)
+    parser.add_argument("--file-size", type=int, default=64 * 1024, help="Размер файла, отдаваемого getFile, в байтах")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Таймаут ожидания ответа бота на стадии, с")
+    parser.add_argument("--startup-timeout", type=float, default=30.0)
+    parser.add_argument("--max-error-rate", type=float, default=0.0, help="Код выхода 1, если доля ошибок выше")
+    parser.add_argument("--keep-config", action="store_true", help="Не снимать лимиты и паузу после авторизации")
+    parser.add_argument("--keep-workdir", action="store_true", help="Оставить временный каталог с логами и БД")
+    parser.add_argument("--json", help="Записать результаты в JSON-файл")
+    args = parser.parse_args()
+    return asyncio.run(run(args))
+
+if __name__ == "__main__":
+    sys.exit(main())
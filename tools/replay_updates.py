@@ -0,0 +1,364 @@
+"""
+Воспроизведение записанного потока апдейтов (UPDATE_RECORD_FILE) против фейкового Bot API
+и приёмника SMTP из tools/load_test.py и сравнение ответов и задержек двух версий бота.
+
+Апдейты подаются в исходном темпе, ускоренно (--speed 4) или без пауз (--speed 0).
+Все отправители из записи заранее заводятся в базе как авторизованные пользователи.
+
+Запуск из корня проекта:
+    python tools/replay_updates.py run logs/updates.jsonl.gz --json before.json
+    python tools/replay_updates.py run logs/updates.jsonl.gz --project ../bot-new --speed 0 --json after.json
+    python tools/replay_updates.py compare before.json after.json --threshold 0.2
+"""
+import os
+import re
+import sys
+import json
+import gzip
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from collections import defaultdict
+
+from load_test import (
+    PROJECT_DIR, SUPPORT_CHAT_ID, FakeBotApi, SmtpSink, percentile, prepare_workdir, bot_environment,
+)
+
+REPLAY_EMAIL = "replay@example.com"
+EMAIL_PATTERN = re.compile(r"[^\s@]+@[^\s@]+\.[^\s@]+")
+DIGITS = re.compile(r"\d+")
+# Идентификатор обращения (uuid4().hex[:12]) случаен в каждом прогоне
+TICKET_ID = re.compile(r"\b[0-9a-f]{12}\b")
+# Вызовы, которые не являются ответом пользователю
+SERVICE_METHODS = frozenset({"getUpdates", "getMe", "getFile", "deleteWebhook", "setMyCommands", "close", "logOut"})
+SEED_SCRIPT = """
+import sys, json
+from modules.storage import db_init, db_add_allowed_email, db_add_user
+with open(sys.argv[1], encoding="utf-8") as source:
+    seed = json.load(source)
+db_init()
+for email in seed["emails"]:
+    db_add_allowed_email(email)
+for telegram_id in seed["users"]:
+    db_add_user(seed["user_email"], telegram_id)
+"""
+
+def read_records(path: str) -> list:
+    records = []
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as source:
+        try:
+            for number, line in enumerate(source, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    print(f"{path}:{number}: skipped malformed line", file=sys.stderr)
+        except EOFError:
+            # Файл бота, который ещё пишет или был остановлен без закрытия
+            print(f"{path}: truncated gzip stream, using {len(records)} complete records", file=sys.stderr)
+    return records
+
+def update_body(update: dict) -> tuple:
+    # (тип апдейта, объект) — message, callback_query и т. д.
+    for key, value in update.items():
+        if key != "update_id" and isinstance(value, dict):
+            return key, value
+    return None, {}
+
+def update_chat(update: dict):
+    kind, body = update_body(update)
+    chat = body.get("chat") or (body.get("message") or {}).get("chat") or body.get("from") or {}
+    return chat.get("id")
+
+def stream_seed(records: list, allow_stream_emails: bool) -> dict:
+    users = set()
+    emails = set()
+    for record in records:
+        kind, body = update_body(record["update"])
+        sender = body.get("from") or {}
+        if sender.get("id") and not sender.get("is_bot"):
+            users.add(sender["id"])
+        if allow_stream_emails and kind == "message":
+            emails.update(match.lower() for match in EMAIL_PATTERN.findall(body.get("text") or ""))
+    return {"users": sorted(users), "emails": sorted(emails | {REPLAY_EMAIL}), "user_email": REPLAY_EMAIL}
+
+class ReplayBotApi(FakeBotApi):
+    """
+    Фейковый Bot API, который запоминает время подачи каждого апдейта и все ответы бота по чатам.
+    """
+    def __init__(self, file_size: int):
+        super().__init__(file_size)
+        self.pushed = []        # (время подачи, чат)
+        self.outputs = []       # (время, чат, метод, текст)
+        self.callback_chats = {}
+
+    def replay(self, update: dict):
+        payload = {key: value for key, value in update.items() if key != "update_id"}
+        chat_id = update_chat(update)
+        kind, body = update_body(update)
+        if kind == "callback_query":
+            self.callback_chats[str(body.get("id"))] = chat_id
+        self.pushed.append((time.perf_counter(), chat_id))
+        self.push_update(payload)
+
+    async def call(self, method: str, params: dict):
+        if method not in SERVICE_METHODS:
+            if "chat_id" in params:
+                chat_id = int(params["chat_id"])
+            else:
+                # answerCallbackQuery не содержит чата — берём его из исходного апдейта
+                chat_id = self.callback_chats.get(str(params.get("callback_query_id")))
+            text = params.get("text") or params.get("caption") or ""
+            self.outputs.append((time.perf_counter(), chat_id, method, text))
+        return await super().call(method, params)
+
+def reply_latencies(api: ReplayBotApi) -> tuple:
+    """
+    Задержка апдейта — время до первого ответа бота в том же чате, пока не пришёл следующий апдейт чата.
+    При --speed 0 все апдейты подаются сразу и ответы нельзя сопоставить с апдейтами — тогда
+    сравнивается только общее время обработки.
+
+    @return (задержки в мс, число апдейтов без ответа)
+    """
+    pushes = defaultdict(list)
+    for pushed_at, chat_id in api.pushed:
+        pushes[chat_id].append(pushed_at)
+    replies = defaultdict(list)
+    for at, chat_id, method, text in api.outputs:
+        replies[chat_id].append(at)
+
+    latencies = []
+    unanswered = 0
+    for chat_id, times in pushes.items():
+        chat_replies = replies.get(chat_id, [])
+        position = 0
+        for index, pushed_at in enumerate(times):
+            next_push = times[index + 1] if index + 1 < len(times) else float("inf")
+            while position < len(chat_replies) and chat_replies[position] < pushed_at:
+                position += 1
+            if position < len(chat_replies) and chat_replies[position] < next_push:
+                latencies.append((chat_replies[position] - pushed_at) * 1000)
+            else:
+                unanswered += 1
+    return latencies, unanswered
+
+def chat_outputs(api: ReplayBotApi) -> dict:
+    """
+    Ответы бота по чатам в нормализованном виде (идентификаторы обращений и числа заменены) для сравнения версий.
+    Порядок обращений в чате поддержки зависит от параллельных пользователей, поэтому он сортируется.
+    """
+    outputs = defaultdict(list)
+    for at, chat_id, method, text in api.outputs:
+        outputs[str(chat_id)].append(f"{method}: {DIGITS.sub('#', TICKET_ID.sub('<ticket>', text))}")
+    support = str(SUPPORT_CHAT_ID)
+    if support in outputs:
+        outputs[support].sort()
+    return dict(outputs)
+
+def latency_summary(values: list) -> dict:
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "p50": round(percentile(values, 0.5), 3),
+        "p95": round(percentile(values, 0.95), 3),
+        "p99": round(percentile(values, 0.99), 3),
+        "max": round(max(values), 3),
+    }
+
+def git_revision(project_dir: str) -> str:
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=project_dir, capture_output=True, text=True)
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+async def replay(args) -> int:
+    records = read_records(args.recording)
+    if not records:
+        print("No updates to replay")
+        return 1
+    project_dir = os.path.abspath(args.project)
+
+    api = ReplayBotApi(args.file_size)
+    smtp = SmtpSink()
+    api_server = await asyncio.start_server(api.handle, "127.0.0.1", 0)
+    smtp_server = await asyncio.start_server(smtp.handle, "127.0.0.1", 0)
+    api_port = api_server.sockets[0].getsockname()[1]
+    smtp_port = smtp_server.sockets[0].getsockname()[1]
+
+    workdir = tempfile.mkdtemp(prefix="tg_bot_replay_")
+    bot = None
+    try:
+        prepare_workdir(workdir, not args.relax_config, project_dir)
+        env = bot_environment(workdir, api_port, smtp_port, args.workers, project_dir)
+        seed_path = os.path.join(workdir, "seed.json")
+        with open(seed_path, "w", encoding="utf-8") as target:
+            json.dump(stream_seed(records, args.allow_stream_emails), target)
+        seeded = subprocess.run([sys.executable, "-c", SEED_SCRIPT, seed_path], cwd=workdir, env=env,
+                                capture_output=True, text=True)
+        if seeded.returncode != 0:
+            print(f"Database seeding failed:\n{seeded.stderr}")
+            return 1
+
+        with open(os.path.join(workdir, "bot.out"), "wb") as output:
+            bot = subprocess.Popen(
+                [sys.executable, "-c", "import telegram_bot; telegram_bot.run_telegram_bot()"],
+                cwd=workdir, env=env, stdout=output, stderr=subprocess.STDOUT
+            )
+        print(f"Replaying {len(records)} updates from {args.recording} against {project_dir} "
+              f"(speed {args.speed or 'max'}), bot pid {bot.pid}")
+
+        try:
+            await asyncio.wait_for(api.polling.wait(), args.startup_timeout)
+        except asyncio.TimeoutError:
+            print(f"Bot did not start polling within {args.startup_timeout}s, see {workdir}/bot.out")
+            return 1
+
+        first_at = records[0]["t"]
+        started = time.perf_counter()
+        for record in records:
+            if args.speed > 0:
+                delay = started + (record["t"] - first_at) / args.speed - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            api.replay(record["update"])
+        fed = time.perf_counter() - started
+
+        # Ждём, пока бот не замолчит на --settle секунд (медиагруппы, конвейер обращений)
+        deadline = time.perf_counter() + args.timeout
+        while time.perf_counter() < deadline:
+            last_output = api.outputs[-1][0] if api.outputs else started
+            if time.perf_counter() - last_output >= args.settle:
+                break
+            await asyncio.sleep(0.1)
+        elapsed = (api.outputs[-1][0] if api.outputs else time.perf_counter()) - started
+
+        latencies, unanswered = reply_latencies(api) if args.speed > 0 else ([], None)
+        result = {
+            "meta": {
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "recording": os.path.abspath(args.recording),
+                "project": project_dir,
+                "revision": git_revision(project_dir),
+                "speed": args.speed,
+                "workers": args.workers,
+            },
+            "updates": len(records),
+            "feed_sec": round(fed, 3),
+            "elapsed_sec": round(elapsed, 3),
+            "updates_per_sec": round(len(records) / elapsed, 3) if elapsed > 0 else 0.0,
+            "latency_ms": latency_summary(latencies),
+            "unanswered": unanswered,
+            "support_chat_messages": api.support_messages,
+            "emails": smtp.messages,
+            "api_calls": dict(api.calls),
+            "outputs": chat_outputs(api),
+        }
+        summary = result["latency_ms"]
+        print(f"Fed in {fed:.1f}s, last reply after {elapsed:.1f}s ({result['updates_per_sec']:.1f} updates/s)")
+        if summary["count"]:
+            print(f"Replies to {summary['count']} updates, {unanswered} without reply")
+            print(f"Reply latency ms: p50 {summary['p50']:.1f}  p95 {summary['p95']:.1f}  "
+                  f"p99 {summary['p99']:.1f}  max {summary['max']:.1f}")
+        print(f"Support chat messages: {api.support_messages}, emails: {smtp.messages}")
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as target:
+                json.dump(result, target, indent=2, ensure_ascii=False)
+            print(f"Results written to {args.json}")
+        return 0
+    finally:
+        if bot is not None and bot.poll() is None:
+            bot.terminate()
+            try:
+                bot.wait(10)
+            except subprocess.TimeoutExpired:
+                bot.kill()
+        api_server.close()
+        smtp_server.close()
+        if args.keep_workdir:
+            print(f"Workdir kept: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def compare(before: dict, after: dict, threshold: float, show: int) -> int:
+    """
+    @return Число расхождений: чаты с разными ответами, разное число писем и рост p95 задержки выше threshold
+    """
+    print(f"Before: {before['meta'].get('revision')} {before['meta']['project']}")
+    print(f"After:  {after['meta'].get('revision')} {after['meta']['project']}\n")
+    if before["meta"]["speed"] != after["meta"]["speed"]:
+        print(f"Note: runs used different --speed ({before['meta']['speed']} and {after['meta']['speed']})\n")
+    problems = 0
+
+    print(f"{'':<22}{'before':>12}{'after':>12}")
+    for key in ("p50", "p95", "p99", "max"):
+        old, new = before["latency_ms"].get(key), after["latency_ms"].get(key)
+        if old is not None and new is not None:
+            print(f"latency {key} ms{'':<11}{old:>12.1f}{new:>12.1f}  {(new - old) / old * 100 if old else 0.0:+.1f}%")
+    for key in ("unanswered", "support_chat_messages", "emails", "elapsed_sec", "updates_per_sec"):
+        print(f"{key:<22}{str(before[key]):>12}{str(after[key]):>12}")
+
+    old_p95, new_p95 = before["latency_ms"].get("p95"), after["latency_ms"].get("p95")
+    if old_p95 and new_p95 and (new_p95 - old_p95) / old_p95 > threshold:
+        print(f"\nREGRESSION: p95 latency grew by more than {threshold * 100:.0f}%")
+        problems += 1
+    if before["emails"] != after["emails"]:
+        print("\nDIFFERENCE: number of emails sent")
+        problems += 1
+
+    chats = sorted(set(before["outputs"]) | set(after["outputs"]))
+    differing = [chat for chat in chats if before["outputs"].get(chat) != after["outputs"].get(chat)]
+    print(f"\nChats with different replies: {len(differing)} of {len(chats)}")
+    for chat in differing[:show]:
+        old, new = before["outputs"].get(chat, []), after["outputs"].get(chat, [])
+        index = next((i for i, (a, b) in enumerate(zip(old, new)) if a != b), min(len(old), len(new)))
+        print(f"\n  chat {chat}, reply #{index + 1} ({len(old)} -> {len(new)} replies):")
+        print(f"    before: {old[index][:200] if index < len(old) else '<none>'}")
+        print(f"    after:  {new[index][:200] if index < len(new) else '<none>'}")
+    problems += len(differing)
+    return problems
+
+def load(path: str) -> dict:
+    with open(path, encoding="utf-8") as source:
+        return json.load(source)
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Replay recorded updates and compare two bot builds")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Воспроизвести запись")
+    run_parser.add_argument("recording", help="Файл UPDATE_RECORD_FILE (.jsonl или .jsonl.gz)")
+    run_parser.add_argument("--project", default=PROJECT_DIR, help="Каталог версии бота (например, git worktree)")
+    run_parser.add_argument("--speed", type=float, default=1.0, help="Множитель темпа; 0 — без пауз")
+    run_parser.add_argument("--workers", type=int, default=1, help="BOT_WORKERS для запускаемого бота")
+    run_parser.add_argument("--allow-stream-emails", action="store_true",
+                            help="Добавить адреса из сообщений записи в список разрешённых")
+    run_parser.add_argument("--relax-config", action="store_true",
+                            help="Снять лимиты и паузу после авторизации, как в load_test.py")
+    run_parser.add_argument("--file-size", type=int, default=64 * 1024, help="Размер файла, отдаваемого getFile, в байтах")
+    run_parser.add_argument("--settle", type=float, default=3.0, help="Тишина после последнего ответа, после которой прогон завершён, с")
+    run_parser.add_argument("--timeout", type=float, default=120.0, help="Максимальное ожидание ответов после подачи всех апдейтов, с")
+    run_parser.add_argument("--startup-timeout", type=float, default=30.0)
+    run_parser.add_argument("--keep-workdir", action="store_true", help="Оставить временный каталог с логами и БД")
+    run_parser.add_argument("--json", help="Записать результаты в JSON-файл")
+
+    compare_parser = commands.add_parser("compare", help="Сравнить результаты двух прогонов")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    compare_parser.add_argument("--threshold", type=float, default=0.2, help="Допустимый рост p95 задержки (доля)")
+    compare_parser.add_argument("--show", type=int, default=10, help="Сколько различающихся чатов показать")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        return 1 if compare(load(args.before), load(args.after), args.threshold, args.show) else 0
+    return asyncio.run(replay(args))
+
+if __name__ == "__main__":
+    sys.exit(main())
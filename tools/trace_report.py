@@ -0,0 +1,124 @@
+"""
+Разбор журнала трасс (TRACE_FILE): разбивка задержки по стадиям конвейера
+и по видам спанов (обработчики, БД, шаблоны, Telegram API, SMTP), самые медленные трассы.
+
+Запуск из корня проекта:
+    python tools/trace_report.py
+    python tools/trace_report.py logs/trace.jsonl logs/trace.jsonl.1.gz --name ticket --slowest 10
+"""
+import os
+import sys
+import glob
+import gzip
+import json
+import argparse
+from collections import defaultdict
+
+DEFAULT_TRACE_FILE = "logs/trace.jsonl"
+
+def default_paths() -> list:
+    # Текущий файл и ротированные копии (в том числе сжатые)
+    base = os.getenv("TRACE_FILE", DEFAULT_TRACE_FILE)
+    return sorted(glob.glob(base + ".*"), reverse=True) + ([base] if os.path.exists(base) else [])
+
+def read_traces(paths: list) -> list:
+    traces = []
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as source:
+            for number, line in enumerate(source, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    traces.append(json.loads(line))
+                except json.JSONDecodeError:
+                    print(f"{path}:{number}: skipped malformed line", file=sys.stderr)
+    return traces
+
+def percentile(values: list, share: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(share * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def summary(values: list) -> str:
+    return (f"{len(values):6d}  p50 {percentile(values, 0.5):9.1f}  p95 {percentile(values, 0.95):9.1f}  "
+            f"p99 {percentile(values, 0.99):9.1f}  max {max(values):9.1f}")
+
+def stage_breakdown(traces: list) -> dict:
+    """
+    Для трасс обращений: время стадий и ожидание в очереди перед каждой стадией, мс.
+    """
+    stages = defaultdict(lambda: {"work": [], "wait": []})
+    for trace in traces:
+        previous_end = 0.0
+        for span in trace["spans"]:
+            if span["kind"] != "stage":
+                continue
+            stages[span["name"]]["wait"].append(max(span["offset_ms"] - previous_end, 0.0))
+            stages[span["name"]]["work"].append(span["duration_ms"])
+            previous_end = span["offset_ms"] + span["duration_ms"]
+    return stages
+
+def print_tree(trace: dict):
+    depth = {0: 0}
+    print(f"\n{trace['name']} {trace['trace_id']}: {trace['duration_ms']:.1f} ms"
+          + (f" (from {trace['parent_trace_id']})" if trace.get("parent_trace_id") else "")
+          + (f" ERROR {trace['error']}" if trace.get("error") else ""))
+    for span in trace["spans"]:
+        depth[span["id"]] = depth.get(span["parent"], 0) + 1
+        error = f"  ERROR {span['error']}" if span.get("error") else ""
+        print(f"  {span['offset_ms']:9.1f} +{span['duration_ms']:9.1f} ms  "
+              f"{'  ' * (depth[span['id']] - 1)}{span['kind']}:{span['name']}{error}")
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Per-stage latency breakdown from trace logs")
+    parser.add_argument("paths", nargs="*", help="Файлы трасс (по умолчанию TRACE_FILE и его ротированные копии)")
+    parser.add_argument("--name", help="Только трассы с этим корнем: update или ticket")
+    parser.add_argument("--top", type=int, default=20, help="Сколько видов спанов показать")
+    parser.add_argument("--slowest", type=int, default=5, help="Сколько самых медленных трасс показать целиком")
+    args = parser.parse_args()
+
+    paths = args.paths or default_paths()
+    if not paths:
+        print("No trace files found (set TRACE_SAMPLE_RATE or TRACE_SLOW_MS to record traces)")
+        return 1
+    traces = read_traces(paths)
+    if args.name:
+        traces = [trace for trace in traces if trace["name"] == args.name]
+    if not traces:
+        print("No traces to report")
+        return 1
+
+    print(f"{len(traces)} traces from {len(paths)} file(s), durations in ms\n")
+    by_root = defaultdict(list)
+    for trace in traces:
+        by_root[trace["name"]].append(trace["duration_ms"])
+    print("Traces:")
+    for name, durations in sorted(by_root.items()):
+        print(f"  {name:<12} {summary(durations)}")
+
+    tickets = [trace for trace in traces if trace["name"] == "ticket"]
+    if tickets:
+        print("\nTicket pipeline stages (queue wait / work):")
+        for stage, values in stage_breakdown(tickets).items():
+            print(f"  {stage:<12} wait {summary(values['wait'])}")
+            print(f"  {'':<12} work {summary(values['work'])}")
+
+    # Вложенные спаны тоже учитываются, поэтому доли в сумме могут превышать 100%
+    spans = defaultdict(list)
+    for trace in traces:
+        for span in trace["spans"]:
+            spans[f"{span['kind']}:{span['name']}"].append(span["duration_ms"])
+    total_ms = sum(trace["duration_ms"] for trace in traces) or 1.0
+    ranked = sorted(spans.items(), key=lambda item: sum(item[1]), reverse=True)[:args.top]
+    print(f"\nTop {args.top} spans by total time (share of all trace time):")
+    for name, durations in ranked:
+        print(f"  {100 * sum(durations) / total_ms:5.1f}%  {summary(durations)}  {name}")
+
+    for trace in sorted(traces, key=lambda trace: trace["duration_ms"], reverse=True)[:args.slowest]:
+        print_tree(trace)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())